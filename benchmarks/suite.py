@@ -0,0 +1,293 @@
+#!/usr/local/bin/python3
+
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.functions import parse_options, split_list
+
+DUPECHECK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dupecheck.py')
+
+OPTIONS = {
+    '--scales': split_list,
+    '--depth': int,
+    '--dir-files': int,
+    '--sizes': str,
+    '--size-dist': str,
+    '--dup-ratio': float,
+    '--churn': float,
+    '--seed': int,
+    '--repeat': int,
+    '--output': str,
+    '--baseline': str,
+    '--threshold': float,
+    '--args': str,
+    '--keep': None
+}
+
+DEFAULTS = {
+    'scales': ['1000', '10000'],
+    'depth': 3,
+    'dir_files': 100,
+    'sizes': '0-65536',
+    'size_dist': 'log',
+    'dup_ratio': 0.1,
+    'churn': 0.05,
+    'seed': 1,
+    'repeat': 1,
+    'output': 'benchmark_results.json',
+    'threshold': 0.10,
+    'args': ''
+}
+
+# the steps timed at each scale, in the order they are run. Each one runs against the state the one
+# before it left behind.
+STEPS = ('create', 'update_no_change', 'update_churn', 'check', 'report')
+
+
+def usage():
+    print(f"\n{sys.argv[0]}  [options]\n")
+    print("Generates synthetic directory trees in a temp directory, and times create, an update with no")
+    print("changes, an update after some files have changed, check and report on each, at every scale.")
+    print("The same seed always generates the same trees, so runs on different versions of the code can")
+    print("be compared. Results are written to a JSON file, and can be compared to a stored baseline.")
+    print("\nOptions:")
+    print("--scales LIST     - comma separated numbers of files to generate trees of. Defaults to 1000,10000")
+    print("--depth N         - the number of directory levels above the files. Defaults to 3")
+    print("--dir-files N     - the number of files in each directory. Defaults to 100")
+    print("--sizes MIN-MAX   - the range of file sizes, in bytes. Defaults to 0-65536")
+    print("--size-dist D     - uniform, or log (log-uniform, so most files are small). Defaults to log")
+    print("--dup-ratio F     - the fraction of files that duplicate the content of another. Defaults to 0.1")
+    print("--churn F         - the fraction of files changed before the second update. A third are")
+    print("                    rewritten, a third deleted and a third added. Defaults to 0.05")
+    print("--seed N          - the random seed the trees are generated from. Defaults to 1")
+    print("--repeat N        - run each scale N times, and keep the fastest time of each step. Defaults to 1")
+    print("--output FILE     - where to write the results. Defaults to benchmark_results.json")
+    print("--baseline FILE   - results of an earlier run, to compare against. Exits with status 1 if any")
+    print("                    step is slower than the baseline by more than the threshold")
+    print("--threshold F     - the slowdown allowed before a step counts as a regression. Defaults to 0.10")
+    print("--args 'ARGS'     - extra options passed to every command, e.g. '--walkers 4 --jobs 8'")
+    print("--keep            - leave the generated trees and databases in the temp directory")
+    print("")
+
+
+class TreeGenerator:
+    """
+    Writes a synthetic tree of files. Directories are nested depth levels deep, with dir_files files
+    in each directory at the bottom. File content is a repeated 8 byte id, so files with the same id
+    and size are duplicates, and any two files with different ids differ in their first bytes.
+    """
+
+    def __init__(self, root, config):
+        self.root = root
+        self.config = config
+        self.random = random.Random(config['seed'])
+        low, high = config['sizes'].split('-')
+        self.min_size = int(low)
+        self.max_size = int(high)
+        self.next_id = 0
+        self.contents = []
+
+    def random_size(self):
+        if self.config['size_dist'] == 'uniform':
+            return self.random.randint(self.min_size, self.max_size)
+        low = math.log(self.min_size + 1)
+        high = math.log(self.max_size + 1)
+        return int(math.exp(self.random.uniform(low, high))) - 1
+
+    def new_content(self):
+        # either a copy of content already written, or something new
+        if self.contents and self.random.random() < self.config['dup_ratio']:
+            return self.random.choice(self.contents)
+        self.next_id += 1
+        content = (self.next_id, self.random_size())
+        self.contents.append(content)
+        return content
+
+    def dir_for(self, index, file_count):
+        dir_count = max(1, math.ceil(file_count / self.config['dir_files']))
+        fanout = max(2, math.ceil(dir_count ** (1 / max(1, self.config['depth']))))
+        leaf = index // self.config['dir_files']
+        parts = []
+        for _ in range(max(1, self.config['depth'])):
+            leaf, digit = divmod(leaf, fanout)
+            parts.append(f"d{digit}")
+        return os.path.join(self.root, *reversed(parts))
+
+    def write_file(self, path, content):
+        content_id, size = content
+        block = struct.pack('<Q', content_id)
+        with open(path, 'wb') as f:
+            f.write((block * (size // len(block) + 1))[:size])
+
+    def generate(self, file_count):
+        """
+        :return: the list of file paths written
+        """
+        paths = []
+        for index in range(file_count):
+            dirname = self.dir_for(index, file_count)
+            if index % self.config['dir_files'] == 0:
+                os.makedirs(dirname, exist_ok=True)
+            path = os.path.join(dirname, f"f{index}.dat")
+            self.write_file(path, self.new_content())
+            paths.append(path)
+        return paths
+
+    def churn(self, paths):
+        """
+        Rewrite, delete and add a fraction of the files, as set by the churn option
+        :return: the list of file paths after the changes
+        """
+        count = int(len(paths) * self.config['churn'] / 3)
+        chosen = self.random.sample(range(len(paths)), min(len(paths), count * 2))
+        for index in chosen[:count]:
+            self.write_file(paths[index], (self.next_id + 1, self.random_size()))
+            self.next_id += 1
+        deleted = set(chosen[count:])
+        for index in deleted:
+            os.remove(paths[index])
+        remaining = [path for index, path in enumerate(paths) if index not in deleted]
+        for index in range(count):
+            path = os.path.join(os.path.dirname(self.random.choice(remaining)), f"new{index}.dat")
+            self.write_file(path, self.new_content())
+            remaining.append(path)
+        return remaining
+
+
+def run_command(command, dbfile, tree, workdir, extra):
+    """
+    Run one dupecheck command in its own interpreter, with its output thrown away
+    :return: a dictionary of the wall clock seconds, and the metrics the command recorded
+    """
+    stats_file = os.path.join(workdir, 'stats.json')
+    arguments = [dbfile] if tree is None else [dbfile, tree]
+    args = [sys.executable, DUPECHECK, command] + arguments + ['--quiet', '--stats-json', stats_file] + extra
+    start = time.perf_counter()
+    subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    with open(stats_file) as f:
+        stats = json.load(f)
+    return {'seconds': round(elapsed, 4), 'stats': stats}
+
+
+def run_scale(file_count, config, workdir):
+    """
+    Generate a tree of file_count files and time every step against it
+    :return: a dictionary of step name to result
+    """
+    tree = os.path.join(workdir, f"tree_{file_count}")
+    dbfile = os.path.join(workdir, f"files_{file_count}.db")
+    shutil.rmtree(tree, ignore_errors=True)
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(dbfile + suffix):
+            os.remove(dbfile + suffix)
+
+    extra = config['args'].split()
+    generator = TreeGenerator(tree, config)
+    paths = generator.generate(file_count)
+
+    results = dict()
+    results['create'] = run_command('create', dbfile, tree, workdir, extra)
+    results['update_no_change'] = run_command('update', dbfile, tree, workdir, extra)
+    generator.churn(paths)
+    results['update_churn'] = run_command('update', dbfile, tree, workdir, extra)
+    results['check'] = run_command('check', dbfile, tree, workdir, extra)
+    results['report'] = run_command('report', dbfile, None, workdir, extra)
+    return results
+
+
+def fastest(runs):
+    # keep the fastest run of each step
+    best = dict()
+    for results in runs:
+        for step, result in results.items():
+            if step not in best or result['seconds'] < best[step]['seconds']:
+                best[step] = result
+    return best
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each step's time against the baseline
+    :return: True if any step is slower than the baseline by more than the threshold
+    """
+    regressed = False
+    print(f"\n{'scale':>10}  {'step':<18} {'baseline':>10} {'now':>10} {'change':>8}")
+    for scale, steps in results['results'].items():
+        for step in STEPS:
+            base = baseline.get('results', {}).get(scale, {}).get(step)
+            if base is None or step not in steps:
+                continue
+            before = base['seconds']
+            after = steps[step]['seconds']
+            change = (after - before) / before if before else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f"{scale:>10}  {step:<18} {before:>10.3f} {after:>10.3f} {change:>+8.1%}{flag}")
+    print("")
+    return regressed
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        usage()
+        return 0
+    try:
+        positional, options = parse_options(sys.argv[1:], OPTIONS)
+    except ValueError as err:
+        print(f"\nError: {err}\n")
+        usage()
+        return 2
+    config = dict(DEFAULTS, **options)
+    config['keep'] = options.get('keep', False)
+
+    workdir = tempfile.mkdtemp(prefix='dupecheck_bench_')
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in config.items() if key not in ('output', 'baseline', 'keep')},
+        'results': dict()
+    }
+    try:
+        for scale in config['scales']:
+            file_count = int(scale)
+            print(f"{file_count:,} files:")
+            runs = [run_scale(file_count, config, workdir) for _ in range(max(1, config['repeat']))]
+            results['results'][str(file_count)] = fastest(runs)
+            for step in STEPS:
+                print(f"\t{step:<18} {results['results'][str(file_count)][step]['seconds']:.3f} s")
+    finally:
+        if config['keep']:
+            print(f"\nTrees and databases left in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(config['output'], 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"\nResults written to {config['output']}")
+
+    if config.get('baseline'):
+        with open(config['baseline']) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, config['threshold']):
+            return 1
+    return 0
+
+
+sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/local/bin/python3
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.functions import parse_options
+
+OPTIONS = {
+    '--files': int
+}
+
+# the number of files in the generated tree, when no directory is given
+DEFAULT_FILES = 20000
+
+# the walkers being compared. Each is run in its own interpreter, so the counts are not mixed up
+WALKERS = {
+    'os.walk': '''
+import os, sys
+count = 0
+for dirName, subdirList, fileList in os.walk(sys.argv[1]):
+    for fname in fileList:
+        if fname in ['.DS_Store']:
+            continue
+        os.stat(os.path.join(dirName, fname))
+        count += 1
+print(count)
+''',
+    'scan_tree': '''
+import sys
+sys.path.insert(0, sys.argv[2])
+from utils.walk import scan_tree
+print(sum(len(records) for records in scan_tree(sys.argv[1])))
+'''
+}
+
+# the syscalls that make up the cost of a walk
+WALK_SYSCALLS = ('newfstatat', 'statx', 'stat', 'lstat', 'fstat', 'getdents64', 'openat', 'close')
+
+
+def usage():
+    print(f"\n{sys.argv[0]}  [directory_to_walk]  [--files N]\n")
+    print("Counts the syscalls made walking a directory tree with os.walk plus a stat per file (the way")
+    print("treewalk_with_action used to), and with scan_tree. If no directory is given, a synthetic tree")
+    print("of N files (default 20,000) is generated in a temp directory and removed afterwards.")
+    print("Syscalls are counted with strace, so it must be installed. Without it, only times are shown.")
+    print("")
+
+
+def make_tree(root, file_count, per_dir=100):
+    for n in range(file_count):
+        dirname = os.path.join(root, f"d{n // (per_dir * 10)}", f"s{n // per_dir}")
+        if n % per_dir == 0:
+            os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, f"f{n}.dat"), 'wb') as f:
+            f.write(b'x' * (n % 4096))
+
+
+def parse_strace_summary(filename):
+    """
+    Read the table written by strace -c
+    :param filename: the file strace wrote its summary to
+    :return: a dictionary of syscall name to number of calls
+    """
+    counts = dict()
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 5 and fields[0][0].isdigit() and not fields[-1] == 'total':
+                counts[fields[-1]] = int(fields[3])
+    return counts
+
+
+def run_walker(name, directory, strace):
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, '-c', WALKERS[name], directory, package_dir]
+    with tempfile.NamedTemporaryFile(suffix='.strace') as summary:
+        if strace:
+            command = [strace, '-f', '-c', '-o', summary.name] + command
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        elapsed = time.perf_counter() - start
+        counts = parse_strace_summary(summary.name) if strace else dict()
+    return int(result.stdout.split()[-1]), elapsed, counts
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        usage()
+        return
+    try:
+        positional, options = parse_options(sys.argv[1:], OPTIONS)
+    except ValueError as err:
+        print(f"\nError: {err}\n")
+        usage()
+        return
+
+    strace = shutil.which('strace')
+    if not strace:
+        print("\nstrace is not installed, so only the times are shown.")
+
+    tempdir = None
+    if positional:
+        directory = positional[0]
+    else:
+        tempdir = tempfile.mkdtemp(prefix='dupecheck_walk_')
+        directory = tempdir
+        make_tree(directory, options.get('files', DEFAULT_FILES))
+
+    try:
+        print(f"\nWalking {directory}\n")
+        for name in WALKERS:
+            files, elapsed, counts = run_walker(name, directory, strace)
+            print(f"{name}: {files:,} files in {elapsed:.3f} seconds")
+            for syscall in WALK_SYSCALLS:
+                if syscall in counts:
+                    print(f"\t{syscall}: {counts[syscall]:,}")
+            if counts:
+                print(f"\ttotal syscalls: {sum(counts.values()):,}")
+            print("")
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+
+
+main()
@@ -1,9 +1,90 @@
 import os
+import signal
+import sqlite3
+from contextlib import contextmanager
+from functools import partial
+from operator import itemgetter
 
 from utils import db
-from utils.functions import treewalk_with_action, is_file, is_dir, normalize_dir_name, print_matches
-from utils.help import usage, help_create, help_check, help_update, help_report
+from utils.functions import treewalk_with_action, is_file, is_dir, normalize_dir_name, print_matches, save_hashes, \
+                            parse_options, digest_duplicates, split_list, size_group_candidates, \
+                            print_content_matches
+from utils.output import Output, output_format
+from utils.metrics import METRICS
+from utils.names import name_mode, normalize_name
+from utils.help import usage, help_create, help_check, help_update, help_report, help_compare, help_watch, \
+                       help_export, help_import
 
+# the modules only some of the commands need (hashing, the walk and its pipeline, snapshots and the
+# watch backends) are imported by those commands, so the others start up without loading them
+
+def backend_option(value):
+    # the converter for watch's --backend option
+    from utils.watch import watch_backend
+    return watch_backend(value)
+
+
+# options accepted by every command, for how the results are written
+OUTPUT_OPTIONS = {
+    '--format': output_format,
+    '--quiet': None,
+    '--only-changes': None,
+    '--output': str,
+    '--progress': None,
+    '--stats': None,
+    '--stats-json': str
+}
+
+# options accepted by every command that hashes file content
+POOL_OPTIONS = dict(OUTPUT_OPTIONS, **{
+    '--jobs': int,
+    '--device-jobs': int
+})
+
+# options accepted by report
+REPORT_OPTIONS = dict(POOL_OPTIONS, **{
+    '--attach': split_list,
+    '--names': name_mode
+})
+
+# options accepted by the commands that walk a directory tree and hash file content
+HASH_OPTIONS = dict(POOL_OPTIONS, **{
+    '--exclude': split_list,
+    '--prune': split_list,
+    '--walkers': int,
+    '--ordered': None
+})
+
+# options accepted by check
+CHECK_OPTIONS = dict(HASH_OPTIONS, **{
+    '--attach': split_list,
+    '--names': name_mode
+})
+
+# options accepted by the commands that write file info to the database
+WRITE_OPTIONS = dict(HASH_OPTIONS, **{
+    '--commit-rows': int,
+    '--commit-seconds': float,
+    '--resume': None
+})
+
+# options accepted by update only
+UPDATE_OPTIONS = dict(WRITE_OPTIONS, **{
+    '--incremental': None
+})
+
+# options accepted by watch
+WATCH_OPTIONS = dict(POOL_OPTIONS, **{
+    '--exclude': split_list,
+    '--prune': split_list,
+    '--commit-rows': int,
+    '--commit-seconds': float,
+    '--incremental': None,
+    '--backend': backend_option,
+    '--debounce': float,
+    '--poll-seconds': float,
+    '--alert': None
+})
 
 class CommandException(Exception):
     """
@@ -33,6 +114,127 @@ def validate_general_params(parameters):
     return True
 
 
+def parse_command_options(parameters, options, help_function):
+    """
+    Split the parameters into positional parameters and options, displaying the error and the command
+    help if they are not valid
+    :param parameters: the parameters passed in to the command
+    :         options: dictionary of accepted options, as for parse_options
+    :   help_function: the help function to display on an error
+    :return: a tuple of (positional parameters, option values), or (None, None) on an error
+    """
+    try:
+        positional, values = parse_options(parameters, options)
+    except ValueError as err:
+        print(f"\nError: {err}")
+        help_function()
+        return None, None
+    # found out now, rather than once the whole walk has been done
+    try:
+        check_output_files(values)
+    except CommandException as err:
+        print(f"\nError: {err}\n")
+        return None, None
+    return positional, values
+
+
+def check_output_files(options):
+    """
+    Make sure the files the --output and --stats-json options name can be written, without creating them.
+    Will raise a CommandException if one of them cannot.
+    :param options: the options dictionary returned by parse_options
+    :return: nothing
+    """
+    for name in ('output', 'stats_json'):
+        filename = options.get(name)
+        if filename is None:
+            continue
+        directory = os.path.dirname(os.path.abspath(filename))
+        if is_dir(filename) or not is_dir(directory) or \
+                not os.access(filename if os.path.exists(filename) else directory, os.W_OK):
+            raise CommandException(f"{filename} cannot be written to")
+
+
+def create_hash_pool(options):
+    """
+    Create the HashPool for the content digest stage from the --jobs and --device-jobs options
+    :param options: the option values parsed from the command line
+    :return: a HashPool object
+    """
+    from utils.hashing import HashPool, DEFAULT_JOBS, DEFAULT_DEVICE_JOBS
+    return HashPool(options.get('jobs', DEFAULT_JOBS), options.get('device_jobs', DEFAULT_DEVICE_JOBS))
+
+
+def create_output(options):
+    """
+    Create the Output the results of a command are written to, from the command line options
+    :param options: the options dictionary returned by parse_options
+    :return: an Output object, or None if the --output file could not be opened. It must be closed once
+    :      : the command is done with it.
+    """
+    try:
+        return Output(options.get('format', 'text'), options.get('quiet', False), options.get('only_changes', False), \
+                      options.get('output'))
+    except OSError as err:
+        print(f"\nError: {options.get('output')}: {err.strerror}\n")
+        return None
+
+
+def start_metrics(options):
+    """
+    Start measuring the run, if any of the options that show the measurements were given
+    :param options: the options dictionary returned by parse_options
+    """
+    if options.get('progress') or options.get('stats') or options.get('stats_json'):
+        METRICS.enable(progress=options.get('progress', False))
+
+
+def finish_metrics(options):
+    """
+    Write out the timing summary of the run, as the options ask for, and stop measuring
+    :param options: the options dictionary returned by parse_options
+    """
+    if not METRICS.enabled:
+        return
+    if options.get('stats'):
+        METRICS.print_summary()
+    if options.get('stats_json'):
+        try:
+            METRICS.write_json(options['stats_json'])
+        except OSError as err:
+            print(f"\nError: {options['stats_json']}: {err.strerror}\n")
+    METRICS.disable()
+
+
+def create_walk_filter(options):
+    """
+    Create the WalkFilter for a treewalk from the --exclude and --prune options. The default file names
+    are always excluded.
+    :param options: the option values parsed from the command line
+    :return: a WalkFilter object
+    """
+    from utils.walk import WalkFilter, DEFAULT_EXCLUDE
+    return WalkFilter(DEFAULT_EXCLUDE + tuple(options.get('exclude', ())), options.get('prune', ()))
+
+
+def attach_databases(file_db, filenames):
+    """
+    Attach the databases named by the --attach option to the database, so they are searched as well.
+    Will raise a CommandException if one of them is not a file, or not a database of file info.
+    :param file_db: the FileDatabase object to attach them to
+    :    filenames: list of database file names
+    :return: nothing
+    """
+    for filename in filenames:
+        if not is_file(filename):
+            raise CommandException(f"{filename} is not a file, does not exist, or is not accessible")
+    for number, filename in enumerate(filenames, 1):
+        try:
+            file_db.attach(filename, f"db{number}")
+        except sqlite3.DatabaseError as err:
+            raise CommandException(f"{filename} can not be attached: {err}")
+
+
 def create(parameters):
     """
     Create the database file, and then execute an update on it
@@ -41,23 +243,41 @@ def create(parameters):
     :                : sripped, leaving only the parameters for the command itself.
     :return: nothing
     """
-    if len(parameters) != 2:
+    positional, options = parse_command_options(parameters, WRITE_OPTIONS, help_create)
+    if positional is None:
+        return
+    if len(positional) != 2:
         help_create()
         return
 
-    dbfilename = parameters[0]
-    dir_to_walk = normalize_dir_name(parameters[1])
+    dbfilename = positional[0]
+    dir_to_walk = normalize_dir_name(positional[1])
 
-    if is_file(dbfilename):
-        print(f"\nError: file {dbfilename} already exists. Will not create database file on top of it.\n")
-        return
-    
     if not is_dir(dir_to_walk):
         print(f"\nError: {dir_to_walk} is not a directory, does not exist, or is not accessible.")
         return
-    
-    file_db = db.FileDatabase(dbfilename)
-    file_db.cleanup()
+
+    if is_file(dbfilename):
+        if not options.get('resume'):
+            print(f"\nError: file {dbfilename} already exists. Will not create database file on top of it.\n")
+            return
+        # carry on with the create that was interrupted, which update does
+        file_db = db.FileDatabase(dbfilename)
+        if not file_db.is_built():
+            # interrupted before the tables were written, so there is nothing to keep: start it over
+            file_db.cleanup()
+            file_db.close()
+            update(parameters)
+            return
+        run = file_db.find_run()
+        file_db.close()
+        if run is None:
+            print(f"\nError: file {dbfilename} has no interrupted run to resume.\n")
+            return
+    else:
+        file_db = db.FileDatabase(dbfilename)
+        file_db.cleanup()
+        file_db.close()
 
     # now that the database is initialized, use update command method to populate the new database
     update(parameters)
@@ -71,89 +291,279 @@ def check(parameters):
     :                : sripped, leaving only the parameters for the command itself.
     :return: nothing    
     """
-
-    if len(parameters) != 2:
+    positional, options = parse_command_options(parameters, CHECK_OPTIONS, help_check)
+    if positional is None:
+        return
+    if len(positional) != 2:
         help_check()
         return
 
     try:
-        validate_general_params(parameters)
+        validate_general_params(positional)
     except CommandException as err:
         print(f"\nError: {err}\n")
         return
 
-    dbfilename = parameters[0]
-    dir_to_walk = normalize_dir_name(parameters[1])
+    dbfilename = positional[0]
+    dir_to_walk = normalize_dir_name(positional[1])
 
     file_db = db.FileDatabase(dbfilename)
+    try:
+        attach_databases(file_db, options.get('attach', ()))
+    except CommandException as err:
+        print(f"\nError: {err}\n")
+        file_db.close()
+        return
+    output = create_output(options)
+    if output is None:
+        file_db.close()
+        return
+
+    start_metrics(options)
     state = dict()
     state['tot_matches'] = 0
-    state['tot_size_matches'] = 0
+    state['tot_content_matches'] = 0
+    state['tot_link_matches'] = 0
     state['tot_name_matches'] = 0
+    state['candidates'] = dict()
+    state['output'] = output
+    state['names'] = options.get('names', 'exact')
+    pool = create_hash_pool(options)
 
-    return_state = treewalk_with_action(file_db, dir_to_walk, [".DS_Store"], check_helper, \
-                                        in_state = state)
-    
+    # the walk, the lookups, the hashing and the writes each run on a thread of their own, a batch of
+    # files at a time, so the time spent waiting on the file system overlaps the time spent in SQLite
+    stages = [CheckLookup(dbfilename, options.get('attach', ()), state), partial(confirm_check_batch, pool)]
+    from utils.pipeline import CancelToken
+    cancel = CancelToken()
+    try:
+        with cancel_on_signals(cancel):
+            return_state = treewalk_with_action(file_db, dir_to_walk, create_walk_filter(options), flush_check, \
+                                                in_state = state, walkers = options.get('walkers', 1), \
+                                                ordered = options.get('ordered', False), stages = stages, \
+                                                cancel = cancel)
+    finally:
+        pool.close()
+
+    if cancel.cancelled:
+        output.message("\nInterrupted. The matches found so far are shown.")
     if state['tot_matches'] == 0:
-        print("\nNo duplicates found.\n")
-        return
-    
-    tot_matches = return_state['tot_matches']
-    tot_size_matches = return_state['tot_size_matches']
-    tot_name_matches = return_state['tot_name_matches']
-    print(f"\nTotal possible matches found: {tot_matches:,}")
-    print(f"Size matches: {tot_size_matches:,}")
-    print(f"Name matches: {tot_name_matches:,}\n")
+        output.message("\nNo duplicates found.\n")
+    else:
+        output.summary([('Total matches found', return_state['tot_matches']),
+                        ('Confirmed content matches', return_state['tot_content_matches']),
+                        ('Hard links', return_state['tot_link_matches']),
+                        ('Name matches', return_state['tot_name_matches'])])
+    output.close()
+    finish_metrics(options)
 
 
-def check_helper(file_db, dir, fname, filesize, state):
+class CheckLookup:
     """
-    This is the check() helper function that is executed inside the treewalk_with_action
-    It will compare each found file with the database to see if there are any possible matches,
-    and if so, will display those.
-    :param file_db: the FileDatabase object for the connected database containing the file data
-    :          dir: the directory the treewalk is currently in
-    ;        fname: the specific file the treewalk is currently at
-    :     filesize: the current (e.g. up-to-date) size of the file
+    The lookup stage of check's pipeline. It looks up each batch of walked files through a connection
+    of its own, opened on the stage's thread, so the lookups for one batch run while the results of
+    the last are being hashed and written. The database is in WAL mode, so reading it never waits on
+    the writes.
+    """
+
+    def __init__(self, dbfilename, attach, state):
+        """
+        :param dbfilename: the database file to look the files up in
+        :          attach: list of database files to attach to it, as for --attach
+        :           state: the state dictionary for the check run
+        """
+        self.dbfilename = dbfilename
+        self.attach = attach
+        self.state = state
+        self.file_db = None
+
+    def __call__(self, records):
+        if self.file_db is None:
+            self.file_db = db.FileDatabase(self.dbfilename)
+            attach_databases(self.file_db, self.attach)
+        return check_helper(self.file_db, records, self.state)
+
+    def close(self):
+        if self.file_db is not None:
+            self.file_db.close()
+            self.file_db = None
+
+
+def check_helper(file_db, records, state):
+    """
+    This is the check() helper function that is executed by the lookup stage of the treewalk
+    It will compare each found file with the database to see if there are any duplicates, looking up
+    the sizes and names of the whole batch in two queries. Files of the same size are only reported
+    once their content has been confirmed to match by the staged hash verification, which the next
+    stage runs on the batch. Stored files with the same device and inode as the walked file are hard
+    links to it, and are shown as such, not as duplicates.
+    With other databases attached, the sizes and names are looked up in all of them at once. With
+    --names fuzzy, the stored files with names like the walked file's are found through the trigram
+    index, most alike first.
+    :param file_db: the lookup stage's own FileDatabase object for the database containing the file data
+    :      records: the batch of FileRecords the treewalk has found
     ;        state: a dictionary that can be used to store state info needed through the entire
     :             : treewalk run
-    :return: Nothing. All results are either output via print, or stored in the state dictionary
-    """
-    full_file_name = os.path.join(dir, fname)
-   
-    result = file_db.find_files_of_size(filesize)
-    found = 0
-    if result:
-        for match in result:
-            if match[0] == dir and match[1] == fname:
-                continue
-            found += 1
-            if found == 1:
-                print(f"{full_file_name}: possible matches file size:")	
-            state['tot_matches'] += 1
-            state['tot_size_matches'] += 1
-            target_fname = os.path.join(match[0], match[1])
-            print(f"\t{target_fname}")
-        if found:
-            print("\n")
-
-    result = file_db.find_files_of_name(fname)
-    found = 0
-    if result:
-        for match in result:
-            if match[0] == dir and match[1] == fname:
-                continue
-            found += 1
-            if found == 1:
-                print(f"{full_file_name}: possible matches file name:")
-            state['tot_matches'] += 1
-            state['tot_name_matches'] += 1
-            target_fname = os.path.join(match[0], match[1])
-            print(f"\t{target_fname}")
-        if found:
-            print("\n")
-    
-    return state
+    :return: a list of (dir, fname, Candidate of the walked file, Candidates of the stored files of the
+    :      : same size, name matches) tuples, for the walked files with any possible match
+    """
+    # look up the sizes and names of the whole batch at once, rather than two queries per file
+    by_size = dict()
+    for match in file_db.iter_files_of_sizes({record.filesize for record in records}):
+        by_size.setdefault(match[2], []).append(match)
+    by_name = find_name_matches(file_db, {record.filename for record in records}, state['names'] == 'fuzzy')
+
+    pending = []
+    for dir, fname, filesize, mtime, inode, device in records:
+        matches = [match for match in by_size.get(filesize, ()) if not (match[0] == dir and match[1] == fname)]
+        current = None
+        stored = []
+        if matches:
+            # the walked file is never given the hashes stored for its path, which may be out of date
+            current = get_candidate(state, 'walked', dir, fname, filesize, device=device, inode=inode)
+            # a path stored in more than one of the attached databases is the same Candidate, and only
+            # taken once
+            stored = list(dict.fromkeys(get_candidate(state, 'stored', match[0], match[1], filesize, match[3], \
+                                                      match[4], match[5], match[6], match[7]) for match in matches))
+
+        # links to the walked file are not possible matches for it
+        identity = (device, inode) if inode is not None else None
+        name_matches = list(dict.fromkeys((match[0], match[1]) for match in by_name.get(fname, ()) \
+                                          if not (match[0] == dir and match[1] == fname) \
+                                          and (match[2], match[3]) != identity))
+
+        if stored or name_matches:
+            pending.append((dir, fname, current, stored, name_matches))
+    return pending
+
+
+def find_name_matches(file_db, filenames, fuzzy=False):
+    """
+    Look up the stored files whose names match any of a batch of file names
+    :param file_db: the FileDatabase object for the connected database containing the file data
+    :    filenames: a set of file names
+    :        fuzzy: if True, the files with similar names are found as well, most alike first
+    :return: a dictionary of file name to a list of (filedir, filename, device, inode) tuples
+    """
+    by_name = dict()
+    if not fuzzy:
+        for match in file_db.iter_files_of_names(filenames):
+            by_name.setdefault(match[1], []).append(match)
+        return by_name
+
+    norm_names = {filename: normalize_name(filename) for filename in filenames}
+    similar = file_db.find_similar_names(norm_names.values())
+    by_norm_name = dict()
+    for match in file_db.iter_files_of_norm_names({other for ranked in similar.values() for other, _ in ranked}):
+        by_norm_name.setdefault(match[2], []).append((match[0], match[1], match[3], match[4]))
+    for filename, norm_name in norm_names.items():
+        by_name[filename] = [match for other, _ in similar.get(norm_name, ()) for match in by_norm_name.get(other, ())]
+    return by_name
+
+
+def confirm_check_batch(pool, pending):
+    """
+    The hashing stage of check's pipeline. Verifies the content of the files of a batch that share a
+    size with stored files on the hash pool.
+    :param pool: the HashPool to run the verification on
+    :   pending: the list returned by check_helper for the batch
+    :return: a list of (pending tuple, confirmed groups) tuples, in the order the files were walked
+    """
+    results = pool.confirm_groups([current] + stored for dir, fname, current, stored, _ in pending if stored)
+    return [(entry, next(results)[1] if entry[3] else []) for entry in pending]
+
+
+def flush_check(file_db, results, state):
+    """
+    This is the check() worker run on the calling thread at the end of the treewalk's pipeline. It
+    saves the hashes calculated for the stored files, and displays the results for each file, in the
+    order the files were walked.
+    :param file_db: the FileDatabase object for the connected database containing the file data
+    :      results: the list returned by confirm_check_batch for a batch
+    :        state: the state dictionary for the check run
+    :return: nothing
+    """
+    from utils.hashing import copies_of
+    output = state['output']
+    for (dir, fname, current, stored, name_matches), groups in results:
+        full_file_name = os.path.join(dir, fname)
+        if stored:
+            # only the hashes of files in the database are saved. The walked file is hashed as it is on
+            # disk, which may no longer match its row.
+            save_hashes(file_db, stored)
+            for group in groups:
+                if current not in group:
+                    continue
+                links = []
+                copies = []
+                for copy in copies_of(group):
+                    if current in copy:
+                        links = [candidate.path for candidate in copy if candidate is not current]
+                    else:
+                        copies.append([candidate.path for candidate in copy])
+                if copies:
+                    matches = sum(len(copy) for copy in copies)
+                    state['tot_matches'] += matches
+                    state['tot_content_matches'] += matches
+                    output.content_group(copies, current.filesize, full_file_name)
+                if links:
+                    state['tot_matches'] += len(links)
+                    state['tot_link_matches'] += len(links)
+                    output.link_group(links, current.filesize, full_file_name)
+
+        if name_matches:
+            state['tot_matches'] += len(name_matches)
+            state['tot_name_matches'] += len(name_matches)
+            output.name_group([os.path.join(match[0], match[1]) for match in name_matches], fname, full_file_name, \
+                              state['names'] == 'fuzzy')
+
+        if stored:
+            release_candidates(state, 'walked', [current])
+            release_candidates(state, 'stored', stored)
+
+
+def get_candidate(state, role, dir, fname, filesize, partial=None, full=None, device=None, inode=None, source=None):
+    """
+    Look up (or create) the Candidate for a file, so any hashes calculated for it are shared by the
+    batches in the pipeline at the same time, and a file that matches many others is only read once.
+    The Candidate for a walked file is kept apart from the one for its row in the database, as the file
+    may have changed since its row, and its stored hashes, were written.
+    :param state: the state dictionary for the run, holding the 'candidates' cache
+    :       role: 'walked' for the file found by the walk, 'stored' for a file from the database
+    :        dir: the directory of the file
+    :      fname: the file name
+    :   filesize: the size of the file
+    :    partial: optional partial hash already stored for the file
+    :       full: optional full hash already stored for the file
+    :     device: optional device the file is on, used to limit the reads in flight per device
+    :      inode: optional inode of the file, which with device tells hard links apart from copies
+    :     source: optional schema of the attached database the file's row came from
+    :return: the Candidate object for the file
+    """
+    key = (role, dir, fname)
+    candidate = state['candidates'].get(key)
+    if candidate is None:
+        from utils.hashing import Candidate
+        candidate = Candidate(dir, fname, filesize, partial, full, device, inode, source)
+        state['candidates'][key] = candidate
+    return candidate
+
+
+def release_candidates(state, role, candidates):
+    """
+    Drop the Candidates of a batch from the cache once the batch has been written, so the cache only
+    ever holds the files of the batches still in the pipeline. A later batch matching the same stored
+    file picks up the hashes saved for it from the database instead.
+    :param state: the state dictionary for the run, holding the 'candidates' cache
+    :       role: 'walked' or 'stored', as given to get_candidate
+    : candidates: the Candidate objects to drop
+    :return: nothing
+    """
+    cache = state['candidates']
+    for candidate in candidates:
+        key = (role, candidate.filedir, candidate.filename)
+        # a later batch may already have put a Candidate of its own for the file back in the cache
+        if cache.get(key) is candidate:
+            del cache[key]
 
 
 def update(parameters):
@@ -166,117 +576,179 @@ def update(parameters):
     :return: nothing   
     """
 
-    if len(parameters) != 2:
+    positional, options = parse_command_options(parameters, UPDATE_OPTIONS, help_update)
+    if positional is None:
+        return
+    if len(positional) != 2:
         help_update()
         return
     try:
-        validate_general_params(parameters)
+        validate_general_params(positional)
     except CommandException as err:
         print(f"\nError: {err}\n")
         return 
 
-    dbfilename = parameters[0]
-    dir_to_walk = normalize_dir_name(parameters[1])
+    dbfilename = positional[0]
+    dir_to_walk = normalize_dir_name(positional[1])
+
+    output = create_output(options)
+    if output is None:
+        return
 
     state = dict()
-    file_db = db.FileDatabase(dbfilename)
+    start_metrics(options)
+    file_db = db.FileDatabase(dbfilename, options.get('commit_rows', db.COMMIT_ROWS), \
+                             options.get('commit_seconds', db.COMMIT_SECONDS))
+
+    # an interrupted run left its state in the database. With --resume it is carried on from there.
+    run = file_db.find_run()
+    resume = options.get('resume', False) and run is not None
+    if resume and run[0] != dir_to_walk:
+        print(f"\nError: the interrupted run in {dbfilename} was of {run[0]}, not {dir_to_walk}.\n")
+        file_db.close()
+        output.close()
+        return
+    if run is not None and not resume:
+        output.message(f"\nStarting over. An interrupted run of {run[0]} can be carried on with --resume.\n")
+
+    totals = []
+    if not (resume and run[1] == 'hashing'):
+        # load the current state of the filesystem into a snapshot, then compare it with the database
+        # all in one go, rather than looking up each file as the walk finds it
+        # with --incremental, directories whose mtime has not changed since the last walk are not listed
+        walk_filter = create_walk_filter(options)
+        known_dirs = start_walk_filter(file_db, dir_to_walk, walk_filter, options.get('incremental', False), output)
+        if METRICS.progress:
+            # what was stored last time gives the progress line an idea of how long the walk will take
+            METRICS.set_stage('walking', file_db.count_files(dir_to_walk))
+        done_dirs = None
+        resumed_files = 0
+        if resume:
+            # the directories the interrupted walk finished are not listed again
+            done_dirs, resumed_files = file_db.resume_snapshot()
+        else:
+            file_db.start_snapshot(dir_to_walk)
+        from utils.pipeline import CancelToken
+        cancel = CancelToken()
+        with cancel_on_signals(cancel):
+            return_state = treewalk_with_action(file_db, dir_to_walk, walk_filter, update_helper, \
+                                                in_state=state, walkers=options.get('walkers', 1), \
+                                                ordered=options.get('ordered', False), \
+                                                dir_worker=update_dir_helper, known_dirs=known_dirs, \
+                                                done_dirs=done_dirs, cancel=cancel)
+        if cancel.cancelled:
+            # what was walked is committed, and the run left in place, for --resume to carry on with
+            file_db.close()
+            output.message(f"\nInterrupted. The walk of {dir_to_walk} can be carried on with --resume.\n")
+            output.close()
+            finish_metrics(options)
+            return
+        unchanged_dirs, unchanged_files = file_db.count_unchanged_in_snapshot()
+
+        if not output.quiet:
+            # remove any files that are in the database, but not in the filesystem
+            for file_dir, file_name in file_db.find_missing_from_snapshot(dir_to_walk):
+                output.status('deleted', os.path.join(file_dir, file_name))
+
+            for file_dir, file_name, filesize, file_db_size, status in file_db.compare_snapshot():
+                output.status(status, os.path.join(file_dir, file_name), filesize, file_db_size)
+
+        deleted, updated, added = file_db.apply_snapshot(dir_to_walk)
+        file_db.set_walk_filter(dir_to_walk, walk_filter.key)
+
+        total = return_state.get('total', 0) + resumed_files + unchanged_files
+        skipped = total - updated - added
+
+        totals.append(('Total files', total))
+        if known_dirs is not None:
+            totals.append(('Unchanged directories', unchanged_dirs))
+        totals += [None, ('Skipped', skipped), ('Added', added), ('Updated', updated), None, ('Deleted', deleted), \
+                   None]
+
+    # then hash the files that share a size with another, so check and report have the hashes ready.
+    # Any hashes an interrupted run had already saved are not calculated again.
+    pool = create_hash_pool(options)
+    duplicates = digest_duplicates(file_db, pool)
+    pool.close()
+    file_db.finish_run()
+
+    totals.append(('Confirmed duplicate groups', duplicates))
+    output.summary(totals)
+    output.close()
+    finish_metrics(options)
+
+
+@contextmanager
+def cancel_on_signals(cancel):
+    """
+    Have ctrl-c, or a kill, cancel a treewalk, so it stops once the batch in hand has been written,
+    rather than part way through writing it. A second one stops the run straight away, as usual.
+    :param cancel: the CancelToken of the treewalk
+    """
+    previous = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    def stop(signum, frame):
+        cancel.cancel()
+        for signum in previous:
+            signal.signal(signum, signal.default_int_handler)
 
-    # first, check existing data in the database
-    # remove any files that are in the database, but not in the filesystem
-    delete_missing_files(file_db, dir_to_walk, state)
-
-    # helper has to do all the individual file work
-    # so it has to do adds and updates
-    return_state = treewalk_with_action(file_db, dir_to_walk, [".DS_Store"], update_helper, in_state=state)
-
-    total = return_state.get('total', 0)
-    skipped = return_state.get('skipped',0)
-    added = return_state.get('added', 0)
-    updated = return_state.get('updated', 0)
-    deleted = return_state.get('deleted', 0)
-
-    print(f"\nTotal files: {total:,}")
-    print(f"\nSkipped: {skipped:,}")
-    print(f"Added: {added:,}")
-    print(f"Updated: {updated:,}")
-    print(f"\nDeleted: {deleted:,}\n")
-
-
-def delete_missing_files(file_db, dir_to_walk, state):
-    """
-    This function will take a file database and a starting directory, and will walk through the files in
-    the database for that directory and all sub directories, and remove any files that no longer exist.
-    :param file_db: the file database to use as the source
-    :  dir_to_walk: the starting path, top level, to start checking if the files exist
-    :        state: a dictionary that can be used to store state info and return data
-    """
-
-    # first walk the files in the specified directory
-    # this is necessary due to the way the data is stored (without trailing os.sep)
-    files_in_db = file_db.find_files_in_dir(dir_to_walk)
-    for file in files_in_db:
-        file_dir = file[0]
-        file_name = file[1]
-        full_file = os.path.join(file_dir, file_name)
-        if not os.path.isfile(full_file):
-            # remove from database
-            file_db.delete(file_dir, file_name)
-            state['deleted'] = state.get('deleted',0) + 1
-            print(f"DELETED: {full_file}")
-
-    # then walk through any and all sub directories under the given path
-    files_in_db = file_db.find_files_below_dir(dir_to_walk)
-
-    for file in files_in_db:
-        file_dir = file[0]
-        file_name = file[1]
-        full_file = os.path.join(file_dir, file_name)
-        if not os.path.isfile(full_file):
-            # remove from database
-            file_db.delete(file_dir, file_name)
-            state['deleted'] = state.get('deleted',0) + 1
-            print(f"DELETED: {full_file}")
-
-
-def update_helper(file_db, dir, fname, filesize, state):
+    for signum in previous:
+        signal.signal(signum, stop)
+    try:
+        yield cancel
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def start_walk_filter(file_db, root, walk_filter, incremental, output):
+    """
+    Get ready to record the directory states of a walk. If the last walk skipped different files or
+    directories, the stored states are missing anything it skipped that this one will not, so they are
+    not used, and are marked as being replaced until this walk is done, in case it is interrupted.
+    :param file_db: the FileDatabase object for the connected database containing the file data
+    :         root: the top of the tree about to be walked
+    :  walk_filter: the WalkFilter it is about to be walked with
+    :  incremental: True if the directories that have not changed are not to be listed
+    :       output: the Output to say so on, if the stored states can not be used
+    :return: the directory states load_dir_states returns, for the walk's known_dirs, or None to list
+    :      : every directory
+    """
+    if file_db.walk_filter_matches(root, walk_filter.key):
+        return file_db.load_dir_states(root) if incremental else None
+    if incremental:
+        output.message("\nThe --exclude or --prune options have changed since the last walk, so every directory is listed.\n")
+    file_db.set_walk_filter(root, '')
+    return None
+
+
+def update_helper(file_db, records, state):
     """
     This is the update() helper function that is executed inside the treewalk_with_action
-    It performs all the checks and actions necessary for the update function, during the treewalk
-    This means looking for files to delete, add, and update or skip
+    It records each batch of files found in the snapshot the database is then compared against, so
+    the adds, updates and deletes can all be worked out in bulk once the walk is done.
     :param file_db: the FileDatabase object for the connected database containing the file data
-    :          dir: the directory the treewalk is currently in
-    ;        fname: the specific file the treewalk is currently at
-    :     filesize: the current (e.g. up-to-date) size of the file
+    :      records: the batch of FileRecords the treewalk has found
     ;        state: a dictionary that can be used to store state info needed through the entire
     :             : treewalk run
-    :return: Nothing. All results are either output via print, or stored in the state dictionary
+    :return: Nothing. All results are stored in the snapshot, or in the state dictionary
     """
-    state['total'] = state.get('total',0) + 1
-    full_fname = os.path.join(dir, fname)
-
-    # add or update the file we are on right now
-    result = file_db.find_specific_file(dir, fname)
-    if not result:
-        # add
-        file_db.insert(dir, fname, filesize)
-        state['added'] = state.get('added',0) + 1
-        print(f"Added: {full_fname}")
-        return
+    state['total'] = state.get('total',0) + len(records)
+    file_db.add_to_snapshot(records)
 
-    # is update required?
-    file_db_info = result[0]
-    file_db_size = file_db_info[2]
 
-    if file_db_size == filesize:
-        #no update required
-        state['skipped'] = state.get('skipped',0) + 1
-        print(f"skipped: {full_fname}")
-        return
-    
-    # update required
-    file_db.update(dir, fname, filesize)
-    state['updated'] = state.get('updated',0) + 1
-    print(f"Updated: {full_fname}  old size = {file_db_size} new size = {filesize}")
+def update_dir_helper(file_db, listing, state):
+    """
+    This is the update() helper function that is executed for every directory the treewalk visits.
+    It records the directory in the snapshot, so its mtime can be stored for the next incremental
+    update, and so the files of a directory skipped as unchanged are not taken as deleted.
+    :param file_db: the FileDatabase object for the connected database containing the file data
+    :      listing: the DirListing of the directory
+    ;        state: a dictionary that can be used to store state info needed through the entire
+    :             : treewalk run
+    :return: Nothing
+    """
+    file_db.add_dir_to_snapshot(listing.path, listing.mtime, listing.file_count, listing.unchanged, listing.subdirs)
 
 
 def report(parameters):
@@ -287,12 +759,16 @@ def report(parameters):
     :                : sripped, leaving only the parameters for the command itself.
     :return: nothing   
     """
-    if len(parameters) == 0:
+    from utils import snapshot
+    positional, options = parse_command_options(parameters, REPORT_OPTIONS, help_report)
+    if positional is None:
+        return
+    if len(positional) == 0 or len(positional) > 2:
         help_report()
         return
-    if len(parameters) > 1:
+    if len(positional) > 1:
         try:
-            min_size = int(parameters[1])
+            min_size = int(positional[1])
             min_size *= 1000
         except ValueError as err:
             print(f"Error: minimum size parameter: {err}")
@@ -300,11 +776,329 @@ def report(parameters):
     else:
         min_size = None
     
-    dbfilename = parameters[0]
+    dbfilename = positional[0]
     if not is_file(dbfilename):
         print(f"\nError: file {dbfilename} is not a file, does not exist, or is not accessible.\n")
         return
+    if snapshot.is_snapshot(dbfilename):
+        report_snapshot(dbfilename, min_size, options)
+        return
     
     file_db = db.FileDatabase(dbfilename)
+    try:
+        attach_databases(file_db, options.get('attach', ()))
+    except CommandException as err:
+        print(f"\nError: {err}\n")
+        file_db.close()
+        return
+    output = create_output(options)
+    if output is None:
+        file_db.close()
+        return
+
+    start_metrics(options)
+    report_matches(file_db, min_size, options, output)
+
+
+def compare(parameters):
+    """
+    Generate a report on the duplicates between two databases, e.g. of two storage volumes, without
+    walking either tree. Only the groups that have files in both databases are reported.
+    :param parameters: a list of the parameters passed in to this command from the command line.
+    :                : the utiility (argv[0]) and the command itself (argv[1]) have already been
+    :                : sripped, leaving only the parameters for the command itself.
+    :return: nothing
+    """
+    positional, options = parse_command_options(parameters, POOL_OPTIONS, help_compare)
+    if positional is None:
+        return
+    if len(positional) < 2 or len(positional) > 3:
+        help_compare()
+        return
+    if len(positional) > 2:
+        try:
+            min_size = int(positional[2])
+            min_size *= 1000
+        except ValueError as err:
+            print(f"Error: minimum size parameter: {err}")
+            return
+    else:
+        min_size = None
+
+    for dbfilename in positional[:2]:
+        if not is_file(dbfilename):
+            print(f"\nError: file {dbfilename} is not a file, does not exist, or is not accessible.\n")
+            return
+
+    output = create_output(options)
+    if output is None:
+        return
+    file_db = db.FileDatabase(positional[0])
+    try:
+        attach_databases(file_db, positional[1:2])
+    except CommandException as err:
+        print(f"\nError: {err}\n")
+        file_db.close()
+        output.close()
+        return
+
+    start_metrics(options)
+    report_matches(file_db, min_size, options, output, cross=True)
+
+
+def report_matches(file_db, min_size, options, output, cross=False):
+    """
+    Write the report of the duplicates in the database, and any attached to it, followed by the
+    totals, for report and compare
+    :param file_db: the FileDatabase object, with any other databases already attached
+    :     min_size: optional cutoff in bytes, as for print_matches
+    :      options: the options dictionary returned by parse_options
+    :       output: the Output to write the report to. It is closed once done.
+    :        cross: if True, only groups with files from more than one database are reported
+    :return: nothing
+    """
+    content_groups, reclaimable, link_groups, name_groups = print_matches(file_db, min_size, \
+                                                                         create_hash_pool(options), output, cross, \
+                                                                         options.get('names', 'exact'))
+    file_db.close()
+    output.summary([('Confirmed duplicate groups', content_groups), ('Reclaimable bytes', reclaimable),
+                    ('Hard link groups', link_groups), ('Possible name match groups', name_groups)])
+    output.close()
+    finish_metrics(options)
+
+
+def watch(parameters):
+    """
+    Keep the database up to date with a directory tree as it changes, until interrupted. The tree is
+    brought up to date once at the start, then the changes the file system reports are gathered into
+    batches, and each batch is applied by looking at only the files and directories it names, rather
+    than walking the whole tree again. The files of each batch that share a size with another file
+    are hashed straight away, and with --alert, any that turn out to be duplicates are reported.
+    :param parameters: a list of the parameters passed in to this command from the command line.
+    :                : the utiility (argv[0]) and the command itself (argv[1]) have already been
+    :                : sripped, leaving only the parameters for the command itself.
+    :return: nothing
+    """
+    from utils.watch import ChangeApplier, Changes, create_backend, watch_changes, DEBOUNCE_SECONDS, \
+                            MAX_DELAY_SECONDS, POLL_SECONDS
+    positional, options = parse_command_options(parameters, WATCH_OPTIONS, help_watch)
+    if positional is None:
+        return
+    if len(positional) != 2:
+        help_watch()
+        return
+    try:
+        validate_general_params(positional)
+    except CommandException as err:
+        print(f"\nError: {err}\n")
+        return
+
+    dbfilename = positional[0]
+    dir_to_watch = normalize_dir_name(positional[1])
+    walk_filter = create_walk_filter(options)
+
+    output = create_output(options)
+    if output is None:
+        return
+
+    # watching starts before the first sync, so nothing that changes during it is missed
+    try:
+        backend = create_backend(options.get('backend', 'auto'), dir_to_watch, walk_filter, \
+                                 options.get('poll_seconds', POLL_SECONDS))
+        backend.start()
+    except OSError as err:
+        print(f"\nError: {err.strerror}\n")
+        output.close()
+        return
+
+    start_metrics(options)
+    file_db = db.FileDatabase(dbfilename, options.get('commit_rows', db.COMMIT_ROWS), \
+                             options.get('commit_seconds', db.COMMIT_SECONDS))
+    pool = create_hash_pool(options)
+    applier = ChangeApplier(file_db, walk_filter, output)
+    alerts = 0
+    batches = 0
+
+    # a kill stops the watch as cleanly as ctrl-c does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    output.message(f"\nWatching {dir_to_watch} for changes ({backend.name}). Press ctrl-c to stop.\n")
+    try:
+        changes = Changes()
+        changes.add_tree(dir_to_watch)
+        known_dirs = start_walk_filter(file_db, dir_to_watch, walk_filter, options.get('incremental', False), output)
+        alerts += watch_batch(file_db, applier, changes, pool, output, options.get('alert', False), known_dirs)
+        file_db.set_walk_filter(dir_to_watch, walk_filter.key)
+        for changes in watch_changes(backend, options.get('debounce', DEBOUNCE_SECONDS), MAX_DELAY_SECONDS):
+            batches += 1
+            alerts += watch_batch(file_db, applier, changes, pool, output, options.get('alert', False))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.close()
+        pool.close()
+        file_db.close()
+
+    output.summary([('Batches', batches), ('Added', applier.totals['added']), ('Updated', applier.totals['updated']),
+                    ('Deleted', applier.totals['deleted']), ('Duplicate alerts', alerts)])
+    output.close()
+    finish_metrics(options)
+
+
+def watch_batch(file_db, applier, changes, pool, output, alert=False, known_dirs=None):
+    """
+    Apply one batch of changes to the database, then hash the changed files that share a size with
+    any other file, so check and report have their hashes ready
+    :param file_db: the FileDatabase object for the connected database containing the file data
+    :      applier: the ChangeApplier for the watch
+    :      changes: the Changes of the batch
+    :         pool: the HashPool to run the verification on
+    :       output: the Output to write the results to
+    :        alert: if True, the duplicate groups the changed files are in are reported
+    :   known_dirs: optional dictionary of stored directory states, to skip unchanged directories
+    :return: the number of duplicate groups reported
+    """
+    from utils.hashing import copies_of
+    records = applier.apply(changes, known_dirs)
+    if not records:
+        output.flush()
+        return 0
+
+    alerts = 0
+    changed = {(record.filedir, record.filename) for record in records}
+    rows = sorted(file_db.find_files_of_sizes({record.filesize for record in records}), key=itemgetter(2))
+    for candidates, groups in pool.confirm_groups(size_group_candidates(rows)):
+        save_hashes(file_db, candidates)
+        if not alert:
+            continue
+        for group in groups:
+            copies = copies_of(group)
+            if len(copies) > 1 and any((candidate.filedir, candidate.filename) in changed for candidate in group):
+                output.content_group([[candidate.path for candidate in copy] for copy in copies], group[0].filesize)
+                alerts += 1
+    file_db.commit()
+    output.flush()
+    return alerts
+
+
+def report_snapshot(filename, min_size, options):
+    """
+    Write the report of the duplicates by content in a snapshot written by export, straight from the
+    memory mapped file, without loading it into a database. Files of the same size are confirmed by
+    the hashes stored in the snapshot, and any without one are read, if they can be. Hashes calculated
+    are not saved anywhere.
+    :param filename: the snapshot file
+    :      min_size: optional cutoff in bytes, as for print_matches
+    :       options: the options dictionary returned by parse_options
+    :return: nothing
+    """
+    from utils import snapshot
+    if options.get('attach') or options.get('names'):
+        print("\nError: --attach and --names need a database, not a snapshot.\n")
+        return
+    output = create_output(options)
+    if output is None:
+        return
+    try:
+        snap = snapshot.Snapshot(filename)
+    except snapshot.SnapshotError as err:
+        print(f"\nError: {err}\n")
+        output.close()
+        return
+
+    start_metrics(options)
+    with snap:
+        groups = snapshot.size_groups(snap, min_size)
+        content_groups, reclaimable, link_groups = print_content_matches(snapshot.size_group_candidates(snap, groups), \
+                                                                         min_size, create_hash_pool(options), output)
+    output.summary([('Confirmed duplicate groups', content_groups), ('Reclaimable bytes', reclaimable),
+                    ('Hard link groups', link_groups)])
+    output.close()
+    finish_metrics(options)
+
+
+def export_db(parameters):
+    """
+    Write everything in the database to a compact snapshot file, that import can rebuild a database
+    from, and report can read directly
+    :param parameters: a list of the parameters passed in to this command from the command line.
+    :                : the utiility (argv[0]) and the command itself (argv[1]) have already been
+    :                : sripped, leaving only the parameters for the command itself.
+    :return: nothing
+    """
+    from utils import snapshot
+    positional, options = parse_command_options(parameters, OUTPUT_OPTIONS, help_export)
+    if positional is None:
+        return
+    if len(positional) != 2:
+        help_export()
+        return
+
+    dbfilename, snapshot_filename = positional
+    if not is_file(dbfilename):
+        print(f"\nError: file {dbfilename} is not a file, does not exist, or is not accessible.\n")
+        return
+
+    output = create_output(options)
+    if output is None:
+        return
+
+    start_metrics(options)
+    file_db = db.FileDatabase(dbfilename)
+    try:
+        dirs, files, size = snapshot.export_snapshot(file_db, snapshot_filename)
+    except OSError as err:
+        print(f"\nError: {snapshot_filename}: {err.strerror}\n")
+        output.close()
+        return
+    finally:
+        file_db.close()
+
+    output.summary([('Directories', dirs), ('Files', files), ('Snapshot bytes', size)])
+    output.close()
+    finish_metrics(options)
+
+
+def import_db(parameters):
+    """
+    Create a database file from a snapshot written by export, without walking the tree again
+    :param parameters: a list of the parameters passed in to this command from the command line.
+    :                : the utiility (argv[0]) and the command itself (argv[1]) have already been
+    :                : sripped, leaving only the parameters for the command itself.
+    :return: nothing
+    """
+    from utils import snapshot
+    positional, options = parse_command_options(parameters, OUTPUT_OPTIONS, help_import)
+    if positional is None:
+        return
+    if len(positional) != 2:
+        help_import()
+        return
+
+    snapshot_filename, dbfilename = positional
+    if is_file(dbfilename):
+        print(f"\nError: file {dbfilename} already exists. Will not create database file on top of it.\n")
+        return
+    try:
+        snap = snapshot.Snapshot(snapshot_filename)
+    except OSError as err:
+        print(f"\nError: {snapshot_filename}: {err.strerror}\n")
+        return
+    except snapshot.SnapshotError as err:
+        print(f"\nError: {err}\n")
+        return
+
+    output = create_output(options)
+    if output is None:
+        snap.close()
+        return
+
+    start_metrics(options)
+    with snap:
+        file_db = db.FileDatabase(dbfilename)
+        file_db.cleanup()
+        dirs, files = snapshot.import_snapshot(snap, file_db)
+        file_db.close()
 
-    print_matches(file_db, min_size)
+    output.summary([('Directories', dirs), ('Files', files)])
+    output.close()
+    finish_metrics(options)
@@ -1,44 +1,67 @@
 #!/usr/local/bin/python3
 
-import os
+import importlib
 import sys
 
-from utils import db
-
-import utils.functions
 from utils.help import usage
-from commands import create, check, report, update
 
+# the module and function that run each command. Nothing is imported until a command is run, so
+# printing the usage, or running a quick command, does not pay for loading every other one.
 COMMANDS = {
-	'create': create,
-	'check': check,
-	'report': report,
-	'update': update
+	'create': ('commands', 'create'),
+	'check': ('commands', 'check'),
+	'report': ('commands', 'report'),
+	'update': ('commands', 'update'),
+	'compare': ('commands', 'compare'),
+	'watch': ('commands', 'watch'),
+	'export': ('commands', 'export_db'),
+	'import': ('commands', 'import_db')
 }
 
 def resolve_command(cmd):
 	try:
-		return COMMANDS[cmd]
+		module, function = COMMANDS[cmd]
 	except KeyError:
 		return None
+	return getattr(importlib.import_module(module), function)
+
+
+def split_profile_options(parameters):
+	# the profiling module is only imported when it is asked for
+	if not any(param.startswith('--profile') for param in parameters):
+		return parameters, None, None
+	from utils.profiling import split_profile_options
+	return split_profile_options(parameters)
 
 
 
 def main():
 
-	if len(sys.argv) < 2:
+	try:
+		parameters, profile, profile_output = split_profile_options(sys.argv[1:])
+	except ValueError as err:
+		print(f"\nError: {err}\n")
+		sys.exit(2)
+
+	if len(parameters) < 1:
 		usage()
 		sys.exit(1)
-	
-	command = sys.argv[1]
-	parameters = sys.argv[2:]
 
-	command_handler = resolve_command(command)
-	if command_handler is None:
+	command = parameters[0]
+	parameters = parameters[1:]
+
+	if command not in COMMANDS:
 		print(f"\nInvalid command: '{command}'\n")
 		usage()
 		sys.exit(2)
-		
-	command_handler(parameters)
+
+	if profile is None:
+		command_handler = resolve_command(command)
+		command_handler(parameters)
+		return
+
+	# the import of the command's modules is profiled, along with the command itself
+	from utils.profiling import run_profiled
+	run_profiled(lambda: resolve_command(command)(parameters), profile, profile_output)
 
 main()
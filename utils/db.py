@@ -2,73 +2,914 @@
 
 import os
 import sqlite3
+import time
+
+from utils.metrics import METRICS, timed
+from utils.names import SIMILARITY, MAX_SIMILAR, MAX_NAME_LENGTH, normalize_name, name_grams, min_shared, similarity
+
+# bumped whenever the layout of the files table changes. Stored in the database as PRAGMA user_version
+SCHEMA_VERSION = 7
+
+# writes are buffered and sent to SQLite as executemany batches of (up to) this many rows
+BATCH_SIZE = 1000
+
+# number of rows fetched from SQLite at a time by the iterating queries
+FETCH_SIZE = 1000
+
+# buffered writes are committed once this many rows, or this many seconds, have built up since the
+# last commit, whichever comes first
+COMMIT_ROWS = 50000
+COMMIT_SECONDS = 5.0
+
+# connection settings. WAL lets readers carry on while a writer commits, and with WAL a synchronous
+# level of NORMAL can only lose the last commits on a power failure, never corrupt the database
+PRAGMAS = (
+	'journal_mode = WAL',
+	'synchronous = NORMAL',
+	'cache_size = -65536',
+	'mmap_size = 268435456'
+)
+
+
+# subquery for the ids of a directory and every directory below it, found by following the parent_id
+# chain down from the directory's path
+SUBTREE = '''(WITH RECURSIVE subtree(id) AS (SELECT id FROM dirs WHERE path = ?
+	UNION ALL SELECT d.id FROM dirs d JOIN subtree s ON d.parent_id = s.id) SELECT id FROM subtree)'''
+
+
+def fetch_rows(cursor, size=FETCH_SIZE):
+	"""
+	Generator over the rows of a query, fetched size rows at a time. The cursor is closed once the rows
+	run out, or the generator is dropped.
+	"""
+	try:
+		rows = cursor.fetchmany(size)
+		while rows:
+			yield from rows
+			rows = cursor.fetchmany(size)
+	finally:
+		try:
+			cursor.close()
+		except sqlite3.ProgrammingError:
+			# the database was closed before the rows were all read
+			pass
 
 
 class FileDatabase:
 	
-	def __init__(self, filename):
+	def __init__(self, filename, commit_rows=COMMIT_ROWS, commit_seconds=COMMIT_SECONDS):
 		self.connection = sqlite3.connect(filename)
+		# used to fill in norm_name as rows are written in bulk
+		self.connection.create_function('normalize_name', 1, normalize_name)
 		self.cursor = self.connection.cursor()
+		for pragma in PRAGMAS:
+			self.cursor.execute(f'''PRAGMA {pragma}''')
+
+		# the write buffer. A list of [sql, rows] batches kept in the order they were queued, plus the
+		# (filedir, filename) keys of every row in it, so a lookup only has to flush when it needs to
+		self.commit_rows = commit_rows
+		self.commit_seconds = commit_seconds
+		self.pending = []
+		self.pending_rows = 0
+		self.pending_keys = set()
+		self.uncommitted = 0
+		self.last_commit = time.monotonic()
+		self.closed = False
+
+		# cache of directory path to dirs table id
+		self.dir_ids = dict()
+		self.snapshot_indexed = False
+
+		# the schemas searched for duplicates. Other databases can be attached alongside this one, in
+		# which case the searches go through temp views over all of them, with a source column naming
+		# the schema each row came from
+		self.sources = ['main']
+		self.paths_table = 'file_paths'
+		self.files_table = 'files'
+		self.source_column = "'main'"
+
+		self.upgrade()
+
+	def queue(self, sql, vals, key):
+		"""
+		Add a write to the buffer. Consecutive writes using the same statement are grouped into a single
+		executemany call when the buffer is flushed.
+		:param sql: the statement to run
+		:     vals: the parameters for this one row
+		:      key: the (filedir, filename) of the files table row the write affects, or None if it
+		:         : does not write to the files table
+		"""
+		if self.pending and self.pending[-1][0] == sql:
+			self.pending[-1][1].append(vals)
+		else:
+			self.pending.append([sql, [vals]])
+		self.pending_rows += 1
+		if key is not None:
+			self.pending_keys.add(key)
+
+		if self.pending_rows >= BATCH_SIZE:
+			self.flush()
+		# rows still in the buffer count toward the commit, so commit_rows below BATCH_SIZE is honoured
+		if self.uncommitted + self.pending_rows >= self.commit_rows or \
+				time.monotonic() - self.last_commit >= self.commit_seconds:
+			self.commit()
+
+	def queue_many(self, sql, rows):
+		"""
+		Add a whole batch of writes, that do not touch the files table, to the buffer
+		:param sql: the statement to run
+		:     rows: list of the parameters for each row
+		"""
+		self.pending.append([sql, list(rows)])
+		self.pending_rows += len(rows)
+		if self.pending_rows >= BATCH_SIZE:
+			self.flush()
+		if self.uncommitted + self.pending_rows >= self.commit_rows or \
+				time.monotonic() - self.last_commit >= self.commit_seconds:
+			self.commit()
+
+	@timed('sql', count=False)
+	def flush(self):
+		"""
+		Send every buffered write to SQLite, in the order they were queued. They are not committed yet.
+		"""
+		for sql, rows in self.pending:
+			self.cursor.executemany(sql, rows)
+		METRICS.add_db_ops(self.pending_rows)
+		self.uncommitted += self.pending_rows
+		self.pending = []
+		self.pending_rows = 0
+		self.pending_keys = set()
+
+	@timed('sql')
+	def commit(self):
+		"""
+		Flush and commit the buffered writes, so they survive the run being interrupted
+		"""
+		self.flush()
+		self.connection.commit()
+		self.uncommitted = 0
+		self.last_commit = time.monotonic()
+
+	def close(self):
+		if self.closed:
+			return
+		self.commit()
+		self.connection.close()
+		self.closed = True
+
+	@timed('sql')
+	def upgrade(self):
+		"""
+		Bring a database created by an older version of this utility up to the current schema, in place.
+		A brand new (empty) database is left alone, as cleanup() will build it from scratch.
+		"""
+		self.cursor.execute('''SELECT name FROM sqlite_master WHERE type=? AND name=?''', ('table', 'files'))
+		if not self.cursor.fetchall():
+			return
+		self.cursor.execute('''PRAGMA user_version''')
+		version = self.cursor.fetchone()[0]
+		if version < 1:
+			# version 1 adds the stat info used to detect changes, and the content hashes
+			for column in ('mtime', 'inode', 'device', 'partial_hash', 'full_hash'):
+				self.cursor.execute(f'''ALTER TABLE files ADD COLUMN {column}''')
+		if version < 2:
+			# version 2 makes (filedir, filename) a unique key. Older databases could hold the same file
+			# more than once, so only the most recently written row of each is kept.
+			self.cursor.execute('''DELETE FROM files WHERE rowid NOT IN
+				(SELECT max(rowid) FROM files GROUP BY filedir, filename)''')
+			self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS filekey on files(filedir, filename)''')
+		if version < 3:
+			# version 3 moves the directory paths out into the dirs table
+			self.upgrade_dirs()
+		else:
+			if version < 4:
+				# version 4 records the mtime and file count of each directory, as of the last walk
+				self.cursor.execute('''ALTER TABLE dirs ADD COLUMN mtime''')
+				self.cursor.execute('''ALTER TABLE dirs ADD COLUMN file_count''')
+			if version < 5:
+				# version 5 records the state of a run in progress, so an interrupted one can be resumed
+				self.cursor.execute('''CREATE TABLE run_state (id INTEGER PRIMARY KEY, root TEXT, stage TEXT)''')
+			if version < 6:
+				# version 6 adds the normalized file names, and the trigram index over them
+				self.cursor.execute('''ALTER TABLE files ADD COLUMN norm_name''')
+				self.cursor.execute('''UPDATE files SET norm_name = normalize_name(filename)''')
+				self.cursor.execute('''DROP VIEW file_paths''')
+				self.build_file_paths()
+				self.build_names()
+			if version < 7:
+				# version 7 records the files and directories each walk skipped
+				self.cursor.execute('''CREATE TABLE walk_filters (root TEXT PRIMARY KEY, filter TEXT)''')
+		if version < SCHEMA_VERSION:
+			self.cursor.execute(f'''PRAGMA user_version = {SCHEMA_VERSION}''')
+			self.connection.commit()
+			if version < 3:
+				# give back the space the repeated directory strings used to take up
+				self.cursor.execute('''VACUUM''')
+
+	def upgrade_dirs(self):
+		"""
+		Rebuild a version 2 files table, that holds the full directory path on every row, into the dirs
+		table and a files table that refers to it by dir_id
+		"""
+		self.cursor.execute('''DROP INDEX IF EXISTS filename''')
+		self.cursor.execute('''DROP INDEX IF EXISTS filesize''')
+		self.cursor.execute('''DROP INDEX IF EXISTS filekey''')
+		self.cursor.execute('''ALTER TABLE files RENAME TO old_files''')
+		self.build_db()
+
+		for row in self.connection.execute('''SELECT DISTINCT filedir FROM old_files''').fetchall():
+			self.dir_id(row[0])
+		self.cursor.execute('''INSERT INTO files (dir_id, filename, filesize, mtime, inode, device, partial_hash, full_hash,
+				norm_name)
+			SELECT d.id, o.filename, o.filesize, o.mtime, o.inode, o.device, o.partial_hash, o.full_hash,
+				normalize_name(o.filename)
+			FROM old_files o JOIN dirs d ON d.path = o.filedir''')
+		self.cursor.execute('''DROP TABLE old_files''')
 		
+	@timed('sql')
 	def cleanup(self):
+		self.commit()
+		self.cursor.execute('''DROP VIEW IF EXISTS file_paths''')
 		self.cursor.execute('''DROP TABLE IF EXISTS files''')
+		self.cursor.execute('''DROP TABLE IF EXISTS dirs''')
 		self.cursor.execute('''DROP INDEX IF EXISTS filename''')
 		self.cursor.execute('''DROP INDEX IF EXISTS filesize''')
+		self.cursor.execute('''DROP INDEX IF EXISTS filekey''')
+		self.cursor.execute('''DROP INDEX IF EXISTS dirparent''')
+		self.cursor.execute('''DROP TABLE IF EXISTS run_state''')
+		self.cursor.execute('''DROP TABLE IF EXISTS walk''')
+		self.cursor.execute('''DROP TABLE IF EXISTS walk_dirs''')
+		self.cursor.execute('''DROP TABLE IF EXISTS names''')
+		self.cursor.execute('''DROP TABLE IF EXISTS name_grams''')
+		self.cursor.execute('''DROP TABLE IF EXISTS gram_positions''')
+		self.cursor.execute('''DROP TABLE IF EXISTS walk_filters''')
+		self.dir_ids = dict()
 		self.build_db()
 		
 	def build_db(self):
-		self.cursor.execute('''CREATE TABLE files (filedir, filename, filesize) ''')
+		# every directory holding files (and every directory above those) is stored once, in dirs
+		# along with the mtime and number of files of each directory, as of the last walk that listed it
+		self.cursor.execute('''CREATE TABLE dirs (id INTEGER PRIMARY KEY, parent_id INTEGER, path TEXT UNIQUE, mtime, file_count)''')
+		self.cursor.execute('''CREATE INDEX dirparent on dirs(parent_id)''')
+		self.cursor.execute('''CREATE TABLE files (dir_id INTEGER, filename, filesize, mtime, inode, device, partial_hash, full_hash,
+			norm_name) ''')
 		self.cursor.execute('''CREATE INDEX filename on files(filename)''')
 		self.cursor.execute('''CREATE INDEX filesize on files(filesize)''')
-	
+		# the key every point lookup filters on
+		self.cursor.execute('''CREATE UNIQUE INDEX filekey on files(dir_id, filename)''')
+		self.build_file_paths()
+		# the run in progress, if any: the directory it is walking, and the stage it has got to
+		self.cursor.execute('''CREATE TABLE run_state (id INTEGER PRIMARY KEY, root TEXT, stage TEXT)''')
+		# the filter of the walk that last recorded the directory states at and below each root
+		self.cursor.execute('''CREATE TABLE walk_filters (root TEXT PRIMARY KEY, filter TEXT)''')
+		self.build_names()
+		self.cursor.execute(f'''PRAGMA user_version = {SCHEMA_VERSION}''')
+
+	def build_file_paths(self):
+		# the files with their full directory path, for the queries that report on them
+		self.cursor.execute('''CREATE VIEW file_paths AS SELECT d.path AS filedir, f.filename, f.filesize, f.mtime,
+			f.inode, f.device, f.partial_hash, f.full_hash, f.dir_id, f.norm_name FROM files f JOIN dirs d ON d.id = f.dir_id''')
+
+	def build_names(self):
+		"""
+		Build the index of similar file names over the norm_name column of files: the names table holds
+		each normalized name and the number of files that have it, and name_grams the trigrams of each
+		of those names. Triggers keep both up to date as files are added and deleted. They are plain
+		SQL, so files can still be changed from any other SQLite tool.
+		"""
+		self.cursor.execute('''CREATE INDEX norm_name on files(norm_name)''')
+		self.cursor.execute('''CREATE TABLE names (norm_name TEXT PRIMARY KEY, files INTEGER) WITHOUT ROWID''')
+		self.cursor.execute('''CREATE TABLE name_grams (gram TEXT, norm_name TEXT, PRIMARY KEY (gram, norm_name)) WITHOUT ROWID''')
+		# the positions a name's trigrams start at, as a trigger can not use a recursive query to count
+		self.cursor.execute('''CREATE TABLE gram_positions (i INTEGER PRIMARY KEY)''')
+		self.cursor.executemany('''INSERT INTO gram_positions (i) VALUES (?)''', ((i,) for i in range(1, MAX_NAME_LENGTH + 1)))
+
+		# the trigrams are of the stem, after the extension and its '/', padded with a space either side,
+		# as name_grams() works them out
+		stem = '''substr({row}.norm_name, instr({row}.norm_name, '/') + 1)'''
+		grams = f'''SELECT substr(' ' || s.stem || ' ', p.i, 3) AS gram FROM (SELECT {stem} AS stem) s
+			JOIN gram_positions p ON p.i <= length(s.stem)'''
+		self.cursor.execute(f'''CREATE TRIGGER name_added AFTER INSERT ON names BEGIN
+			INSERT OR IGNORE INTO name_grams (gram, norm_name) SELECT gram, NEW.norm_name FROM ({grams.format(row='NEW')});
+			END''')
+		self.cursor.execute(f'''CREATE TRIGGER name_removed AFTER DELETE ON names BEGIN
+			DELETE FROM name_grams WHERE norm_name = OLD.norm_name AND gram IN ({grams.format(row='OLD')});
+			END''')
+		self.cursor.execute('''INSERT INTO names (norm_name, files)
+			SELECT norm_name, count(*) FROM files WHERE norm_name IS NOT NULL GROUP BY norm_name''')
+
+		self.cursor.execute('''CREATE TRIGGER file_added AFTER INSERT ON files WHEN NEW.norm_name IS NOT NULL BEGIN
+			INSERT INTO names (norm_name, files) VALUES (NEW.norm_name, 1)
+				ON CONFLICT (norm_name) DO UPDATE SET files = files + 1;
+			END''')
+		self.cursor.execute('''CREATE TRIGGER file_removed AFTER DELETE ON files WHEN OLD.norm_name IS NOT NULL BEGIN
+			UPDATE names SET files = files - 1 WHERE norm_name = OLD.norm_name;
+			DELETE FROM names WHERE norm_name = OLD.norm_name AND files <= 0;
+			END''')
+
+	def dir_id(self, path, create=True):
+		"""
+		Look up the id of a directory in the dirs table, adding it (and any directories above it that are
+		missing) if need be. Ids are cached, as a walk looks up the same few directories over and over.
+		:param path: the full, normalized path of the directory
+		:    create: if False, returns None for a directory that is not in the table rather than adding it
+		:return: the id of the directory
+		"""
+		id = self.dir_ids.get(path)
+		if id is not None:
+			return id
+		return self._find_dir_id(path, create)
+
+	@timed('sql')
+	def _find_dir_id(self, path, create):
+		# the lookup for a directory that is not cached, kept apart so a cache hit is not timed or counted
+		self.cursor.execute('''SELECT id FROM dirs WHERE path=?''', (path,))
+		row = self.cursor.fetchone()
+		if row:
+			id = row[0]
+		elif not create:
+			return None
+		else:
+			parent = os.path.dirname(path)
+			parent_id = self.dir_id(parent) if parent != path else None
+			self.cursor.execute('''INSERT INTO dirs (parent_id, path) VALUES (?, ?)''', (parent_id, path))
+			id = self.cursor.lastrowid
+		self.dir_ids[path] = id
+		return id
+
 	def delete(self, filedir, filename):
 		val = (filedir, filename)
-		self.cursor.execute('''DELETE FROM files WHERE filedir=? and filename=?''', val)
+		self.queue('''DELETE FROM files WHERE dir_id=(SELECT id FROM dirs WHERE path=?) and filename=?''', val, val)
 
-	def insert(self, filedir, filename, filesize):
-		vals = (f"{filedir}", f"{filename}", filesize)
-		self.cursor.execute('''INSERT INTO files VALUES (?, ?, ?)''', vals)
+	def insert(self, filedir, filename, filesize, mtime=None, inode=None, device=None):
+		vals = (self.dir_id(filedir), f"{filename}", filesize, mtime, inode, device, normalize_name(filename))
+		self.queue('''INSERT INTO files (dir_id, filename, filesize, mtime, inode, device, norm_name) VALUES (?, ?, ?, ?, ?, ?, ?)''', vals, (filedir, filename))
 		
+	@timed('sql')
+	def iter_query(self, sql, vals=()):
+		"""
+		Run a query on a cursor of its own, and hand back the rows FETCH_SIZE at a time as they are
+		iterated over, so memory use stays flat however many rows there are. As the cursor is its own,
+		writes (e.g. deleting rows found by the query) can be made while the rows are being read.
+		:param sql: the query to run
+		:     vals: the parameters for the query
+		:return: an iterator of row tuples
+		"""
+		self.flush()
+		cursor = self.connection.cursor()
+		cursor.execute(sql, vals)
+		return fetch_rows(cursor)
+
 	def find_dup_filesizes(self):
-		self.cursor.execute('''SELECT filedir, filename, filesize, count(*), sum(filesize) AS totsize FROM files GROUP BY filesize having count(*) > 1 ORDER BY totsize DESC''')
-		return self.cursor.fetchall()
-		
+		return list(self.iter_dup_filesizes())
+
+	def iter_dup_filesizes(self):
+		return self.iter_query('''SELECT filedir, filename, filesize, count(*), sum(filesize) AS totsize FROM file_paths GROUP BY filesize having count(*) > 1 ORDER BY totsize DESC''')
+
 	def find_files_of_size(self, size):
+		return list(self.iter_files_of_size(size))
+
+	def iter_files_of_size(self, size):
 		val = (size,)
-		self.cursor.execute('''SELECT filedir, filename FROM files WHERE filesize=?''', val)
-		return self.cursor.fetchall()
-		
+		return self.iter_query('''SELECT filedir, filename, partial_hash, full_hash, device FROM file_paths WHERE filesize=?''', val)
+
 	def find_dup_filenames(self):
-		self.cursor.execute('''SELECT filedir, filename, count(*), sum(filesize) AS totsize FROM files GROUP BY filename having count(*) > 1 ORDER BY totsize DESC''')
-		return self.cursor.fetchall()
-		
+		return list(self.iter_dup_filenames())
+
+	def iter_dup_filenames(self):
+		return self.iter_query('''SELECT filedir, filename, count(*), sum(filesize) AS totsize FROM file_paths GROUP BY filename having count(*) > 1 ORDER BY totsize DESC''')
+
 	def find_files_of_name(self, name):
+		return list(self.iter_files_of_name(name))
+
+	def iter_files_of_name(self, name):
 		val = (name,)
-		self.cursor.execute('''SELECT filedir, filename FROM files WHERE filename=?''', val)
-		return self.cursor.fetchall()
-	
+		return self.iter_query('''SELECT filedir, filename FROM file_paths WHERE filename=?''', val)
+
+	@timed('sql')
+	def attach(self, filename, alias):
+		"""
+		Attach another database, so the duplicate searches cover its files as well as this database's.
+		Hashes calculated for its files are saved back to it.
+		:param filename: the database file to attach. It is brought up to the current schema first.
+		:         alias: the schema name to attach it as, a plain identifier
+		Raises a sqlite3.DatabaseError if the file is not a database, or not one of this utility's.
+		"""
+		FileDatabase(filename).close()
+		self.commit()
+		self.cursor.execute(f'''ATTACH DATABASE ? AS {alias}''', (filename,))
+		self.cursor.execute(f'''SELECT name FROM {alias}.sqlite_master WHERE type=? AND name=?''', ('table', 'files'))
+		if not self.cursor.fetchall():
+			self.cursor.execute(f'''DETACH DATABASE {alias}''')
+			raise sqlite3.DatabaseError("it has no file info in it")
+		self.sources.append(alias)
+
+		# the views are temp, so they live only as long as this connection, and can span the schemas
+		self.cursor.execute('''DROP VIEW IF EXISTS temp.all_paths''')
+		self.cursor.execute('''DROP VIEW IF EXISTS temp.all_files''')
+		self.cursor.execute('''CREATE TEMP VIEW all_paths AS ''' + ' UNION ALL '.join(
+			f'''SELECT '{source}' AS source, * FROM {source}.file_paths''' for source in self.sources))
+		self.cursor.execute('''CREATE TEMP VIEW all_files AS ''' + ' UNION ALL '.join(
+			f'''SELECT '{source}' AS source, filesize, filename, norm_name FROM {source}.files''' for source in self.sources))
+		self.paths_table = 'temp.all_paths'
+		self.files_table = 'temp.all_files'
+		self.source_column = 'source'
+
+	@timed('sql')
+	def find_size_groups(self, min_total=0, cross=False):
+		"""
+		Find every file that shares its size with another, in a single query, ordered so the files of
+		each size come together, the groups with the largest total size first. Rows are read from the
+		cursor as they are needed, rather than all being fetched up front.
+		:param min_total: groups whose sizes add up to less than this many bytes are left out
+		:        cross: if True, only sizes found in more than one of the attached databases are included
+		:return: an iterator of (filedir, filename, filesize, partial_hash, full_hash, device, inode, source)
+		:      : tuples, where source is the schema the row came from
+		"""
+		having = '''AND count(DISTINCT source) > 1''' if cross else ''
+		return self.iter_query(f'''SELECT f.filedir, f.filename, f.filesize, f.partial_hash, f.full_hash, f.device,
+				f.inode, {self.source_column}
+			FROM (SELECT filesize, sum(filesize) AS totsize FROM {self.files_table} GROUP BY filesize
+				HAVING count(*) > 1 AND sum(filesize) >= ? {having}) g
+			JOIN {self.paths_table} f ON f.filesize = g.filesize
+			ORDER BY g.totsize DESC, g.filesize''', (min_total or 0,))
+
+	@timed('sql')
+	def find_name_groups(self, min_total=0, cross=False):
+		"""
+		Find every file that shares its name with another, in a single query, ordered so the files of
+		each name come together, the groups with the largest total size first.
+		:param min_total: groups whose sizes add up to less than this many bytes are left out
+		:        cross: if True, only names found in more than one of the attached databases are included
+		:return: an iterator of (filedir, filename, count of files with that name, device, inode) tuples
+		"""
+		having = '''AND count(DISTINCT source) > 1''' if cross else ''
+		return self.iter_query(f'''SELECT f.filedir, f.filename, g.count, f.device, f.inode
+			FROM (SELECT filename, count(*) AS count, sum(filesize) AS totsize FROM {self.files_table} GROUP BY filename
+				HAVING count(*) > 1 AND sum(filesize) >= ? {having}) g
+			JOIN {self.paths_table} f ON f.filename = g.filename
+			ORDER BY g.totsize DESC, g.filename''', (min_total or 0,))
+
+	@timed('sql')
+	def find_similar_name_groups(self, min_total=0, cross=False):
+		"""
+		Find every file whose normalized name it shares with another, in a single query, ordered so the
+		files of each name come together, the groups with the largest total size first. This groups
+		'report.pdf' with 'Report (1).pdf' and 'report - Copy.pdf', as well as with other 'report.pdf's.
+		:param min_total: groups whose sizes add up to less than this many bytes are left out
+		:        cross: if True, only names found in more than one of the attached databases are included
+		:return: an iterator of (filedir, filename, norm_name, device, inode) tuples
+		"""
+		having = '''AND count(DISTINCT source) > 1''' if cross else ''
+		return self.iter_query(f'''SELECT f.filedir, f.filename, f.norm_name, f.device, f.inode
+			FROM (SELECT norm_name, sum(filesize) AS totsize FROM {self.files_table} GROUP BY norm_name
+				HAVING count(*) > 1 AND sum(filesize) >= ? {having}) g
+			JOIN {self.paths_table} f ON f.norm_name = g.norm_name
+			ORDER BY g.totsize DESC, g.norm_name''', (min_total or 0,))
+
+	def find_files_of_sizes(self, sizes):
+		return list(self.iter_files_of_sizes(sizes))
+
+	@timed('sql')
+	def iter_files_of_sizes(self, sizes):
+		"""
+		Find every file of any of a number of sizes, with a single join against a temp table holding
+		the sizes, rather than a query per size. The rows must all be read before the next call, as
+		that refills the temp table.
+		:param sizes: an iterable of file sizes
+		:return: an iterator of (filedir, filename, filesize, partial_hash, full_hash, device, inode, source)
+		:      : tuples, where source is the schema the row came from
+		"""
+		self.flush()
+		self.load_keys('check_sizes', sizes)
+		return self.iter_query(self.each_source('''SELECT f.filedir, f.filename, f.filesize, f.partial_hash, f.full_hash,
+				f.device, f.inode, '{source}' FROM temp.check_sizes k CROSS JOIN {source}.file_paths f ON f.filesize = k.value'''))
+
+	def find_files_of_names(self, names):
+		return list(self.iter_files_of_names(names))
+
+	@timed('sql')
+	def iter_files_of_names(self, names):
+		"""
+		Find every file with any of a number of names, with a single join against a temp table holding
+		the names, rather than a query per name. The rows must all be read before the next call, as
+		that refills the temp table.
+		:param names: an iterable of file names
+		:return: an iterator of (filedir, filename, device, inode) tuples
+		"""
+		self.flush()
+		self.load_keys('check_names', names)
+		return self.iter_query(self.each_source('''SELECT f.filedir, f.filename, f.device, f.inode
+			FROM temp.check_names k CROSS JOIN {source}.file_paths f ON f.filename = k.value'''))
+
+	@timed('sql')
+	def find_similar_names(self, norm_names, threshold=SIMILARITY, limit=MAX_SIMILAR):
+		"""
+		Find the stored names most like each of a number of normalized names, using the trigram index.
+		Only names with the same extension, that share enough trigrams to possibly reach the threshold,
+		are ever looked at, so the time taken depends on the number of near names, not of names stored.
+		:param norm_names: an iterable of names returned by normalize_name
+		:       threshold: the lowest similarity, from 0 to 1, of a name to count as a near match
+		:           limit: the most near matches returned for any one name
+		:return: a dictionary of each of norm_names that has near matches to a list of (norm_name,
+		:      : similarity) tuples, most similar first. A name that is stored is its own best match.
+		"""
+		self.flush()
+		self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS check_grams (name, gram, need, low, high)''')
+		self.cursor.execute('''DELETE FROM temp.check_grams''')
+		grams = dict()
+		rows = []
+		for name in set(norm_names):
+			grams[name] = name_grams(name)
+			extension = name.split('/', 1)[0]
+			need = min_shared(grams[name], threshold)
+			# '0' sorts straight after '/', so low and high bound the names with this extension
+			rows.extend((name, gram, need, f"{extension}/", f"{extension}0") for gram in grams[name])
+		self.cursor.executemany('''INSERT INTO temp.check_grams (name, gram, need, low, high) VALUES (?, ?, ?, ?, ?)''', rows)
+
+		similar = dict()
+		for name, other in self.iter_query(self.each_source('''SELECT q.name, g.norm_name
+				FROM temp.check_grams q CROSS JOIN {source}.name_grams g
+					ON g.gram = q.gram AND g.norm_name > q.low AND g.norm_name < q.high
+				GROUP BY q.name, g.norm_name HAVING count(*) >= min(q.need)''')):
+			score = similarity(grams[name], name_grams(other))
+			if score >= threshold:
+				similar.setdefault(name, dict())[other] = score
+		return {name: sorted(found.items(), key=lambda item: (-item[1], item[0]))[:limit] \
+				for name, found in similar.items()}
+
+	def find_files_of_norm_names(self, norm_names):
+		return list(self.iter_files_of_norm_names(norm_names))
+
+	@timed('sql')
+	def iter_files_of_norm_names(self, norm_names):
+		"""
+		Find every file with any of a number of normalized names, with a single join against a temp
+		table holding the names. The rows must all be read before the next call, as that refills the
+		temp table.
+		:param norm_names: an iterable of names returned by normalize_name
+		:return: an iterator of (filedir, filename, norm_name, device, inode) tuples
+		"""
+		self.flush()
+		self.load_keys('check_norms', norm_names)
+		return self.iter_query(self.each_source('''SELECT f.filedir, f.filename, f.norm_name, f.device, f.inode
+			FROM temp.check_norms k CROSS JOIN {source}.file_paths f ON f.norm_name = k.value'''))
+
+	def each_source(self, sql):
+		# the query run against each of the attached databases in turn, with {source} as its schema, so
+		# a join against a temp table of keys can use each database's own index. The queries CROSS JOIN
+		# from the keys, as without statistics SQLite would otherwise scan the whole files table.
+		return ' UNION ALL '.join(sql.format(source=source) for source in self.sources)
+
+	def load_keys(self, table, values):
+		# (re)fill a single column temp table with the distinct values to look up
+		self.cursor.execute(f'''CREATE TEMP TABLE IF NOT EXISTS {table} (value PRIMARY KEY) WITHOUT ROWID''')
+		self.cursor.execute(f'''DELETE FROM temp.{table}''')
+		self.cursor.executemany(f'''INSERT OR IGNORE INTO temp.{table} (value) VALUES (?)''', ((value,) for value in values))
+
+	@timed('sql')
+	def count_files(self, dir):
+		# the number of files stored at or below a directory
+		self.flush()
+		self.cursor.execute(f'''SELECT count(*) FROM files WHERE dir_id IN {SUBTREE}''', (dir,))
+		return self.cursor.fetchone()[0]
+
 	def find_files_in_dir(self, dir):
+		return list(self.iter_files_in_dir(dir))
+
+	def iter_files_in_dir(self, dir):
 		val = (dir,)
-		self.cursor.execute('''SELECT * FROM files WHERE filedir=?''', val)
-		return self.cursor.fetchall()
+		return self.iter_query('''SELECT * FROM file_paths WHERE filedir=?''', val)
 
 	def find_files_below_dir(self, dir):
-		pattern=f"{dir}{os.sep}%"
-		val = (pattern,)
-		self.cursor.execute('''SELECT * FROM files WHERE filedir LIKE ?''', val)
-		return self.cursor.fetchall()
+		return list(self.iter_files_below_dir(dir))
+
+	def iter_files_below_dir(self, dir):
+		val = (dir,)
+		return self.iter_query(f'''SELECT * FROM file_paths WHERE dir_id IN {SUBTREE} AND filedir != ?''', val * 2)
 		
+	@timed('sql')
 	def find_specific_file(self, directory, name):
 		val = (directory, name)
-		self.cursor.execute('''SELECT * FROM files WHERE filedir=? and filename=?''', val)
+		if val in self.pending_keys:
+			self.flush()
+		self.cursor.execute('''SELECT * FROM file_paths WHERE filedir=? and filename=?''', val)
 		return self.cursor.fetchall()
 		
-	def update(self, filedir, filename, filesize):
-		val = (filedir, filename, filesize, filedir, filename)
-		self.cursor.execute('''UPDATE files SET filedir=?, filename=?, filesize=? WHERE filedir=? and filename=?''', val)
+	def update(self, filedir, filename, filesize, mtime=None, inode=None, device=None):
+		# the file has changed, so any hashes stored for it are no longer valid
+		val = (filesize, mtime, inode, device, filedir, filename)
+		self.queue('''UPDATE files SET filesize=?, mtime=?, inode=?, device=?, partial_hash=NULL, full_hash=NULL WHERE dir_id=(SELECT id FROM dirs WHERE path=?) and filename=?''', val, val[4:])
+
+	def set_hashes(self, filedir, filename, filesize, partial_hash, full_hash, schema='main'):
+		# only stored if the file is still the size the hashes were calculated at
+		val = (partial_hash, full_hash, filedir, filename, filesize)
+		self.queue(f'''UPDATE {schema}.files SET partial_hash=?, full_hash=? WHERE dir_id=(SELECT id FROM {schema}.dirs WHERE path=?) and filename=? and filesize=?''', val, val[2:4])
+
+	def start_snapshot(self, root):
+		"""
+		Create the empty tables that a treewalk loads the current state of the filesystem into: walk for
+		the files, and walk_dirs for the directories visited. Once loaded, update compares them to the
+		database with a handful of set based statements, rather than looking up every file one at a
+		time. They are ordinary tables, committed as the walk goes, so an interrupted walk can be
+		resumed from where it got to. run_state records that the walk is in progress.
+		:param root: the directory about to be walked
+		"""
+		self.commit()
+		self.cursor.execute('''DROP TABLE IF EXISTS walk''')
+		self.cursor.execute('''DROP TABLE IF EXISTS walk_dirs''')
+		self.cursor.execute('''CREATE TABLE walk (filedir, filename, filesize, mtime, inode, device, dir_id INTEGER)''')
+		self.cursor.execute('''CREATE TABLE walk_dirs (path, mtime, file_count, unchanged, subdirs, dir_id INTEGER)''')
+		self.cursor.execute('''DELETE FROM run_state''')
+		self.cursor.execute('''INSERT INTO run_state (id, root, stage) VALUES (1, ?, ?)''', (root, 'walking'))
+		self.commit()
+		self.snapshot_indexed = False
+
+	@timed('sql')
+	def is_built(self):
+		"""
+		:return: False for a database whose tables were never written, e.g. one left by a create that was
+		:      : interrupted straight after making the file
+		"""
+		self.cursor.execute('''SELECT name FROM sqlite_master WHERE type=? AND name=?''', ('table', 'run_state'))
+		return bool(self.cursor.fetchall())
+
+	@timed('sql')
+	def find_run(self):
+		"""
+		:return: a tuple of (directory walked, stage reached) for the run in progress, or None if there
+		:      : is none. The stage is 'walking' until the walk has been applied, then 'hashing'.
+		"""
+		self.cursor.execute('''SELECT root, stage FROM run_state WHERE id = 1''')
+		return self.cursor.fetchone()
+
+	@timed('sql')
+	def resume_snapshot(self):
+		"""
+		Pick up the snapshot of an interrupted walk. A directory's row is written before its files, so
+		any listed directory without all of its files in the snapshot was cut off part way, and is
+		removed to be listed again.
+		:return: a tuple of (dictionary of directory path to list of subdirectory paths, for every
+		:      : directory the walk has finished, the number of files those directories hold)
+		"""
+		self.commit()
+		self.cursor.execute('''DELETE FROM walk_dirs WHERE unchanged = 0 AND file_count !=
+			coalesce((SELECT count FROM (SELECT filedir, count(*) AS count FROM walk GROUP BY filedir) w
+				WHERE w.filedir = walk_dirs.path), 0)''')
+		self.cursor.execute('''DELETE FROM walk WHERE filedir NOT IN (SELECT path FROM walk_dirs)''')
+		self.commit()
+		done_dirs = dict()
+		for path, subdirs in self.connection.execute('''SELECT path, subdirs FROM walk_dirs'''):
+			done_dirs[path] = subdirs.split('\0') if subdirs else []
+		self.cursor.execute('''SELECT total(file_count) FROM walk_dirs''')
+		self.snapshot_indexed = False
+		return done_dirs, int(self.cursor.fetchone()[0])
+
+	def finish_run(self):
+		self.cursor.execute('''DELETE FROM run_state''')
+		self.commit()
+
+	def add_to_snapshot(self, records):
+		# records are (filedir, filename, filesize, mtime, inode, device) tuples, as a walk hands them back
+		self.queue_many('''INSERT INTO walk (filedir, filename, filesize, mtime, inode, device) VALUES (?, ?, ?, ?, ?, ?)''', records)
+
+	def add_dir_to_snapshot(self, path, mtime, file_count, unchanged, subdirs):
+		"""
+		Record a directory the walk visited. If unchanged is True the walk did not list it, because its
+		mtime matched the stored one, so its files are left as they are. The subdirectories are kept so
+		a resumed walk can carry on below the directory without listing it again.
+		"""
+		vals = (path, mtime, file_count, 1 if unchanged else 0, '\0'.join(subdirs))
+		self.queue('''INSERT INTO walk_dirs (path, mtime, file_count, unchanged, subdirs) VALUES (?, ?, ?, ?, ?)''', vals, None)
+
+	@timed('sql')
+	def load_dir_states(self, dir):
+		"""
+		Load what the last walk recorded about every directory at or below dir, for a walk that skips
+		the directories that have not changed since
+		:param dir: the top of the tree about to be walked
+		:return: a dictionary of directory path to (mtime, file_count, list of subdirectory paths)
+		"""
+		self.flush()
+		rows = self.connection.execute(f'''SELECT id, parent_id, path, mtime, file_count FROM dirs
+			WHERE id IN {SUBTREE}''', (dir,)).fetchall()
+		paths = {row[0]: row[2] for row in rows}
+		states = {row[2]: (row[3], row[4], []) for row in rows}
+		for id, parent_id, path, mtime, file_count in rows:
+			if parent_id in paths:
+				states[paths[parent_id]][2].append(path)
+		return states
+
+	@timed('sql')
+	def walk_filter_matches(self, root, key):
+		"""
+		Check the directory states at and below root were recorded by walks that skipped the same files
+		and directories as the one about to start. A directory pruned then, or a file excluded then, is
+		missing from the states, and would never be found again by a walk that trusts them.
+		States recorded before the filters were, e.g. by an older version or an import, are trusted.
+		:param root: the top of the tree about to be walked
+		:       key: the key of the WalkFilter it is about to be walked with
+		:return: True if the stored directory states can be used for the walk
+		"""
+		self.flush()
+		rows = self.connection.execute('''SELECT root, filter FROM walk_filters WHERE root = ?1
+			OR substr(?1, 1, length(root) + 1) = root || ?2 OR substr(root, 1, length(?1) + 1) = ?1 || ?2''', \
+			(root, os.sep)).fetchall()
+		# the closest root at or above this one is the one its states come under
+		above = [row for row in rows if len(row[0]) <= len(root)]
+		if above and max(above, key=lambda row: len(row[0]))[1] != key:
+			return False
+		return all(recorded == key for path, recorded in rows if len(path) > len(root))
+
+	def set_walk_filter(self, root, key):
+		"""
+		Record the filter the directory states at and below root are being recorded with. Any recorded
+		for the roots below it are dropped, as the walk of root covers them.
+		:param root: the top of the tree walked
+		:       key: the key of the WalkFilter, or '' while the walk is still going, so an interrupted
+		:          : one is walked in full the next time
+		"""
+		self.flush()
+		self.cursor.execute('''DELETE FROM walk_filters WHERE substr(root, 1, length(?1) + 1) = ?1 || ?2''', (root, os.sep))
+		self.cursor.execute('''INSERT OR REPLACE INTO walk_filters (root, filter) VALUES (?, ?)''', (root, key))
+		self.commit()
+
+	@timed('sql')
+	def index_snapshot(self):
+		"""
+		Once the snapshot is loaded, add any new directories to the dirs table, give every file and
+		directory in the snapshot its dir_id, and index it. Building the index once is much cheaper than
+		maintaining it row by row during the walk.
+		"""
+		self.flush()
+		if self.snapshot_indexed:
+			return
+		for row in self.connection.execute('''SELECT path FROM walk_dirs WHERE path NOT IN (SELECT path FROM dirs)
+			UNION SELECT filedir FROM walk WHERE filedir NOT IN (SELECT path FROM dirs)''').fetchall():
+			self.dir_id(row[0])
+		self.cursor.execute('''UPDATE walk SET dir_id = (SELECT id FROM dirs WHERE path = walk.filedir)''')
+		self.cursor.execute('''UPDATE walk_dirs SET dir_id = (SELECT id FROM dirs WHERE path = walk_dirs.path)''')
+		self.cursor.execute('''CREATE INDEX IF NOT EXISTS walk_key ON walk(dir_id, filename)''')
+		self.cursor.execute('''CREATE INDEX IF NOT EXISTS walk_dirs_key ON walk_dirs(dir_id)''')
+		self.snapshot_indexed = True
+
+	@timed('sql')
+	def compare_snapshot(self):
+		"""
+		Compare every file in the snapshot to the files table, in the order the files were walked.
+		A file is 'updated' if its size, mtime or inode has changed. Rows from older databases with no
+		stat info yet are 'skipped' as long as the size still matches.
+		:return: an iterator of (filedir, filename, filesize, stored filesize, status) tuples, where status
+		:      : is one of 'added', 'updated' or 'skipped'
+		"""
+		self.index_snapshot()
+		return self.iter_query('''SELECT w.filedir, w.filename, w.filesize, f.filesize,
+			CASE WHEN f.rowid IS NULL THEN 'added'
+				WHEN f.filesize IS NOT w.filesize THEN 'updated'
+				WHEN f.mtime IS NULL THEN 'skipped'
+				WHEN f.mtime IS NOT w.mtime OR f.inode IS NOT w.inode THEN 'updated'
+				ELSE 'skipped' END
+			FROM walk w LEFT JOIN files f ON f.dir_id = w.dir_id AND f.filename = w.filename
+			ORDER BY w.rowid''')
+
+	@timed('sql')
+	def count_unchanged_in_snapshot(self):
+		"""
+		:return: a tuple of (the number of directories the walk skipped as unchanged, the number of files
+		:      : stored for them)
+		"""
+		self.index_snapshot()
+		self.cursor.execute('''SELECT count(*), total(file_count) FROM walk_dirs WHERE unchanged = 1''')
+		dirs, files = self.cursor.fetchone()
+		return dirs, int(files)
+
+	@timed('sql')
+	def find_missing_from_snapshot(self, dir):
+		"""
+		Find the files in the database, at or below a directory, that the walk did not find. The files of
+		directories the walk skipped as unchanged are not missing.
+		:param dir: the directory the snapshot was walked from
+		:return: an iterator of (filedir, filename) tuples
+		"""
+		self.index_snapshot()
+		return self.iter_query(f'''SELECT d.path, f.filename FROM files f JOIN dirs d ON d.id = f.dir_id
+			WHERE f.dir_id IN {SUBTREE}
+			AND f.dir_id NOT IN (SELECT dir_id FROM walk_dirs WHERE unchanged = 1)
+			AND NOT EXISTS (SELECT 1 FROM walk w WHERE w.dir_id = f.dir_id AND w.filename = f.filename)''', (dir,))
+
+	@timed('sql')
+	def apply_snapshot(self, dir):
+		"""
+		Make the database match the snapshot, for everything at or below the directory it was walked
+		from. Each kind of change is a single statement. The snapshot is dropped afterwards.
+		:param dir: the directory the snapshot was walked from
+		:return: a tuple of the number of rows (deleted, updated, added)
+		"""
+		self.index_snapshot()
+		self.cursor.execute(f'''DELETE FROM files WHERE dir_id IN {SUBTREE}
+			AND dir_id NOT IN (SELECT dir_id FROM walk_dirs WHERE unchanged = 1)
+			AND NOT EXISTS (SELECT 1 FROM walk w WHERE w.dir_id = files.dir_id AND w.filename = files.filename)''', (dir,))
+		deleted = self.cursor.rowcount
+
+		# rows from older databases just have their stat info filled in, keeping their hashes
+		self.cursor.execute('''UPDATE files SET (mtime, inode, device) =
+			(SELECT w.mtime, w.inode, w.device FROM walk w WHERE w.dir_id = files.dir_id AND w.filename = files.filename)
+			WHERE rowid IN (SELECT f.rowid FROM walk w JOIN files f ON f.dir_id = w.dir_id AND f.filename = w.filename
+				WHERE f.mtime IS NULL AND f.filesize = w.filesize)''')
+
+		# the file has changed, so any hashes stored for it are no longer valid
+		self.cursor.execute('''UPDATE files SET (filesize, mtime, inode, device) =
+			(SELECT w.filesize, w.mtime, w.inode, w.device FROM walk w WHERE w.dir_id = files.dir_id AND w.filename = files.filename),
+			partial_hash = NULL, full_hash = NULL
+			WHERE rowid IN (SELECT f.rowid FROM walk w JOIN files f ON f.dir_id = w.dir_id AND f.filename = w.filename
+				WHERE f.filesize IS NOT w.filesize OR f.mtime IS NOT w.mtime OR f.inode IS NOT w.inode)''')
+		updated = self.cursor.rowcount
+
+		self.cursor.execute('''INSERT INTO files (dir_id, filename, filesize, mtime, inode, device, norm_name)
+			SELECT dir_id, filename, filesize, mtime, inode, device, normalize_name(filename) FROM walk w
+			WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.dir_id = w.dir_id AND f.filename = w.filename)''')
+		added = self.cursor.rowcount
+
+		# remember what each listed directory looked like, so the next walk can skip it if unchanged
+		self.cursor.execute('''UPDATE dirs SET (mtime, file_count) =
+			(SELECT w.mtime, w.file_count FROM walk_dirs w WHERE w.dir_id = dirs.id)
+			WHERE id IN (SELECT dir_id FROM walk_dirs WHERE unchanged = 0)''')
+
+		self.prune_dirs(dir)
+		self.cursor.execute('''DROP TABLE walk''')
+		self.cursor.execute('''DROP TABLE walk_dirs''')
+		# committed along with the changes, so a resumed run goes straight on to hashing
+		self.cursor.execute('''UPDATE run_state SET stage = ?''', ('hashing',))
+		self.commit()
+		return deleted, updated, added
+
+	def prune_dirs(self, dir):
+		"""
+		Remove the directories below dir that the walk did not visit (they were removed, or pruned from
+		the walk) and that no longer hold any files. Directories the walk did visit are kept even when
+		empty, as their stored mtime is what lets the next walk skip them.
+		:param dir: the directory the snapshot was walked from
+		"""
+		self.cursor.execute(f'''DELETE FROM dirs WHERE id IN {SUBTREE}
+			AND id NOT IN (SELECT dir_id FROM walk_dirs)
+			AND NOT EXISTS (SELECT 1 FROM files f WHERE f.dir_id = dirs.id)''', (dir,))
+		self.dir_ids = dict()
+
+	@timed('sql')
+	def find_child_dirs(self, dir):
+		# the stored directories directly below a directory
+		self.flush()
+		self.cursor.execute('''SELECT path FROM dirs WHERE parent_id = (SELECT id FROM dirs WHERE path = ?)''', (dir,))
+		return [row[0] for row in self.cursor.fetchall()]
+
+	def set_dir_state(self, path, mtime, file_count):
+		# the mtime and number of files of a directory that has just been listed, for the next incremental walk
+		val = (mtime, file_count, self.dir_id(path))
+		self.queue('''UPDATE dirs SET mtime=?, file_count=? WHERE id=?''', val, None)
+
+	@timed('sql')
+	def delete_tree(self, dir):
+		"""
+		Delete a directory, along with every file and directory below it, once it is gone from the file system
+		:param dir: the directory to delete
+		:return: the number of files deleted
+		"""
+		self.flush()
+		self.cursor.execute(f'''DELETE FROM files WHERE dir_id IN {SUBTREE}''', (dir,))
+		deleted = self.cursor.rowcount
+		self.cursor.execute(f'''DELETE FROM dirs WHERE id IN {SUBTREE}''', (dir,))
+		self.uncommitted += deleted
+		self.dir_ids = dict()
+		return deleted
+
+	def iter_dirs(self):
+		# every stored directory, in id order, so each parent comes before the directories below it
+		return self.iter_query('''SELECT id, parent_id, path, mtime, file_count FROM dirs ORDER BY id''')
+
+	def iter_all_files(self):
+		# every stored file, with the files of each directory together
+		return self.iter_query('''SELECT dir_id, filename, filesize, mtime, inode, device, partial_hash, full_hash
+			FROM files ORDER BY dir_id, filename''')
+
+	def load_dirs(self, rows):
+		"""
+		Add directories in bulk, keeping the ids given, e.g. from a snapshot
+		:param rows: list of (id, parent_id, path, mtime, file_count) tuples
+		"""
+		self.queue_many('''INSERT INTO dirs (id, parent_id, path, mtime, file_count) VALUES (?, ?, ?, ?, ?)''', rows)
+
+	def load_files(self, rows):
+		"""
+		Add files in bulk, along with any hashes already calculated for them, e.g. from a snapshot
+		:param rows: list of (dir_id, filename, filesize, mtime, inode, device, partial_hash, full_hash) tuples
+		"""
+		# nothing is looked up while files are loaded, so their keys need not be tracked as queue does
+		self.queue_many('''INSERT INTO files (dir_id, filename, filesize, mtime, inode, device, partial_hash, full_hash,
+			norm_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, normalize_name(?2))''', rows)
 
 	def __del__(self):
-		self.connection.commit()
-		self.connection.close()
+		if hasattr(self, 'closed'):
+			self.close()
 		
 		
\ No newline at end of file
@@ -1,6 +1,15 @@
 #!/usr/local/bin/python3
 
 import os
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+
+from utils.metrics import METRICS
+from utils.output import Output
+
+# the hashing, the walk and its pipeline are imported by the functions that use them, so a command
+# that needs none of them, e.g. export, does not load them
 
 
 def is_file(filename):
@@ -32,20 +41,93 @@ def normalize_dir_name(dirname):
 	return os.path.abspath(temp)
 
 
-def treewalk_with_action(file_db, directory, filter, worker, in_state = None):
+def parse_options(parameters, options):
+	"""
+	Split the parameters for a command into the positional parameters and any --options
+	:param parameters: the list of parameters passed in to the command from the command line
+	:         options: a dictionary of the options the command accepts. Maps the option name (e.g. '--jobs')
+	:                : to a function that converts its value (e.g. int), or to None for a flag that
+	:                : takes no value
+	:return: a tuple of (list of positional parameters, dictionary of option name to value). The option
+	:      : names in the dictionary have the leading dashes removed. Flags are set to True.
+	:      : Raises a ValueError for an unknown option, a missing value, or a value that will not convert.
+	"""
+	positional = []
+	values = dict()
+	remaining = iter(parameters)
+	for param in remaining:
+		if not param.startswith('--'):
+			positional.append(param)
+			continue
+
+		name, sep, value = param.partition('=')
+		if name not in options:
+			raise ValueError(f"unknown option {name}")
+		convert = options[name]
+		key = name[2:].replace('-', '_')
+		if convert is None:
+			if sep:
+				raise ValueError(f"option {name} does not take a value")
+			values[key] = True
+			continue
+
+		if not sep:
+			value = next(remaining, None)
+			if value is None:
+				raise ValueError(f"option {name} requires a value")
+		try:
+			values[key] = convert(value)
+		except ValueError:
+			raise ValueError(f"invalid value for option {name}: {value}")
+	return positional, values
+
+
+def split_list(value):
+	"""
+	Option value converter for a comma separated list, e.g. --exclude '*.tmp,Thumbs.db'
+	:param value: the option value from the command line
+	:return: a list of the non-empty items in the value
+	"""
+	return [item for item in value.split(',') if item]
+
+
+def treewalk_with_action(file_db, directory, walk_filter, worker, in_state = None, walkers = 1, ordered = False, \
+						 dir_worker = None, known_dirs = None, done_dirs = None, stages = (), cancel = None):
 	"""
 	Perform a treewalk on a specified filesystem, including all subdirectories and files. Will skip
-	any file namess in the filter list, and will execute the worker function, passing it a dictionary
-	to maintain state.
-	NOTE: If state['STOP'] exists, then the treewalk will immediately halt.
+	any files and directories the filter says to, and will execute the worker function on the files
+	found a batch at a time, passing it a dictionary to maintain state.
+	The walk runs as a pipeline: the directories are listed on a thread of their own, each batch then
+	goes through any stages given, each on its own thread, and the worker is run on the calling thread,
+	so it remains the only one writing to the database while the walk gets on with the next batches.
+	NOTE: Once cancel is cancelled, the treewalk halts before the next batch, and returns as if it were
+	done, so the caller must check cancel.cancelled to tell the two apart. The worker can cancel it
+	through state['cancel'], and the caller from anywhere else, e.g. a signal handler.
 	:param file_db: the FileDatabase class object that connects to a file database file
 	:    directory: a string specifying the filesystem tree to walk through
-	:       filter: a list of specific filename strings (not reg exp or wildcards) to skip over
-	;             : in the treewalk (e.g. '.DS_Store" for Mac native, etc.)
-	:       worker: a helper worker function to be executed on each file found.
-	:             : worker signature;  worker(file_db, directory, filename, filesize, state_dict)
+	:  walk_filter: a WalkFilter of the files (e.g. '.DS_Store' for Mac native) and directories to skip
+	;             : in the treewalk. None skips only the default file names.
+	:       worker: a helper worker function to be executed on each batch of files found.
+	:             : worker signature;  worker(file_db, records, state_dict)
+	:             : where records is a list of FileRecord tuples
+	:             : (filedir, filename, filesize, mtime, inode, device)
 	:     in_state: Optional parameter. Allows a pre-populated state dictionary to come in, to be
 	;             : used by the helper (i.e. pass flags, settings, etc. specific to this run)
+	:      walkers: Optional parameter. The number of threads listing directories at once.
+	:      ordered: Optional parameter. If True, files are handed to the worker sorted by directory
+	:             : and name, however many walker threads there are.
+	:   dir_worker: Optional parameter. A helper function executed on each directory visited.
+	:             : signature;  dir_worker(file_db, listing, state_dict) where listing is a DirListing
+	:   known_dirs: Optional parameter. Dictionary of directory path to (mtime, file_count, subdirs)
+	:             : from the last walk. Directories whose mtime still matches are not listed again.
+	:    done_dirs: Optional parameter. Dictionary of directory path to subdirs, for the directories
+	:             : an interrupted walk being resumed has already finished. They are not listed again.
+	:       stages: Optional parameter. Functions each batch is passed through in turn, on threads of their
+	:             : own, before the worker gets it. The first is called with the list of FileRecords, and
+	:             : the worker is then passed whatever the last one returns instead. Stages must not touch
+	:             : file_db. See Pipeline.stage for stages that need a resource of their own.
+	:       cancel: Optional parameter. A CancelToken that stops the treewalk when cancelled. It is put in
+	:             : the state as 'cancel', and one is created there if none is given.
 	;return: a final state dictionary. the calling handler is expected to know how to access and
 	:      : interpret the data in it, as it is being populated by the worker function passed in.
 	"""
@@ -54,53 +136,223 @@ def treewalk_with_action(file_db, directory, filter, worker, in_state = None):
 	else:
 		state = in_state
 
-	for dirName, subdirList, fileList in os.walk(directory):
-		for fname in fileList:
-			# immediately halt if we get the STOP flag
-			if 'STOP' in state:
-				return state
+	METRICS.set_stage('walking')
+	from utils.pipeline import Pipeline
+	pipeline = Pipeline(walk_batches(directory, walk_filter, walkers, ordered, known_dirs, done_dirs), cancel)
+	state['cancel'] = pipeline.cancel
+	for stage in stages:
+		pipeline.stage(BatchStage(stage))
 
-			# skip any filtered filename (exact) matches
-			# e.g. .DS_Store
-			if fname in filter:
-				continue
-			
-			#get file size
-			fullFileName = os.path.join(dirName, fname)
-			statinfo = os.stat(fullFileName)
-			fileSize = statinfo.st_size
-			
-			worker(file_db, dirName, fname, fileSize, state)
+	items = pipeline.run()
+	while True:
+		# the time spent waiting on the walk (and any stages), as opposed to the worker
+		with METRICS.timer('walk'):
+			item = next(items, None)
+		if item is None:
+			break
+		listings, count, batch = item
+		if dir_worker is not None:
+			for listing in listings:
+				dir_worker(file_db, listing, state)
+		METRICS.add_files(count)
+		if count:
+			worker(file_db, batch, state)
 	return state
 
 
-# leaving this in for future reporting command	
-def print_matches(file_db, min_size):
-	print("\nPossible matches by file size:\n")
-	
-	result = file_db.find_dup_filesizes()	
-	
-	for match in result:
-		if min_size:
-			if match[4] < min_size:
-				break
-		print(f"\tmatches: {match[3]}  file size: {match[2]}  total size: {match[4]:,}")
+def walk_batches(directory, walk_filter, walkers=1, ordered=False, known_dirs=None, done_dirs=None):
+	"""
+	Generator that walks a tree, for the first stage of treewalk_with_action's pipeline
+	:return: a generator of (list of DirListings, number of files, list of FileRecords) tuples. The
+	:      : listings are of the directories visited since the last batch, so none of their files are
+	:      : handed back before them. The last batch may have listings but no files.
+	"""
+	from utils.walk import scan_tree
+	listings = []
+	for records in scan_tree(directory, walk_filter, threads=walkers, ordered=ordered, known_dirs=known_dirs, \
+							 on_dir=listings.append, done_dirs=done_dirs):
+		yield listings[:], len(records), records
+		listings.clear()
+	if listings:
+		yield listings[:], 0, []
 
-		files = file_db.find_files_of_size(match[2])
-		for file in files:
-			print(f"\t|\t{file[0]}{os.sep}{file[1]}")
-		print("")
-
-
-	print("\nPossible matches by file name:\n")
-		
-	result = file_db.find_dup_filenames()
-	for match in result:
-		if min_size:
-			if match[3] < min_size:
-				break
-		print(f"\tmatches: {match[2]}  file name: {match[1]}")
-		files = file_db.find_files_of_name(match[1])
+
+class BatchStage:
+	"""
+	Wraps a treewalk stage, so it is only given the batch of each item passing through the pipeline,
+	while the listings and file count are passed along untouched
+	"""
+
+	def __init__(self, function):
+		self.function = function
+
+	def __call__(self, item):
+		listings, count, batch = item
+		return listings, count, self.function(batch)
+
+	def close(self):
+		close = getattr(self.function, 'close', None)
+		if close is not None:
+			close()
+
+
+def save_hashes(file_db, candidates):
+	"""
+	Store any newly calculated hashes back into the database each file came from, so later runs can
+	reuse them
+	:param file_db: the FileDatabase object for the connected database containing the file data
+	:   candidates: the Candidate objects that went through the hash verification
+	:return: nothing
+	"""
+	for candidate in candidates:
+		if candidate.dirty:
+			# cleared first, so a hash another thread adds meanwhile is still saved next time
+			candidate.dirty = False
+			file_db.set_hashes(candidate.filedir, candidate.filename, candidate.filesize, \
+							   candidate.partial, candidate.full, candidate.source or 'main')
+
+
+def size_group_candidates(rows):
+	"""
+	Generator that turns the rows of find_size_groups into groups of Candidates, one group per size,
+	carrying any hashes already stored in the database
+	:param rows: the rows returned by find_size_groups, with the files of each size together
+	:return: a generator of lists of Candidate objects
+	"""
+	from utils.hashing import Candidate
+	for filesize, files in groupby(rows, key=itemgetter(2)):
+		# a path stored in more than one of the attached databases is only taken once
+		group = dict()
 		for file in files:
-			print(f"\t|\t{file[0]}{os.sep}{file[1]}")
-		print("")
+			if (file[0], file[1]) not in group:
+				group[(file[0], file[1])] = Candidate(file[0], file[1], filesize, file[3], file[4], file[5], \
+													  file[6], file[7])
+		yield list(group.values())
+
+
+def digest_duplicates(file_db, pool):
+	"""
+	The content digest stage run after create and update. Every group of files in the database that
+	share a size is put through the staged hash verification on the hash pool, so the hashes are
+	already stored by the time a check or report needs them. Files that already have their hashes
+	stored are not read again.
+	:param file_db: the FileDatabase object for the connected database containing the file data
+	:         pool: the HashPool to run the verification on
+	:return: the number of confirmed duplicate groups, not counting groups that are only links to one file
+	"""
+	from utils.hashing import copies_of
+	METRICS.set_stage('hashing')
+	found = 0
+	for candidates, groups in pool.confirm_groups(size_group_candidates(file_db.find_size_groups())):
+		save_hashes(file_db, candidates)
+		found += sum(1 for group in groups if len(copies_of(group)) > 1)
+		METRICS.tick()
+	return found
+
+
+def print_matches(file_db, min_size, pool=None, output=None, cross=False, names='exact'):
+	"""
+	Print a report of the duplicates inside the database. Files are first grouped by size, and each
+	size group is then put through the staged hash verification so only confirmed duplicates are shown.
+	Paths that are hard links to the same file are shown as links of one copy, and are not counted
+	as space that could be reclaimed. Files sharing a name are reported separately, as possible matches,
+	or with names 'fuzzy', files with the same name once case and copy marks such as ' (1)' are ignored.
+	Each section is a single query, streamed, so output starts straight away and memory use does not
+	grow with the size of the database.
+	:param file_db: the FileDatabase object for the connected database containing the file data
+	:     min_size: optional cutoff in bytes. Groups with a total size below this are not reported.
+	:         pool: optional HashPool to run the verification on. Defaults to one with default settings
+	:       output: optional Output to write the report to. Defaults to text on stdout
+	:        cross: if True, only groups with files from more than one of the attached databases are reported
+	:        names: 'exact' or 'fuzzy', how file names are matched
+	:return: a tuple of the number of (confirmed duplicate groups, bytes reclaimable, hard link groups,
+	:      : file name groups) reported
+	"""
+	if output is None:
+		output = Output()
+	if pool is None:
+		from utils.hashing import HashPool
+		pool = HashPool()
+	rows = file_db.find_size_groups(min_size, cross)
+	content_groups, reclaimable, link_groups = print_content_matches(size_group_candidates(rows), min_size, pool, \
+																	 output, cross, partial(save_hashes, file_db))
+
+	similar = names == 'fuzzy'
+	if similar:
+		output.heading("Possible matches by similar file name:")
+		rows = groupby(file_db.find_similar_name_groups(min_size, cross), key=itemgetter(2))
+	else:
+		output.heading("Possible matches by file name:")
+		rows = groupby(file_db.find_name_groups(min_size, cross), key=itemgetter(1))
+
+	name_groups = 0
+	for _, files in rows:
+		files = list(files)
+		identities = {(file[3], file[4]) for file in files}
+		if len(identities) == 1 and None not in identities.pop():
+			# only links to the one file share the name, and those are shown above
+			continue
+		paths = list(dict.fromkeys(f"{file[0]}{os.sep}{file[1]}" for file in files))
+		if len(paths) < 2:
+			continue
+		name_groups += 1
+		output.name_group(paths, files[0][1], similar=similar)
+	output.flush()
+	return content_groups, reclaimable, link_groups, name_groups
+
+
+def print_content_matches(candidate_groups, min_size, pool, output, cross=False, save=None):
+	"""
+	Print the duplicates by content section of a report, followed by the groups that are only hard links
+	to one file. Each group of candidates of the same size is put through the staged hash verification.
+	The hard link groups are written to a temporary file as they are found, and printed from there once
+	the duplicates are done, so memory use does not grow with the number of them.
+	:param candidate_groups: an iterable of lists of Candidates, one list per size, largest total first
+	:          min_size: optional cutoff in bytes. Groups with a total size below this are not reported.
+	:              pool: the HashPool to run the verification on. It is closed once done.
+	:            output: the Output to write the report to
+	:             cross: if True, only groups with files from more than one of the attached databases are reported
+	:              save: optional function called with each list of candidates once verified, to save their hashes
+	:return: a tuple of the number of (confirmed duplicate groups, bytes reclaimable, hard link groups) reported
+	"""
+	import json
+	import tempfile
+	from utils.hashing import copies_of
+	output.heading("Duplicates by content:")
+
+	METRICS.set_stage('hashing')
+	content_groups = 0
+	reclaimable = 0
+	link_groups = 0
+	links = tempfile.TemporaryFile('w+', encoding='ascii')
+	for candidates, groups in pool.confirm_groups(candidate_groups):
+		if save is not None:
+			save(candidates)
+		METRICS.tick()
+		for group in groups:
+			if cross and len({candidate.source for candidate in group}) < 2:
+				continue
+			filesize = group[0].filesize
+			copies = copies_of(group)
+			if len(copies) == 1:
+				# every path leads to the same file, so there is no space to be had back
+				if not min_size or filesize >= min_size:
+					links.write(json.dumps([[candidate.path for candidate in group], filesize]) + '\n')
+					link_groups += 1
+				continue
+			# the query cut off on the size group as a whole, so a confirmed subset can still fall short
+			if min_size and filesize * len(copies) < min_size:
+				continue
+			content_groups += 1
+			reclaimable += filesize * (len(copies) - 1)
+			output.content_group([[candidate.path for candidate in copy] for copy in copies], filesize)
+	pool.close()
+
+	with links:
+		if link_groups:
+			output.heading("Hard links to the same file:")
+			links.seek(0)
+			for line in links:
+				paths, filesize = json.loads(line)
+				output.link_group(paths, filesize)
+	return content_groups, reclaimable, link_groups
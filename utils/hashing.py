@@ -0,0 +1,330 @@
+#!/usr/local/bin/python3
+
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import METRICS
+
+# number of bytes read from each end of a file for the tier 2 (partial) hash
+EDGE_SIZE = 4096
+
+# read size used when streaming an entire file through the tier 3 (full) hash
+BLOCK_SIZE = 1024 * 1024
+
+# default number of hashing worker threads, and of reads allowed in flight on any one device
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+DEFAULT_DEVICE_JOBS = 4
+
+
+class Candidate:
+    """
+    A single file being considered as a member of a duplicate group. Holds the location and size of the
+    file, along with any hashes calculated so far, so that no tier ever has to read a file twice.
+    Hashes already stored in the database can be passed in, and 'dirty' is set whenever a new hash is
+    calculated, so the caller knows which ones are worth saving back.
+    Paths with the same device and inode are hard links to (or bind mounts of) one file, so they share
+    a single identity: only one of them is ever read, and they are never duplicates of each other.
+    source is the schema of the database the file's row came from, when several are attached.
+    """
+    __slots__ = ('filedir', 'filename', 'filesize', 'partial', 'full', 'device', 'inode', 'source', 'dirty')
+
+    def __init__(self, filedir, filename, filesize, partial=None, full=None, device=None, inode=None, source=None):
+        self.filedir = filedir
+        self.filename = filename
+        self.filesize = filesize
+        self.partial = partial
+        self.full = full
+        self.device = device
+        self.inode = inode
+        self.source = source
+        self.dirty = False
+
+    @property
+    def path(self):
+        return os.path.join(self.filedir, self.filename)
+
+    @property
+    def identity(self):
+        # the file on disk this path leads to. Without stat info, every path is taken to be its own file.
+        if self.device is None or self.inode is None:
+            return id(self)
+        return (self.device, self.inode)
+
+
+def new_hash():
+    """
+    Create the hash object used for all content comparisons
+    :return: a fresh hashlib object
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+def partial_hash(path, filesize):
+    """
+    Tier 2 hash. Hashes only the first and last EDGE_SIZE bytes of a file. For files no bigger than
+    two edges this covers the entire content, and is therefore as good as a full hash.
+    :param path: the full path of the file to hash
+    :  filesize: the size of the file (already known from tier 1)
+    :return: the hex digest of the head and tail of the file
+    """
+    digest = new_hash()
+    with open(path, 'rb') as f:
+        digest.update(f.read(EDGE_SIZE))
+        if filesize > EDGE_SIZE * 2:
+            f.seek(-EDGE_SIZE, os.SEEK_END)
+            digest.update(f.read(EDGE_SIZE))
+        elif filesize > EDGE_SIZE:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    """
+    Tier 3 hash. Streams the entire file through the hash, BLOCK_SIZE bytes at a time.
+    :param path: the full path of the file to hash
+    :return: the hex digest of the entire file content
+    """
+    digest = new_hash()
+    with open(path, 'rb') as f:
+        block = f.read(BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = f.read(BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def is_fully_covered(filesize):
+    """
+    Returns True if the partial hash of a file of this size already covers every byte of it
+    """
+    return filesize <= EDGE_SIZE * 2
+
+
+class _Unlimited:
+    """
+    Stand in for a device limit when hashing without a HashPool
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_UNLIMITED = _Unlimited()
+
+
+class HashPool:
+    """
+    Runs the staged verification of many duplicate groups at once, on a pool of worker threads.
+    The files of each tier of a group are hashed in parallel too, on a second pool of jobs reader
+    threads, so a single group of many large files of the same size (e.g. VM images) can keep the
+    whole array busy. The group threads only wait on the readers, so there are never more than jobs
+    reads in flight in all.
+    Reads are also limited per device, so an SSD array can have many reads in flight while a spinning
+    disk is not made to seek between dozens of files at once.
+    The digests themselves run in parallel on the threads, as hashlib releases the GIL while hashing
+    any reasonably sized block.
+    All results come back to the calling thread, which remains the only one to touch the database.
+    """
+
+    def __init__(self, jobs=DEFAULT_JOBS, device_jobs=DEFAULT_DEVICE_JOBS):
+        self.jobs = max(1, jobs)
+        self.device_jobs = max(1, device_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        # kept apart from the group threads, which wait on these, so they can never all be waiting
+        # on work that has no thread left to run it
+        self.readers = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        self._limits = dict()
+        self._lock = threading.Lock()
+
+    def device_limit(self, device):
+        """
+        Get the semaphore limiting the reads in flight on a device
+        :param device: the st_dev of the file about to be read (None if not known)
+        :return: a semaphore, to be used as a context manager around the read
+        """
+        with self._lock:
+            limit = self._limits.get(device)
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.device_jobs)
+                self._limits[device] = limit
+            return limit
+
+    def confirm(self, candidates):
+        return confirm_duplicates(candidates, self)
+
+    def keys(self, candidates, key):
+        """
+        Work out the key of each of a group of candidates, reading the files in parallel on the reader
+        threads
+        :param candidates: list of Candidate objects
+        :             key: function that takes a Candidate and the HashPool, and returns its key
+        :return: list of the keys, in the order of candidates, with UNREADABLE for any file that could
+        :      : not be read
+        """
+        if self.readers is None or len(candidates) < 2:
+            return [_key_of(candidate, key, self) for candidate in candidates]
+        futures = [self.readers.submit(_key_of, candidate, key, self) for candidate in candidates]
+        return [future.result() for future in futures]
+
+    def confirm_groups(self, groups):
+        """
+        Verify a stream of candidate groups, a window of them at a time, so memory stays bounded no
+        matter how many groups there are.
+        :param groups: an iterable of candidate groups (lists of Candidates of the same size)
+        :return: a generator of (candidates, confirmed groups) tuples, in the order the groups came in
+        """
+        if self.executor is None:
+            for candidates in groups:
+                yield candidates, self.confirm(candidates)
+            return
+
+        window = deque()
+        for candidates in groups:
+            window.append((candidates, self.executor.submit(self.confirm, candidates)))
+            if len(window) >= self.jobs * 4:
+                candidates, future = window.popleft()
+                yield candidates, future.result()
+        while window:
+            candidates, future = window.popleft()
+            yield candidates, future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.readers is not None:
+            self.readers.shutdown()
+            self.readers = None
+
+
+def _reading(candidate, pool):
+    if pool is None:
+        return _UNLIMITED
+    return pool.device_limit(candidate.device)
+
+
+def _partial_key(candidate, pool=None):
+    if candidate.partial is None:
+        with _reading(candidate, pool):
+            start = time.perf_counter()
+            candidate.partial = partial_hash(candidate.path, candidate.filesize)
+            if METRICS.enabled:
+                METRICS.add_hashed(min(candidate.filesize, EDGE_SIZE * 2), time.perf_counter() - start)
+        candidate.dirty = True
+    return candidate.partial
+
+
+def _full_key(candidate, pool=None):
+    if candidate.full is None:
+        if is_fully_covered(candidate.filesize):
+            candidate.full = _partial_key(candidate, pool)
+        else:
+            with _reading(candidate, pool):
+                start = time.perf_counter()
+                candidate.full = full_hash(candidate.path)
+                if METRICS.enabled:
+                    METRICS.add_hashed(candidate.filesize, time.perf_counter() - start)
+        candidate.dirty = True
+    return candidate.full
+
+
+# the key of a file that could not be read
+UNREADABLE = object()
+
+
+def _key_of(candidate, key, pool):
+    try:
+        return key(candidate, pool)
+    except OSError:
+        return UNREADABLE
+
+
+def split_group(candidates, key, pool=None):
+    """
+    Split a group of candidates into sub groups that share the same key. Any sub group that collapses
+    to a single member is dropped, as is any file that can no longer be read.
+    :param candidates: list of Candidate objects
+    :             key: function that takes a Candidate (and the HashPool) and returns the value to
+    :                : group on
+    :            pool: optional HashPool, that reads the files in parallel, honouring its device limits
+    :return: list of sub groups (lists of Candidates), each with 2 or more members
+    """
+    if pool is None:
+        values = [_key_of(candidate, key, None) for candidate in candidates]
+    else:
+        values = pool.keys(candidates, key)
+    groups = dict()
+    for candidate, value in zip(candidates, values):
+        if value is UNREADABLE:
+            continue
+        groups.setdefault(value, []).append(candidate)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def copies_of(group):
+    """
+    Split a group of candidates into the separate copies on disk, putting the paths that are links
+    to the same file together
+    :param group: list of Candidate objects
+    :return: list of lists of Candidates, one list per copy, in the order they first appear in group
+    """
+    copies = dict()
+    for candidate in group:
+        copies.setdefault(candidate.identity, []).append(candidate)
+    return list(copies.values())
+
+
+def confirm_duplicates(candidates, pool=None):
+    """
+    Run the staged verification over a group of candidates that already share the same file size
+    (tier 1). Tier 2 compares the partial hashes, and tier 3 compares the full hashes of only those
+    files that survive tier 2. As soon as a group collapses to a single member, no further tiers are
+    run for it.
+    Links to the same file are only read once, through the first of them, which passes its hashes on
+    to the others. They always end up in the same group, and a group can be made up of nothing but
+    links to one file, which copies_of tells apart from real duplicates.
+    :param candidates: list of Candidate objects, all of the same file size
+    :            pool: optional HashPool, whose device limits are honoured while reading
+    :return: list of confirmed groups of identical content, each a list of 2 or more Candidates
+    """
+    if len(candidates) < 2:
+        return []
+
+    copies = copies_of(candidates)
+    firsts = [copy[0] for copy in copies]
+    confirmed = []
+    # a file linked from several paths, with no other file of its size, is not read at all
+    partial_groups = split_group(firsts, _partial_key, pool) if len(firsts) > 1 else []
+    for group in partial_groups:
+        if is_fully_covered(group[0].filesize):
+            # the partial hash already read the whole file, so tier 3 has nothing left to prove
+            confirmed.append(group)
+            continue
+        confirmed.extend(split_group(group, _full_key, pool))
+
+    # bring the links back in, alongside the first path of their file
+    linked = {copy[0].identity: copy for copy in copies if len(copy) > 1}
+    for group in confirmed:
+        for first in list(group):
+            copy = linked.pop(first.identity, None)
+            if copy:
+                for link in copy[1:]:
+                    _share_hashes(first, link)
+                group.extend(copy[1:])
+    # nothing else matched these, but their paths still all lead to the one file
+    confirmed.extend(linked.values())
+    return confirmed
+
+
+def _share_hashes(first, link):
+    for name in ('partial', 'full'):
+        value = getattr(first, name)
+        if value is not None and getattr(link, name) != value:
+            setattr(link, name, value)
+            link.dirty = True
@@ -12,78 +12,269 @@ def usage():
     print("         file will be created and processing will proceed as if an update command had given")
     print("         on an existing database file.")
     print("\ncheck  - Check the specified directory for duplicate entries in the file database, and")
-    print("         display any potential matches for review.")
+    print("         display any matches for review. Files of the same size are only reported once")
+    print("         their content has been confirmed to be identical.")
     print("\nupdate - Will modify the database entries for this directory to match the directory")
     print("         specified. NOTE that this will mean adding new files, updating stats on existing")
     print("         existing files, and removal of files in the database that are not in the filesystem.")
     print("\nreport - Generate a report on possible duplicates already contained within the database.")
+    print("\ncompare - Generate a report on the duplicates between two databases, e.g. of two volumes,")
+    print("         without walking either directory tree.")
+    print("\nwatch  - Keep the database up to date with a directory as files change, until stopped,")
+    print("         optionally reporting new duplicates as they appear.")
+    print("\nexport - Write the database to a compact snapshot file, which report can read directly.")
+    print("\nimport - Create a database from a snapshot file, without walking the directory tree.")
     print("\nEach command takes its own set of parameters. To see help for a specific command, run")
     print(f"\n{command_name} command")
     print("\nwith no parameters after the command.")
+    print("\nAny command can be run with --profile (or --profile=memory) to write a report of where its")
+    print("\ttime (or memory) went to stderr, or to the file given with --profile-output FILE. A FILE")
+    print("\tending in .prof gets the raw cProfile data instead. Only the main thread is profiled.")
     print("")
 
 
+def help_output_options():
+    print("\nOptions:")
+    print("--format F       - optional - text (the default), jsonl or csv. jsonl writes one JSON record")
+    print("                              per line, and csv one row per file, with each duplicate group")
+    print("                              given a group number, ready to be read by other tools.")
+    print("--quiet          - optional - write only the summary at the end.")
+    print("--only-changes   - optional - do not list the files update found unchanged.")
+    print("--output FILE    - optional - write the results to FILE instead of the screen.")
+    print("--progress       - optional - keep a progress line, with the rate of files, hashing and")
+    print("                              database operations, up to date on the terminal.")
+    print("--stats          - optional - show a summary of the time spent walking, reading file")
+    print("                              info (stat), hashing and in the database when done.")
+    print("--stats-json FILE - optional - also write that summary to FILE, as JSON.")
+
+
+def help_pool_options():
+    help_output_options()
+    print("--jobs N         - optional - the number of files to hash in parallel when confirming")
+    print("                              duplicates by content. Defaults to the number of CPUs (max 8).")
+    print("--device-jobs N  - optional - the most files to read at once from any single device.")
+    print("                              Defaults to 4. Use 1 for spinning disks, so they are not made")
+    print("                              to seek between files, and higher for SSD arrays.")
+
+
+def help_attach_option():
+    print("--attach LIST    - optional - comma separated database files, e.g. of other volumes, to")
+    print("                              search along with database_file. Their files are matched")
+    print("                              against each other's as well, and all of them are read at once.")
+
+
+def help_names_option():
+    print("--names MODE     - optional - exact (the default) or fuzzy. fuzzy matches file names that")
+    print("                              are alike, ignoring case, punctuation and the marks added to")
+    print("                              copies, e.g. 'report (1).pdf' and 'Report - Copy.pdf'.")
+
+
+def help_report_options():
+    help_pool_options()
+    help_attach_option()
+    help_names_option()
+
+
+def help_hash_options():
+    help_pool_options()
+    print("--exclude LIST   - optional - comma separated file names or wildcard patterns of files to")
+    print("                              skip, e.g. '*.tmp,Thumbs.db'. .DS_Store is always skipped.")
+    print("--prune LIST     - optional - comma separated directory names or wildcard patterns of")
+    print("                              directories to skip, along with everything below them,")
+    print("                              e.g. '.git,node_modules'.")
+    print("--walkers N      - optional - the number of threads listing directories at once. Defaults")
+    print("                              to 1. Higher values speed up walks over NFS and large RAID")
+    print("                              volumes, where each directory listing waits on the network.")
+    print("--ordered        - optional - process the files sorted by directory and name, so the")
+    print("                              output is the same from run to run, whatever --walkers is.")
+
+
+def help_write_options():
+    help_hash_options()
+    print("--commit-rows N  - optional - commit the changes to the database every N rows. Defaults")
+    print("                              to 50,000. An interrupted run keeps everything committed.")
+    print("--commit-seconds S - optional - also commit at least every S seconds. Defaults to 5.")
+    print("--resume         - optional - carry on with a run that was interrupted, from the last commit.")
+    print("                              Directories it had finished walking are not listed again, and")
+    print("                              files it had already hashed are not read again.")
+
+
 def help_create():
     print(f"\n\n{command_name} v {version}")
-    print(f"\n{command_name}  create  database_file  directory_to_check\n")
+    print(f"\n{command_name}  create  database_file  directory_to_check  [options]\n")
     print("database_file - required      - the path and filename of the files database to create")
     print("                                and then populate with initial data.")
     print("directory_to_check - required - the directory to walk, to populate the file database with.")
+    help_write_options()
     print("\nExample:")
     print(f"\n{command_name} create /files.db /file/system\n")
     print("\tWill create the database files.db (or will abort with an error if that database file")
     print("\talready exists). Then will perform like an update command, which means populating the")
     print('\tdatabase files.db with the information in the /file/system filesystem tree.')
+    print("\tFiles that share a size with another file are then hashed, so later check and report")
+    print("\tcommands can confirm duplicates without reading them again.")
     print("")
 
 
 def help_check():
     print(f"\n\n{command_name} v {version}")
-    print(f"\n{command_name}  check  database_file  directory_to_check\n")
+    print(f"\n{command_name}  check  database_file  directory_to_check  [options]\n")
     print("database_file - required      - the path and filename of the files database to use")
     print("                                as a reference for possible duplicates.")
     print("directory_to_check - required - the directory to walk, to check against the file database")
     print("                                for potential duplicates.")
+    help_hash_options()
+    help_attach_option()
+    help_names_option()
     print("\nExample:")
     print(f"\n{command_name} check /my/files.db /my/file/system\n")
     print("\tWill use the /my/files.db database file, and will tree walk through filesystem")
     print("\t/my/file/system and examine all files (from that path and lower). It will output")
-    print("\tany potential duplicates found, where the total impact is greater than 1 MB (1000 KB)")
+    print("\tany duplicates found. Files of the same size are compared by a hash of their first and")
+    print("\tlast few KB, and then by a hash of their full content, and only confirmed duplicates")
+    print("\tare displayed. Files sharing the same name are displayed as possible matches. Hard links")
+    print("\tto a walked file are displayed as links, rather than as duplicates.")
+    print(f"\n{command_name} check /vol1/files.db /incoming --attach /vol2/files.db,/vol3/files.db\n")
+    print("\tWill walk /incoming once, and display the duplicates of its files found on any of the")
+    print("\tthree volumes.")
     print("")
 
 
 def help_update():
     print(f"\n\n{command_name} v {version}")
-    print(f"\n{command_name}  update  database_file  directory_to_check\n")
+    print(f"\n{command_name}  update  database_file  directory_to_check  [options]\n")
     print("database_file - required      - the path and filename of the files database to update")
     print("                                with the fileysstem info.")
     print("directory_to_check - required - the directory to walk, to gather info from to update the")
     print("                                file database to reflect.")
+    help_write_options()
+    print("--incremental    - optional - do not list directories whose mtime has not changed since")
+    print("                              the last walk. Files rewritten in place, without changing")
+    print("                              their directory, are not picked up until a full update.")
+    print("                              If --exclude or --prune differ from the last walk's, every")
+    print("                              directory is listed, as files and directories skipped then")
+    print("                              would not otherwise be found.")
     print("\nExample:")
     print(f"\n{command_name} update /some/files.db /another/filesystem")
     print("\tWill use database file /some/files.db, will tree walk through the filesystem")
     print("\t/another/filesystem. The database will have new entries created for files not already")
     print('\tfound in the database, will have existing files updated, and will have missing files')
     print("\tremoved. When complete, the database information on the specified directly will")
-    print("\texactly reflect the current contents and state of that directory.")
+    print("\texactly reflect the current contents and state of that directory. Any files in the")
+    print("\tdatabase that share a size with another file, and have not been hashed yet, are then")
+    print("\thashed so later check and report commands can confirm duplicates without reading them.")
     print("")
 
 def help_report():
     print(f"\n\n{command_name} v {version}")
-    print(f"\n{command_name}  report  database_file  [cutoff size KB]\n")
+    print(f"\n{command_name}  report  database_file  [cutoff size KB]  [options]\n")
     print("database_file - required - the path and filename of the files database to search inside")
     print("                           and report on possible duplicates.")
     print("cutoff size - optional   - an integer that indicates in KB, at what point to stop")
     print("                           reporting on possible matches. If no parameter is supplied,")
     print("                           then all possible matches are reported.")
-    print("\nFor each possible match, a total impact is calculated. This is the size of all the")
+    print("\nFiles of the same size are confirmed to be duplicates by comparing a hash of their first")
+    print("\tand last few KB, and then a hash of their full content. Files sharing the same name are")
+    print("\treported separately, as possible matches. Paths that are hard links to the same file are")
+    print("\tshown as links of one copy, and groups made up only of links are reported on their own.")
+    print("\nFor each match, a total impact is calculated. This is the size of all the")
     print("\tpossible matches summed. It allows the user to eliminate low value output. For example,")
     print("\twhen the total match sizes fall below 1,000 KB (i.e. 1 MB), it may no longer be worth the")
     print("\tuser's time to track down the matches and validate uniqueness.")
+    help_report_options()
+    print("\ndatabase_file can also be a snapshot written by export. Its duplicates by content are")
+    print("\tthen found straight from the snapshot file, without a database, using numpy if it is")
+    print("\tinstalled. --attach and --names need a database.")
     print("\nExamples:")
     print(f"\n{command_name} report /some/files.db")
     print("\tReports all possible matches inside the file info database /some/files.db")
     print(f"\n{command_name} report /files.db 1000")
     print("\tReports the possible matches inside the file info database /files.db that total up")
     print("\tto 1,000 KB (1 MB) or greater. Once totals fall below this, the reporting stops.")
+    print(f"\n{command_name} report /vol1/files.db --attach /vol2/files.db")
+    print("\tReports the possible matches across both databases, as if they were one.")
+    print("")
+
+
+def help_compare():
+    print(f"\n\n{command_name} v {version}")
+    print(f"\n{command_name}  compare  database_file  other_database_file  [cutoff size KB]  [options]\n")
+    print("database_file - required       - the path and filename of the first files database.")
+    print("other_database_file - required - the path and filename of the files database to compare it with.")
+    print("cutoff size - optional         - an integer that indicates in KB, at what point to stop")
+    print("                                 reporting on possible matches, as for report.")
+    print("\nNo directory is walked. Only the duplicates with files in both databases are reported, so")
+    print("\tthe duplicates within either one are left out. Files of the same size are confirmed by")
+    print("\ttheir stored hashes, and any file without one is read, if it can be. Hashes calculated")
+    print("\tare saved back to the database the file belongs to.")
+    help_pool_options()
+    print("\nExample:")
+    print(f"\n{command_name} compare /vol1/files.db /vol2/files.db 1000")
+    print("\tReports the files on /vol1 that are duplicated on /vol2, for groups that total up to")
+    print("\t1,000 KB (1 MB) or greater.")
+    print("")
+
+
+def help_watch():
+    print(f"\n\n{command_name} v {version}")
+    print(f"\n{command_name}  watch  database_file  directory_to_watch  [options]\n")
+    print("database_file - required      - the path and filename of the files database to keep up to date.")
+    print("directory_to_watch - required - the directory to watch for changes.")
+    print("\nThe directory is first brought up to date, as update does. From then on, only the files")
+    print("\tand directories the file system reports as changed are looked at, in batches, once")
+    print("\tthings have been quiet for a moment. Files in each batch that share a size with another")
+    print("\tfile are hashed straight away. Stop watching with ctrl-c, or by killing the process.")
+    help_pool_options()
+    print("--exclude LIST   - optional - comma separated file names or wildcard patterns of files to")
+    print("                              skip, as for update.")
+    print("--prune LIST     - optional - comma separated directory names or wildcard patterns of")
+    print("                              directories to skip and not watch, as for update.")
+    print("--commit-rows N  - optional - commit the changes to the database every N rows, as for update.")
+    print("--commit-seconds S - optional - also commit at least every S seconds. Each batch is committed")
+    print("                              once applied in any case.")
+    print("--incremental    - optional - do not list directories whose mtime has not changed since")
+    print("                              the last walk, when first bringing the database up to date.")
+    print("                              As for update, every directory is listed if --exclude or")
+    print("                              --prune differ from the last walk's.")
+    print("--backend B      - optional - auto (the default), inotify or poll. inotify, on Linux, is told")
+    print("                              of each change by the kernel. poll looks for directories whose")
+    print("                              mtime has changed, and does not see files rewritten in place.")
+    print("--debounce S     - optional - apply a batch once there have been no changes for S seconds.")
+    print("                              Defaults to 2. A batch is applied at least every 30 seconds")
+    print("                              while changes keep coming.")
+    print("--poll-seconds S - optional - how often the poll backend looks for changes. Defaults to 5.")
+    print("--alert          - optional - report each duplicate group a new or changed file is in.")
+    print("\nExample:")
+    print(f"\n{command_name} watch /some/files.db /home/shared --alert --prune .git")
+    print("\tKeeps /some/files.db up to date with /home/shared, leaving out .git directories, and")
+    print("\treports any file added to it that duplicates one already there.")
+    print("")
+
+
+def help_export():
+    print(f"\n\n{command_name} v {version}")
+    print(f"\n{command_name}  export  database_file  snapshot_file  [options]\n")
+    print("database_file - required - the path and filename of the files database to export.")
+    print("snapshot_file - required - the path and filename of the snapshot file to write.")
+    print("\nThe snapshot holds every directory and file in the database, with their stat info and")
+    print("\tstored hashes, as packed binary columns, with each directory path stored only once. It")
+    print("\tis a fraction of the size of the database, can be rebuilt into one by import, and can")
+    print("\tbe given to report in place of a database.")
+    help_output_options()
+    print("\nExample:")
+    print(f"\n{command_name} export /vol1/files.db /backup/vol1.snap")
+    print("")
+
+
+def help_import():
+    print(f"\n\n{command_name} v {version}")
+    print(f"\n{command_name}  import  snapshot_file  database_file  [options]\n")
+    print("snapshot_file - required - the path and filename of a snapshot written by export.")
+    print("database_file - required - the path and filename of the files database to create. If it")
+    print("                           already exists, the process will abort with an error.")
+    print("\nThe database is created with everything in the snapshot, including the stored hashes and")
+    print("\tthe directory mtimes --incremental uses, so an update of the tree can follow straight on.")
+    help_output_options()
+    print("\nExample:")
+    print(f"\n{command_name} import /backup/vol1.snap /vol1/files.db")
     print("")
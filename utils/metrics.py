@@ -0,0 +1,228 @@
+#!/usr/local/bin/python3
+
+import functools
+import json
+import sys
+import threading
+import time
+
+# the phases time is tracked for. Walk is the time spent waiting on the directory walk, while stat, hash
+# and sql are summed over every thread doing that work, so together they can add up to more than the
+# elapsed time.
+PHASES = ('walk', 'stat', 'hash', 'sql')
+
+# the progress line is redrawn at most this often
+PROGRESS_SECONDS = 0.5
+
+
+class _Timer:
+    """
+    Adds the time spent inside a with block to a phase. Nested blocks for the same phase, on the same
+    thread (e.g. commit calling flush), are only counted once.
+    """
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        depth = self.metrics.local.__dict__
+        depth[self.phase] = depth.get(self.phase, 0) + 1
+        if depth[self.phase] == 1:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        depth = self.metrics.local.__dict__
+        depth[self.phase] -= 1
+        if self.start is not None:
+            self.metrics.add_time(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    Counts the work done by a run, and the time spent in each phase of it, so a long run can show its
+    rate and progress as it goes, and report at the end which phase the time went on.
+    Nothing is measured unless enabled, so a run that does not ask for metrics pays only for a check
+    of the enabled flag.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.progress = False
+        self.reset()
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.files = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.db_ops = 0
+        self.expected_files = None
+        self.stage = None
+        self.last_progress = 0.0
+        self.progress_shown = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, progress=False):
+        """
+        Start measuring, from now
+        :param progress: if True, and stderr is a terminal, a progress line is kept up to date there
+        """
+        self.reset()
+        self.enabled = True
+        self.progress = progress and sys.stderr.isatty()
+
+    def disable(self):
+        self.clear_progress()
+        self.enabled = False
+        self.progress = False
+
+    def timer(self, phase):
+        return _Timer(self, phase)
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] += seconds
+
+    def add_hashed(self, nbytes, seconds):
+        with self.lock:
+            self.files_hashed += 1
+            self.bytes_hashed += nbytes
+            self.phase_seconds['hash'] += seconds
+
+    def add_db_ops(self, count):
+        with self.lock:
+            self.db_ops += count
+
+    def add_files(self, count):
+        with self.lock:
+            self.files += count
+        self.tick()
+
+    def set_stage(self, stage, expected_files=None):
+        """
+        Name the stage the run is in, for the progress line
+        :param stage: e.g. 'walking' or 'hashing'
+        :expected_files: optional number of files the walk is expected to find, to estimate the time left
+        """
+        self.stage = stage
+        if expected_files:
+            self.expected_files = expected_files
+        self.tick(force=True)
+
+    def tick(self, force=False):
+        """
+        Redraw the progress line, if it has not been drawn in the last PROGRESS_SECONDS
+        """
+        if not self.progress:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_progress < PROGRESS_SECONDS:
+            return
+        self.last_progress = now
+        elapsed = max(now - self.start, 1e-6)
+        rate = self.files / elapsed
+        line = f"[{self.stage or 'running'}] {self.files:,} files  {rate:,.0f} files/s"
+        if self.stage == 'walking' and self.expected_files and rate > 0:
+            remaining = max(self.expected_files - self.files, 0) / rate
+            line += f"  ETA {format_seconds(remaining)}"
+        line += f"  hashed {format_bytes(self.bytes_hashed)} ({format_bytes(self.bytes_hashed / elapsed)}/s)"
+        line += f"  db ops {self.db_ops:,}"
+        sys.stderr.write(f"\r{line}\x1b[K")
+        sys.stderr.flush()
+        self.progress_shown = True
+
+    def clear_progress(self):
+        """
+        Remove the progress line, so other output can be written to the terminal. It is drawn again on
+        the next tick.
+        """
+        if self.progress_shown:
+            sys.stderr.write("\r\x1b[K")
+            sys.stderr.flush()
+            self.progress_shown = False
+            self.last_progress = 0.0
+
+    def summary(self):
+        """
+        :return: a dictionary of everything measured, suitable for writing out as JSON
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'files': self.files,
+            'files_per_second': round(self.files / elapsed, 1),
+            'files_hashed': self.files_hashed,
+            'bytes_hashed': self.bytes_hashed,
+            'bytes_hashed_per_second': round(self.bytes_hashed / elapsed, 1),
+            'db_ops': self.db_ops,
+            'db_ops_per_second': round(self.db_ops / elapsed, 1),
+            'phase_seconds': {phase: round(seconds, 3) for phase, seconds in self.phase_seconds.items()}
+        }
+
+    def print_summary(self, stream=None):
+        """
+        Write the timing summary, as text, to stderr (or the given stream)
+        """
+        self.clear_progress()
+        stream = stream or sys.stderr
+        summary = self.summary()
+        stream.write("\nTiming:\n")
+        stream.write(f"\telapsed: {summary['elapsed_seconds']:,.3f} s\n")
+        stream.write(f"\tfiles walked: {summary['files']:,} ({summary['files_per_second']:,.0f}/s)\n")
+        stream.write(f"\tfiles hashed: {summary['files_hashed']:,}, {format_bytes(summary['bytes_hashed'])}"
+                     f" ({format_bytes(summary['bytes_hashed_per_second'])}/s)\n")
+        stream.write(f"\tdatabase operations: {summary['db_ops']:,} ({summary['db_ops_per_second']:,.0f}/s)\n")
+        for phase, seconds in summary['phase_seconds'].items():
+            stream.write(f"\ttime in {phase}: {seconds:,.3f} s\n")
+        stream.write("\n")
+        stream.flush()
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write("\n")
+
+
+# the metrics for the run. There is only ever one run per process.
+METRICS = Metrics()
+
+
+def timed(phase, count=True):
+    """
+    Decorator that adds the time spent in a function to a phase of METRICS, while metrics are enabled.
+    A call to a function timed as 'sql' also counts as a database operation, unless it was made from
+    inside another one, so a query is counted once however many timed methods it goes through.
+    :param phase: the phase to add the time to
+    :     count: False for a function that counts its own database operations, such as the rows it writes
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            if phase == 'sql' and count and not METRICS.local.__dict__.get(phase):
+                METRICS.add_db_ops(1)
+            with METRICS.timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1000:
+            return f"{count:,.1f} {unit}"
+        count /= 1000
+    return f"{count:,.1f} TB"
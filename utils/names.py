@@ -0,0 +1,85 @@
+#!/usr/local/bin/python3
+
+import math
+import os
+import re
+import unicodedata
+
+# how alike two names must be, as the share of their trigrams they have in common, to be a near match
+SIMILARITY = 0.7
+
+# the ways file names can be matched: exact, or similar names, including copies and case variants
+NAME_MODES = ('exact', 'fuzzy')
+
+# the most near matches kept for any one name, best first
+MAX_SIMILAR = 20
+
+# the longest file name stem the trigram index covers. No file system allows names this long.
+MAX_NAME_LENGTH = 1024
+
+# the marks file managers, browsers and sync tools add to the name of a copy: "name (1)", "name - Copy",
+# "name - Copy (2)", "name copy 3", "name_copy", and "Copy of name"
+COPY_SUFFIX = re.compile(r'(?:\s*\(\d+\)|[\s_-]+copy(?:\s*\(?\d+\)?)?)+$')
+COPY_PREFIX = re.compile(r'^copy (?:\(\d+\) )?of ')
+
+# runs of spaces and punctuation that separate the words of a name
+SEPARATORS = re.compile(r'[\s_.\-]+')
+
+
+def name_mode(value):
+    """
+    Option converter for --names
+    :param value: the value given on the command line
+    :return: the name matching mode
+    """
+    if value not in NAME_MODES:
+        raise ValueError(f"must be one of {', '.join(NAME_MODES)}")
+    return value
+
+
+def normalize_name(filename):
+    """
+    Reduce a file name to the form copies of the same file are likely to share: case folded, with any
+    copy marks taken off, and the words separated by single spaces. The extension comes first, before
+    a '/', which no file name can contain, so the names sharing an extension sort next to each other,
+    and a search can be kept to just those.
+    e.g. 'Report - Copy (2).PDF' and 'report_(1).pdf' both become 'pdf/report'
+    :param filename: the file name, without its directory
+    :return: the normalized name
+    """
+    name = unicodedata.normalize('NFC', filename).casefold()
+    stem, ext = os.path.splitext(name)
+    stem = COPY_PREFIX.sub('', stem)
+    stem = COPY_SUFFIX.sub('', stem)
+    stem = SEPARATORS.sub(' ', stem).strip()
+    return f"{ext[1:]}/{stem or name}"
+
+
+def name_grams(norm_name):
+    """
+    The trigrams of the stem of a normalized name, padded with a space at either end so short names
+    still have a few. They match the ones the database triggers store in name_grams.
+    :param norm_name: a name returned by normalize_name
+    :return: a set of 3 character strings
+    """
+    stem = norm_name.split('/', 1)[1]
+    padded = f" {stem} "
+    return {padded[i:i + 3] for i in range(len(stem))}
+
+
+def min_shared(grams, threshold=SIMILARITY):
+    """
+    The fewest trigrams another name can share with this one and still be similar enough. A name that
+    shares fewer can be ruled out without looking at its own trigrams.
+    """
+    return max(1, math.ceil(len(grams) * threshold))
+
+
+def similarity(grams, other_grams):
+    """
+    :return: the Jaccard similarity of two sets of trigrams, from 0 (nothing in common) to 1 (the same)
+    """
+    if not grams and not other_grams:
+        return 1.0
+    shared = len(grams & other_grams)
+    return shared / (len(grams) + len(other_grams) - shared)
@@ -0,0 +1,252 @@
+#!/usr/local/bin/python3
+
+import csv
+import json
+import sys
+import time
+
+from utils.metrics import METRICS
+
+# the formats results can be written in
+FORMATS = ('text', 'jsonl', 'csv')
+
+# the columns of csv output. Each kind of record fills in the columns that apply to it.
+CSV_COLUMNS = ('type', 'match', 'status', 'group', 'copy', 'file', 'path', 'filesize', 'old_size', 'total_size',
+               'reclaimable', 'name', 'value')
+
+# buffered output is written out once it reaches this many characters, or has been held this long
+BUFFER_SIZE = 65536
+BUFFER_SECONDS = 0.25
+
+# how each file status is shown in text output
+STATUS_LABELS = {
+    'added': 'Added',
+    'updated': 'Updated',
+    'deleted': 'DELETED',
+    'skipped': 'skipped'
+}
+
+
+def output_format(value):
+    """
+    Option converter for --format
+    :param value: the value given on the command line
+    :return: the format name
+    """
+    if value not in FORMATS:
+        raise ValueError(f"must be one of {', '.join(FORMATS)}")
+    return value
+
+
+class Output:
+    """
+    Where the commands write their results. Lines are collected in a buffer and written out in large
+    blocks, rather than a write per line, which on big runs is most of the time spent on a terminal.
+    Results are written as the text the commands have always shown, or as one structured record per
+    line (JSON Lines or CSV), so they can be piped straight into other tools. Duplicate groups are a
+    single record in JSON Lines, and one row per file, sharing a group number, in CSV.
+    """
+
+    def __init__(self, format='text', quiet=False, only_changes=False, filename=None):
+        """
+        :param format: one of FORMATS
+        :       quiet: if True, only the summary is written
+        :only_changes: if True, files found unchanged are not listed
+        :    filename: optional file to write to, instead of stdout
+        """
+        self.format = format
+        self.quiet = quiet
+        self.only_changes = only_changes
+        self.stream = open(filename, 'w', newline='') if filename else sys.stdout
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        self.groups = 0
+        self.csv = None
+        if format == 'csv':
+            self.csv = csv.writer(self, lineterminator='\n')
+            self.csv.writerow(CSV_COLUMNS)
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= BUFFER_SIZE or time.monotonic() - self.last_flush >= BUFFER_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            # the progress line would be left in the middle of the output otherwise
+            METRICS.clear_progress()
+            self.stream.write(''.join(self.buffer))
+            self.stream.flush()
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+    def line(self, text=''):
+        self.write(text + '\n')
+
+    def record(self, kind, **fields):
+        # a structured record, in whichever of the formats is not text
+        if self.csv is not None:
+            fields['type'] = kind
+            self.csv.writerow([fields.get(column, '') for column in CSV_COLUMNS])
+        else:
+            fields = {key: value for key, value in fields.items() if value is not None}
+            self.line(json.dumps(dict(type=kind, **fields)))
+
+    def heading(self, title):
+        """
+        A section heading, shown in text output only
+        """
+        if self.format == 'text' and not self.quiet:
+            self.line(f"\n{title}\n")
+
+    def message(self, text):
+        """
+        A line of explanation, shown in text output only, e.g. that nothing was found
+        """
+        if self.format == 'text':
+            self.line(text)
+
+    def status(self, status, path, filesize=None, old_size=None):
+        """
+        What happened to a single file during an update
+        :param status: one of 'added', 'updated', 'deleted' or 'skipped'
+        :        path: the full path of the file
+        :    filesize: optional size of the file
+        :    old_size: optional size stored for the file before this update
+        """
+        if self.quiet or (self.only_changes and status == 'skipped'):
+            return
+        if self.format != 'text':
+            self.record('file', status=status, path=path, filesize=filesize, old_size=old_size)
+        elif status == 'updated':
+            self.line(f"Updated: {path}  old size = {old_size} new size = {filesize}")
+        else:
+            self.line(f"{STATUS_LABELS[status]}: {path}")
+
+    def content_group(self, copies, filesize, file=None):
+        """
+        A group of files confirmed to have the same content
+        :param copies: the full paths of the files in the group, other than file, as a list of paths for
+        :            : each copy on disk. Any paths after the first of a copy are hard links to it.
+        :    filesize: the size of each file
+        :        file: optional walked file the group was found for (check), which is not in copies
+        """
+        self.groups += 1
+        if self.quiet:
+            return
+        count = len(copies) + (1 if file else 0)
+        total_size = filesize * count
+        # every copy but one could go. Links to a copy take up no more space than it does.
+        reclaimable = filesize * (count - 1)
+        paths = [path for copy in copies for path in copy]
+        if self.format == 'csv':
+            first = 2 if file else 1
+            rows = ([(1, file)] if file else []) + \
+                [(number, path) for number, copy in enumerate(copies, first) for path in copy]
+            for number, path in rows:
+                self.record('group', match='content', group=self.groups, copy=number, file=file, path=path,
+                            filesize=filesize, total_size=total_size, reclaimable=reclaimable)
+        elif self.format == 'jsonl':
+            links = [copy for copy in copies if len(copy) > 1]
+            self.record('group', match='content', group=self.groups, file=file, paths=paths, filesize=filesize,
+                        total_size=total_size, copies=count, reclaimable=reclaimable, links=links or None)
+        elif file:
+            self.line(f"{file}: duplicates by content:")
+            for copy in copies:
+                self.line(f"\t{copy[0]}")
+                for path in copy[1:]:
+                    self.line(f"\t\t(link) {path}")
+            self.line("\n")
+        else:
+            self.line(f"\tmatches: {len(paths)}  file size: {filesize}  total size: {total_size:,}"
+                      f"  reclaimable: {reclaimable:,}")
+            for copy in copies:
+                self.line(f"\t|\t{copy[0]}")
+                for path in copy[1:]:
+                    self.line(f"\t|\t\t(link) {path}")
+            self.line()
+
+    def link_group(self, paths, filesize, file=None):
+        """
+        A group of paths that are all hard links to (or bind mounts of) the same file, so they are not
+        duplicates taking up space of their own
+        :param paths: the full paths in the group, other than file
+        :    filesize: the size of the file
+        :        file: optional walked file the group was found for (check), which is not in paths
+        """
+        self.groups += 1
+        if self.quiet:
+            return
+        if self.format == 'csv':
+            for path in ([file] if file else []) + list(paths):
+                self.record('group', match='link', group=self.groups, file=file, path=path, filesize=filesize)
+        elif self.format == 'jsonl':
+            self.record('group', match='link', group=self.groups, file=file, paths=list(paths), filesize=filesize)
+        elif file:
+            self.line(f"{file}: hard links to the same file:")
+            for path in paths:
+                self.line(f"\t{path}")
+            self.line("\n")
+        else:
+            self.line(f"\tlinks: {len(paths)}  file size: {filesize}")
+            for path in paths:
+                self.line(f"\t|\t{path}")
+            self.line()
+
+    def name_group(self, paths, name, file=None, similar=False):
+        """
+        A group of files that share a file name, but have not been compared by content
+        :param paths: the full paths of the files in the group, other than file
+        :        name: the file name they share
+        :        file: optional walked file the group was found for (check), which is not in paths
+        :     similar: if True, the names are only alike (--names fuzzy), and name is the first of them
+        """
+        self.groups += 1
+        if self.quiet:
+            return
+        match = 'similar_name' if similar else 'name'
+        if self.format == 'csv':
+            for path in ([file] if file else []) + list(paths):
+                self.record('group', match=match, group=self.groups, file=file, path=path, name=name)
+        elif self.format == 'jsonl':
+            self.record('group', match=match, group=self.groups, file=file, paths=list(paths), name=name)
+        elif file:
+            self.line(f"{file}: possible matches {'by similar ' if similar else ''}file name:")
+            for path in paths:
+                self.line(f"\t{path}")
+            self.line("\n")
+        else:
+            self.line(f"\tmatches: {len(paths)}  {'similar to' if similar else 'file name'}: {name}")
+            for path in paths:
+                self.line(f"\t|\t{path}")
+            self.line()
+
+    def summary(self, items):
+        """
+        The totals at the end of a run
+        :param items: list of (label, value) tuples. In text output a None in the list is a blank line.
+        :           : In structured output each label becomes the key, e.g. 'Total files' is total_files
+        """
+        if self.format == 'text':
+            self.line()
+            for item in items:
+                self.line(f"{item[0]}: {item[1]:,}" if item else '')
+            self.line()
+        elif self.format == 'jsonl':
+            self.record('summary', **{summary_key(item[0]): item[1] for item in items if item})
+        else:
+            for item in items:
+                if item:
+                    self.record('summary', name=summary_key(item[0]), value=item[1])
+
+
+def summary_key(label):
+    return label.lower().replace(' ', '_')
@@ -0,0 +1,152 @@
+#!/usr/local/bin/python3
+
+import queue
+import threading
+
+# number of items each queue between two stages holds. A stage that gets this far ahead of the next
+# one waits, so memory stays bounded and the slowest stage sets the pace.
+PIPELINE_DEPTH = 4
+
+# how often a stage waiting on a full or empty queue looks to see if the run has been cancelled
+POLL_SECONDS = 0.1
+
+# put on a queue after a stage's last item
+_DONE = object()
+
+
+class CancelToken:
+    """
+    Shared by every stage of a run, so any of them, or the caller, can stop it. Each stage stops before
+    its next item once the token is cancelled.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+
+class Pipeline:
+    """
+    Runs a chain of stages, each on a thread of its own, with a bounded queue between each stage and
+    the next, so the file system work of one stage overlaps the database or hashing work of another.
+    The first stage is a source, an iterable producing the items. Every stage after it is a function
+    called with each item in turn, returning the item handed on to the next. Items are handed back to
+    the calling thread in the order the source produced them, so whatever the caller does with them,
+    e.g. writing to the database, is only ever done from the one thread.
+    If any stage raises, or the caller stops taking items, the run is cancelled, and the error raised
+    again on the calling thread.
+    """
+
+    def __init__(self, source, cancel=None, depth=PIPELINE_DEPTH):
+        """
+        :param source: an iterable of items, iterated over on a thread of its own
+        :      cancel: optional CancelToken, to be able to stop the run from elsewhere
+        :       depth: the number of items each queue holds
+        """
+        self.source = source
+        self.cancel = cancel if cancel is not None else CancelToken()
+        self.depth = depth
+        self.stages = []
+        self.threads = []
+        self.error = None
+
+    def stage(self, function):
+        """
+        Add a stage to the end of the chain. If function has a close method, it is called on the stage's
+        thread once the stage is done, so the stage can hold on to things that belong to its thread,
+        such as a database connection.
+        :param function: called with each item, returning the item for the next stage
+        :return: the Pipeline, so calls can be chained
+        """
+        self.stages.append(function)
+        return self
+
+    def put(self, items, item):
+        # waits for room, unless the run is cancelled while waiting
+        while not self.cancel.cancelled:
+            try:
+                items.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def take(self, items):
+        """
+        :return: a generator of the items on a queue, up to the last one, or until the run is cancelled
+        """
+        while not self.cancel.cancelled:
+            try:
+                item = items.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def fail(self, err):
+        if self.error is None:
+            self.error = err
+        self.cancel.cancel()
+
+    def produce(self, output):
+        items = iter(self.source)
+        try:
+            for item in items:
+                if not self.put(output, item):
+                    break
+        except BaseException as err:
+            self.fail(err)
+        finally:
+            # closing the source lets a generator, such as the walk, stop its own threads
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+            self.put(output, _DONE)
+
+    def transform(self, function, input, output):
+        try:
+            for item in self.take(input):
+                if not self.put(output, function(item)):
+                    break
+        except BaseException as err:
+            self.fail(err)
+        finally:
+            close = getattr(function, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except BaseException as err:
+                    self.fail(err)
+            self.put(output, _DONE)
+
+    def run(self):
+        """
+        Start every stage, and hand back the items coming out of the last one
+        :return: a generator of items
+        """
+        queues = [queue.Queue(maxsize=self.depth) for _ in range(len(self.stages) + 1)]
+        self.threads = [threading.Thread(target=self.produce, args=(queues[0],), daemon=True)]
+        for index, function in enumerate(self.stages):
+            self.threads.append(threading.Thread(target=self.transform, args=(function, queues[index], \
+                                                                            queues[index + 1]), daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+        try:
+            yield from self.take(queues[-1])
+        except BaseException:
+            # the caller failed on an item, or was interrupted. Its error is the one raised.
+            self.cancel.cancel()
+            raise
+        finally:
+            for thread in self.threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,108 @@
+#!/usr/local/bin/python3
+
+import sys
+
+# what --profile measures: cpu runs the command under cProfile, memory under tracemalloc
+PROFILE_MODES = ('cpu', 'memory')
+
+# the number of functions, or lines allocating memory, listed in a report
+PROFILE_LINES = 40
+
+# the number of stack frames tracemalloc keeps for each allocation. More makes the report point
+# further up the call chain, at a cost in speed.
+TRACE_FRAMES = 1
+
+
+def split_profile_options(parameters):
+    """
+    Take the --profile and --profile-output options out of the command line, wherever they are, so they
+    can be given to any command without every command having to accept them.
+    --profile takes an optional mode, as --profile=memory. On its own it means cpu.
+    :param parameters: the parameters from the command line, after the utility name
+    :return: a tuple of (the remaining parameters, mode or None, output file name or None). Raises a
+    :      : ValueError for a mode that is not one of PROFILE_MODES, or a missing file name.
+    """
+    remaining = []
+    mode = None
+    output = None
+    params = iter(parameters)
+    for param in params:
+        name, sep, value = param.partition('=')
+        if name == '--profile':
+            mode = value if sep else 'cpu'
+            if mode not in PROFILE_MODES:
+                raise ValueError(f"--profile must be one of {', '.join(PROFILE_MODES)}")
+        elif name == '--profile-output':
+            output = value if sep else next(params, None)
+            if not output:
+                raise ValueError("option --profile-output requires a value")
+        else:
+            remaining.append(param)
+    return remaining, mode, output
+
+
+def run_profiled(function, mode, output=None):
+    """
+    Run a function under cProfile or tracemalloc, and write a report on it once it is done, even if
+    it is interrupted or fails.
+    :param function: the function to run, with no arguments
+    :          mode: one of PROFILE_MODES
+    :        output: optional file to write the report to, instead of stderr. For cpu, a file name
+    :              : ending in .prof gets the raw profile instead, for pstats or other viewers.
+    :return: whatever the function returns
+    """
+    if mode == 'memory':
+        import tracemalloc
+        tracemalloc.start(TRACE_FRAMES)
+        try:
+            return function()
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            write_report(output, lambda stream: memory_report(stream, snapshot, current, peak))
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        if output is not None and output.endswith('.prof'):
+            profiler.dump_stats(output)
+        else:
+            write_report(output, lambda stream: cpu_report(stream, profiler))
+
+
+def write_report(output, report):
+    if output is None:
+        report(sys.stderr)
+        sys.stderr.flush()
+        return
+    with open(output, 'w') as stream:
+        report(stream)
+
+
+def cpu_report(stream, profiler):
+    """
+    Write the functions that took the most time, counting what they called, and then counting only
+    their own code
+    """
+    import pstats
+    stats = pstats.Stats(profiler, stream=stream)
+    stream.write("\nProfile, by cumulative time:\n")
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    stream.write("\nProfile, by time in the function itself:\n")
+    stats.sort_stats('tottime').print_stats(PROFILE_LINES)
+
+
+def memory_report(stream, snapshot, current, peak):
+    """
+    Write the peak memory use, and the lines holding the most memory when the command finished
+    """
+    stream.write(f"\nMemory: peak {peak:,} bytes, {current:,} bytes still allocated at the end\n")
+    stream.write("\nLargest allocations still held, by line:\n")
+    for stat in snapshot.statistics('lineno')[:PROFILE_LINES]:
+        stream.write(f"\t{stat}\n")
+    stream.write("\n")
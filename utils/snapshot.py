@@ -0,0 +1,375 @@
+#!/usr/local/bin/python3
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import groupby
+
+# the first bytes of every snapshot file, followed by the version of the layout
+MAGIC = b'DUPESNAP'
+SNAPSHOT_VERSION = 1
+
+# the header: magic, version, number of sections, number of directories, number of files. A table of
+# sections follows it, each entry giving a section's name, and its offset and length in bytes.
+HEADER = struct.Struct('<8sIIQQ')
+SECTION = struct.Struct('<16sQQ')
+
+# every section starts on a multiple of this many bytes, so each column can be used straight from the
+# memory map as an array
+ALIGNMENT = 8
+
+# stands in for NULL in the integer columns
+NULL = -2 ** 63
+
+# the size of the raw digests stored, and what is stored for a missing one
+HASH_SIZE = 20
+NO_HASH = bytes(HASH_SIZE)
+
+# the bits of the file_hashes column, saying which of the file's digests are stored
+HAS_PARTIAL = 1
+HAS_FULL = 2
+
+# the sections, in the order they are written, with the array typecode of each. Every column is a
+# packed little endian array, one entry per directory or file. Directory paths and file names are
+# stored end to end in a single blob each, with the offset each one ends at, and each file refers to
+# its directory by index, so a path is only stored once however many files are in it.
+SECTIONS = (
+    ('dir_parent', 'q'),
+    ('dir_mtime', 'q'),
+    ('dir_file_count', 'q'),
+    ('dir_path_ends', 'q'),
+    ('dir_paths', 'B'),
+    ('file_dir', 'i'),
+    ('file_size', 'q'),
+    ('file_mtime', 'q'),
+    ('file_inode', 'q'),
+    ('file_device', 'q'),
+    ('file_hashes', 'B'),
+    ('file_partial', 'B'),
+    ('file_full', 'B'),
+    ('file_name_ends', 'q'),
+    ('file_names', 'B')
+)
+TYPECODES = dict(SECTIONS)
+
+# number of rows loaded into the database at a time by import_snapshot
+LOAD_ROWS = 1000
+
+
+class SnapshotError(Exception):
+    """
+    Raised for a file that is not a snapshot, or is one of a layout this version cannot read
+    """
+    pass
+
+
+def is_snapshot(filename):
+    """
+    :return: True if the file starts the way a snapshot does
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _int(value):
+    return NULL if value is None else value
+
+
+def _value(value):
+    return None if value == NULL else value
+
+
+def _digest(value):
+    # the raw bytes of a stored hex digest, or None for a missing (or unrecognized) one
+    if value is None or len(value) != HASH_SIZE * 2:
+        return None
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
+
+
+def _encode(text):
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def export_snapshot(file_db, filename):
+    """
+    Write every directory and file in the database to a snapshot file. The file is written under a
+    temporary name first, so an interrupted export never leaves a partial snapshot behind.
+    :param file_db: the FileDatabase object to export
+    :     filename: the snapshot file to write
+    :return: a tuple of the number of (directories, files, bytes) written
+    """
+    columns = {name: array(typecode) for name, typecode in SECTIONS}
+    dir_index = dict()
+    for id, parent_id, path, mtime, file_count in file_db.iter_dirs():
+        dir_index[id] = len(dir_index)
+        columns['dir_parent'].append(dir_index.get(parent_id, -1))
+        columns['dir_mtime'].append(_int(mtime))
+        columns['dir_file_count'].append(_int(file_count))
+        columns['dir_paths'].frombytes(_encode(path))
+        columns['dir_path_ends'].append(len(columns['dir_paths']))
+
+    files = 0
+    for dir_id, name, filesize, mtime, inode, device, partial, full in file_db.iter_all_files():
+        files += 1
+        columns['file_dir'].append(dir_index[dir_id])
+        columns['file_size'].append(filesize)
+        columns['file_mtime'].append(_int(mtime))
+        columns['file_inode'].append(_int(inode))
+        columns['file_device'].append(_int(device))
+        partial = _digest(partial)
+        full = _digest(full)
+        columns['file_hashes'].append((HAS_PARTIAL if partial else 0) | (HAS_FULL if full else 0))
+        columns['file_partial'].frombytes(partial or NO_HASH)
+        columns['file_full'].frombytes(full or NO_HASH)
+        columns['file_names'].frombytes(_encode(name))
+        columns['file_name_ends'].append(len(columns['file_names']))
+
+    table = []
+    offset = _aligned(HEADER.size + SECTION.size * len(SECTIONS))
+    for name, _ in SECTIONS:
+        length = len(columns[name]) * columns[name].itemsize
+        table.append((name, offset, length))
+        offset = _aligned(offset + length)
+
+    temp = f"{filename}.tmp"
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, SNAPSHOT_VERSION, len(SECTIONS), len(dir_index), files))
+        for name, start, length in table:
+            f.write(SECTION.pack(name.encode(), start, length))
+        for name, start, length in table:
+            f.write(bytes(start - f.tell()))
+            column = columns[name]
+            if sys.byteorder == 'big':
+                column.byteswap()
+            column.tofile(f)
+        f.write(bytes(offset - f.tell()))
+    os.replace(temp, filename)
+    return len(dir_index), files, offset
+
+
+class Snapshot:
+    """
+    A snapshot file, memory mapped, so nothing is read from it until it is used, and the operating
+    system can share and drop its pages as it likes. Each column is a memoryview straight onto the map.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            self.file.close()
+            raise SnapshotError(f"{filename} is not a snapshot")
+        self.views = []
+        try:
+            magic, version, sections, self.dir_count, self.file_count = HEADER.unpack_from(self.map)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError(f"{filename} is not a snapshot")
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise SnapshotError(f"{filename} is a version {version} snapshot, which this version cannot read")
+
+        self.sections = dict()
+        try:
+            for index in range(sections):
+                name, offset, length = SECTION.unpack_from(self.map, HEADER.size + SECTION.size * index)
+                if offset + length > len(self.map):
+                    # the section runs past the end of the file
+                    raise struct.error
+                self.sections[name.rstrip(b'\0').decode()] = (offset, length)
+        except struct.error:
+            self.close()
+            raise SnapshotError(f"{filename} is truncated")
+        try:
+            self.columns = {name: self.column(name) for name in TYPECODES}
+        except KeyError as err:
+            self.close()
+            raise SnapshotError(f"{filename} has no {err.args[0]} section")
+        self.dir_paths = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def column(self, name):
+        offset, length = self.sections[name]
+        view = memoryview(self.map)[offset:offset + length]
+        self.views.append(view)
+        if sys.byteorder == 'big' and TYPECODES[name] != 'B':
+            # the columns are little endian, so on a big endian machine they are copied and swapped
+            column = array(TYPECODES[name], view.tobytes())
+            column.byteswap()
+            return column
+        view = view.cast(TYPECODES[name])
+        self.views.append(view)
+        return view
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.columns = dict()
+        try:
+            self.map.close()
+        except BufferError:
+            # an array made from the map is still in use. The map is closed along with it.
+            pass
+        self.file.close()
+
+    def _text(self, blob, ends, index):
+        start = self.columns[ends][index - 1] if index else 0
+        return bytes(self.columns[blob][start:self.columns[ends][index]]).decode('utf-8', 'surrogateescape')
+
+    def dir_path(self, index):
+        path = self.dir_paths.get(index)
+        if path is None:
+            path = self._text('dir_paths', 'dir_path_ends', index)
+            self.dir_paths[index] = path
+        return path
+
+    def file_name(self, index):
+        return self._text('file_names', 'file_name_ends', index)
+
+    def hashes(self, index):
+        """
+        :return: a tuple of the (partial, full) hex digests stored for a file, None for either one missing
+        """
+        flags = self.columns['file_hashes'][index]
+        start = index * HASH_SIZE
+        partial = self.columns['file_partial'][start:start + HASH_SIZE].hex() if flags & HAS_PARTIAL else None
+        full = self.columns['file_full'][start:start + HASH_SIZE].hex() if flags & HAS_FULL else None
+        return partial, full
+
+    def candidate(self, index):
+        """
+        :return: a Candidate for a file, carrying any hashes stored for it
+        """
+        # only report needs Candidates, so export and import do not load the hashing
+        from utils.hashing import Candidate
+        partial, full = self.hashes(index)
+        columns = self.columns
+        return Candidate(self.dir_path(columns['file_dir'][index]), self.file_name(index), columns['file_size'][index],
+                         partial, full, _value(columns['file_device'][index]), _value(columns['file_inode'][index]))
+
+    def iter_dirs(self):
+        """
+        :return: a generator of (index, parent index, path, mtime, file_count) tuples, parent index being
+        :      : None for a directory with no parent stored
+        """
+        columns = self.columns
+        for index in range(self.dir_count):
+            parent = columns['dir_parent'][index]
+            yield index, None if parent < 0 else parent, self.dir_path(index), \
+                _value(columns['dir_mtime'][index]), _value(columns['dir_file_count'][index])
+
+    def iter_files(self):
+        """
+        :return: a generator of (dir index, filename, filesize, mtime, inode, device, partial_hash,
+        :      : full_hash) tuples, the hashes as hex digests
+        """
+        columns = self.columns
+        for index in range(self.file_count):
+            yield (columns['file_dir'][index], self.file_name(index), columns['file_size'][index],
+                   _value(columns['file_mtime'][index]), _value(columns['file_inode'][index]),
+                   _value(columns['file_device'][index])) + self.hashes(index)
+
+
+def import_snapshot(snapshot, file_db):
+    """
+    Load every directory and file of a snapshot into an empty database, along with their hashes, so
+    a database can be rebuilt without walking the tree again
+    :param snapshot: the Snapshot to load
+    :       file_db: the FileDatabase object, freshly cleaned up
+    :return: a tuple of the number of (directories, files) loaded
+    """
+    rows = []
+    for index, parent, path, mtime, file_count in snapshot.iter_dirs():
+        # ids start at 1, as SQLite's would
+        rows.append((index + 1, None if parent is None else parent + 1, path, mtime, file_count))
+        if len(rows) >= LOAD_ROWS:
+            file_db.load_dirs(rows)
+            rows = []
+    file_db.load_dirs(rows)
+
+    rows = []
+    for row in snapshot.iter_files():
+        rows.append((row[0] + 1,) + row[1:])
+        if len(rows) >= LOAD_ROWS:
+            file_db.load_files(rows)
+            rows = []
+    file_db.load_files(rows)
+    file_db.commit()
+    return snapshot.dir_count, snapshot.file_count
+
+
+def _numpy():
+    # numpy is optional. With it, the duplicate grouping over a snapshot is done on whole columns at once.
+    # It takes longer to import than the rest of this utility put together, so it is only looked for here.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def size_groups(snapshot, min_total=0):
+    """
+    Find the files of a snapshot that share their size with another, the groups with the largest total
+    size first, as find_size_groups does for a database. With numpy, the sizes column is sorted and
+    split into runs of the same size as a whole, straight from the memory map. Without it, only the
+    file indexes are sorted, on the sizes in the map.
+    :param snapshot: the Snapshot to search
+    :     min_total: groups whose sizes add up to less than this many bytes are left out
+    :return: a list of sequences of file indexes, one per size
+    """
+    if snapshot.file_count == 0:
+        return []
+    numpy = _numpy()
+    if numpy is not None:
+        offset, _ = snapshot.sections['file_size']
+        sizes = numpy.frombuffer(snapshot.map, dtype='<i8', count=snapshot.file_count, offset=offset)
+        order = numpy.argsort(sizes, kind='stable')
+        ordered = sizes[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ordered[1:] != ordered[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(ordered)))
+        group_sizes = ordered[starts]
+        totals = group_sizes * counts
+        keep = numpy.flatnonzero((counts > 1) & (totals >= (min_total or 0)))
+        keep = keep[numpy.lexsort((group_sizes[keep], -totals[keep]))]
+        return [order[starts[index]:starts[index] + counts[index]] for index in keep]
+
+    sizes = snapshot.columns['file_size']
+    groups = []
+    for size, members in groupby(sorted(range(snapshot.file_count), key=sizes.__getitem__), key=sizes.__getitem__):
+        members = list(members)
+        if len(members) > 1 and size * len(members) >= (min_total or 0):
+            groups.append((size * len(members), size, members))
+    groups.sort(key=lambda group: (-group[0], group[1]))
+    return [members for _, _, members in groups]
+
+
+def size_group_candidates(snapshot, groups):
+    """
+    Generator that turns the groups found by size_groups into groups of Candidates, one group per size
+    """
+    for members in groups:
+        yield [snapshot.candidate(int(index)) for index in members]
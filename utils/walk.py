@@ -0,0 +1,339 @@
+#!/usr/local/bin/python3
+
+import fnmatch
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque, namedtuple
+
+from utils.metrics import METRICS
+
+# the info kept for each file found by the walk. The field order matches the snapshot table, so a batch
+# of records can be handed straight to executemany
+FileRecord = namedtuple('FileRecord', ['filedir', 'filename', 'filesize', 'mtime', 'inode', 'device'])
+
+# the result of visiting one directory. mtime is the directory's own st_mtime_ns, taken before it was
+# listed. If unchanged is True the directory was not listed at all: its mtime matched the one stored
+# for it, so files is empty and file_count and subdirs are the ones stored. If resumed is True the
+# directory was already listed by an interrupted run being resumed, and only its subdirs are filled in.
+DirListing = namedtuple('DirListing', ['path', 'files', 'subdirs', 'mtime', 'file_count', 'unchanged', 'resumed'])
+
+# number of FileRecords handed back by the walk at a time
+BATCH_SIZE = 1000
+
+# number of directory listings the walker threads may get ahead of whoever is consuming them
+LISTINGS_PER_THREAD = 16
+
+# file names that are always skipped, e.g. '.DS_Store' for Mac native
+DEFAULT_EXCLUDE = ('.DS_Store',)
+
+
+class WalkFilter:
+    """
+    Decides which files and directories a walk skips. Plain names are checked with a set lookup, and
+    any wildcard patterns are compiled into a single regular expression, so the cost per entry stays
+    the same no matter how many exclusions are given.
+    """
+
+    def __init__(self, exclude=DEFAULT_EXCLUDE, prune=()):
+        """
+        :param exclude: file names, or wildcard patterns (e.g. '*.tmp'), of files to skip
+        :        prune: directory names, or wildcard patterns, of directories to skip entirely, along
+        :             : with everything below them (e.g. '.git')
+        """
+        self.exclude_names, self.exclude_pattern = self._compile(exclude)
+        self.prune_names, self.prune_pattern = self._compile(prune)
+        # the same for any two filters that skip the same things, however the options were given
+        self.key = '\0'.join(sorted(set(exclude))) + '\n' + '\0'.join(sorted(set(prune)))
+
+    @staticmethod
+    def _compile(patterns):
+        names = set()
+        wildcards = []
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                wildcards.append(fnmatch.translate(pattern))
+            else:
+                names.add(pattern)
+        return names, re.compile('|'.join(wildcards)) if wildcards else None
+
+    def skip_file(self, name):
+        if name in self.exclude_names:
+            return True
+        return self.exclude_pattern is not None and self.exclude_pattern.match(name) is not None
+
+    def skip_dir(self, name):
+        if name in self.prune_names:
+            return True
+        return self.prune_pattern is not None and self.prune_pattern.match(name) is not None
+
+
+def visit_dir(path, walk_filter, known_dirs=None, ordered=False, done_dirs=None):
+    """
+    Visit a single directory of the walk. The directory's mtime is taken first, so anything that changes
+    while it is being listed makes the mtime differ next time. If the directory is in known_dirs with
+    the same mtime, nothing can have been added, removed or renamed in it, so it is not listed again.
+    :param path: the directory to visit
+    :   walk_filter: the WalkFilter deciding what to skip
+    :    known_dirs: optional dictionary of directory path to (mtime, file_count, list of subdirectory
+    :              : paths), as stored by the last walk
+    :       ordered: if True, the files and subdirectories are sorted by name
+    :     done_dirs: optional dictionary of directory path to list of subdirectory paths, for the
+    :              : directories an interrupted walk has already finished with
+    :return: a DirListing
+    """
+    if done_dirs is not None and path in done_dirs:
+        return DirListing(path, [], done_dirs[path], None, 0, False, True)
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    if known_dirs is not None and mtime is not None:
+        known = known_dirs.get(path)
+        if known is not None and known[0] == mtime:
+            # the stored subdirectories are filtered again, in case a directory is pruned now that was not
+            # before. Ones pruned before are not stored, so the caller walks everything again once the
+            # filter has changed, rather than passing in known_dirs.
+            subdirs = [subdir for subdir in known[2] if not walk_filter.skip_dir(os.path.basename(subdir))]
+            if ordered:
+                subdirs.sort()
+            return DirListing(path, [], subdirs, mtime, known[1], True, False)
+
+    files, subdirs = scan_dir(path, walk_filter)
+    if ordered:
+        files.sort()
+        subdirs.sort()
+    return DirListing(path, files, subdirs, mtime, len(files), False, False)
+
+
+def scan_dir(path, walk_filter):
+    """
+    List a single directory with os.scandir. The file type comes from the directory listing itself, so
+    only the files need a stat, and pruned directories and excluded files need none at all.
+    Like os.walk, symbolic links to directories are not followed, while symbolic links to files are
+    recorded with the details of the file they point to. Entries that vanish, or cannot be read, while
+    being listed are skipped.
+    :param path: the directory to list
+    :   walk_filter: the WalkFilter deciding what to skip
+    :return: a tuple of (list of FileRecords, list of subdirectory paths to descend into)
+    """
+    files = []
+    subdirs = []
+    timing = METRICS.enabled
+    stat_seconds = 0.0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not walk_filter.skip_dir(entry.name):
+                            subdirs.append(entry.path)
+                        continue
+                    if walk_filter.skip_file(entry.name):
+                        continue
+                    if timing:
+                        start = time.perf_counter()
+                        statinfo = entry.stat()
+                        stat_seconds += time.perf_counter() - start
+                    else:
+                        statinfo = entry.stat()
+                except OSError:
+                    continue
+                files.append(FileRecord(path, entry.name, statinfo.st_size, statinfo.st_mtime_ns,
+                                        statinfo.st_ino, statinfo.st_dev))
+    except OSError:
+        pass
+    if timing:
+        METRICS.add_time('stat', stat_seconds)
+    return files, subdirs
+
+
+class ParallelWalk:
+    """
+    Lists the directories of a tree on several threads at once. On NFS and large RAID volumes the time
+    goes on readdir and stat round trips rather than bandwidth, so keeping many of them in flight
+    makes the walk scale with the number of threads.
+    Each thread keeps its own deque of directories still to list. It takes from the back of its own
+    (so it works depth first, close to what it just listed), and when that runs dry it steals from the
+    front of the others, where the biggest untouched parts of the tree are.
+    Listings are handed back through a bounded queue, so the threads cannot run arbitrarily far ahead
+    of a slow consumer.
+    """
+
+    def __init__(self, directory, walk_filter, threads, ordered=False, known_dirs=None, done_dirs=None):
+        self.walk_filter = walk_filter
+        self.ordered = ordered
+        self.known_dirs = known_dirs
+        self.done_dirs = done_dirs
+        self.deques = [deque() for _ in range(threads)]
+        self.deques[0].append(directory)
+        # directories queued or being listed. The walk is done when this gets back to zero.
+        self.outstanding = 1
+        self.condition = threading.Condition()
+        self.listings = queue.Queue(maxsize=threads * LISTINGS_PER_THREAD)
+        self.stop = threading.Event()
+
+    def next_dir(self, index):
+        """
+        Get the next directory for a thread to list, stealing one if its own deque is empty
+        :param index: the thread's index
+        :return: a directory path, or None when the walk is finished (or stopped)
+        """
+        count = len(self.deques)
+        while not self.stop.is_set():
+            try:
+                return self.deques[index].pop()
+            except IndexError:
+                pass
+            for offset in range(1, count):
+                try:
+                    return self.deques[(index + offset) % count].popleft()
+                except IndexError:
+                    continue
+            with self.condition:
+                if self.outstanding == 0:
+                    return None
+                self.condition.wait(0.05)
+        return None
+
+    def put(self, item):
+        # waits for room in the listings queue, unless the walk is stopped while waiting
+        while not self.stop.is_set():
+            try:
+                self.listings.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def work(self, index):
+        try:
+            while True:
+                path = self.next_dir(index)
+                if path is None:
+                    break
+                listing = visit_dir(path, self.walk_filter, self.known_dirs, self.ordered, self.done_dirs)
+                with self.condition:
+                    self.outstanding += len(listing.subdirs)
+                # reversed, so this thread lists them in the order they were found
+                self.deques[index].extend(reversed(listing.subdirs))
+                self.put(listing)
+                with self.condition:
+                    self.outstanding -= 1
+                    self.condition.notify_all()
+        except Exception as err:
+            self.put(err)
+        finally:
+            self.put(None)
+
+    def run(self):
+        """
+        Start the threads, and hand back the listings as they complete
+        :return: a generator of DirListings
+        """
+        threads = [threading.Thread(target=self.work, args=(index,), daemon=True) \
+                   for index in range(len(self.deques))]
+        for thread in threads:
+            thread.start()
+
+        finished = 0
+        try:
+            while finished < len(threads):
+                item = self.listings.get()
+                if item is None:
+                    finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop.set()
+
+
+def walk_listings(directory, walk_filter, ordered=False, known_dirs=None, done_dirs=None):
+    """
+    List a tree, one directory at a time, top down on the calling thread
+    :return: a generator of DirListings
+    """
+    stack = [directory]
+    while stack:
+        listing = visit_dir(stack.pop(), walk_filter, known_dirs, ordered, done_dirs)
+        # reversed, so the subdirectories are walked in the order they were listed
+        stack.extend(reversed(listing.subdirs))
+        yield listing
+
+
+def in_walk_order(directory, listings):
+    """
+    Put directory listings that complete in any order back into the top down order a single threaded
+    walk would have produced. Only the listings that finish ahead of their turn are held on to.
+    :param directory: the top of the tree
+    :       listings: an iterable of DirListings, in any order
+    :return: a generator of DirListings, in walk order
+    """
+    done = dict()
+    order = [directory]
+    for listing in listings:
+        done[listing.path] = listing
+        while order and order[-1] in done:
+            listing = done.pop(order.pop())
+            order.extend(reversed(listing.subdirs))
+            yield listing
+
+
+def scan_tree(directory, walk_filter=None, batch_size=BATCH_SIZE, threads=1, ordered=False, known_dirs=None,
+              on_dir=None, done_dirs=None):
+    """
+    Walk a directory tree, handing back the files found in batches.
+    :param directory: the top of the tree to walk
+    :    walk_filter: optional WalkFilter. Defaults to skipping only the DEFAULT_EXCLUDE names
+    :     batch_size: the (maximum) number of FileRecords in each batch
+    :        threads: the number of threads listing directories at once. With 1, the walk is done
+    :               : top down on the calling thread.
+    :        ordered: if True, the files come back sorted by directory (top down) and by name,
+    :               : the same no matter how many threads are used. Otherwise a multi threaded walk
+    :               : hands back each directory as soon as it is listed.
+    :     known_dirs: optional dictionary of directory path to (mtime, file_count, list of subdirectory
+    :               : paths). Directories whose mtime still matches are not listed again, and their
+    :               : stored subdirectories are walked instead.
+    :         on_dir: optional function called with the DirListing of every directory visited, on the
+    :               : thread consuming the generator, before any of that directory's files are handed back
+    :      done_dirs: optional dictionary of directory path to list of subdirectory paths. These
+    :               : directories were finished by an interrupted walk, so they are not listed, and are
+    :               : not passed to on_dir, but their stored subdirectories are walked.
+    :return: a generator of lists of FileRecords
+    """
+    if walk_filter is None:
+        walk_filter = WalkFilter()
+
+    if threads > 1:
+        listings = ParallelWalk(directory, walk_filter, threads, ordered, known_dirs, done_dirs).run()
+        if ordered:
+            listings = in_walk_order(directory, listings)
+    else:
+        listings = walk_listings(directory, walk_filter, ordered, known_dirs, done_dirs)
+
+    batch = []
+    for listing in listings:
+        if listing.resumed:
+            continue
+        if on_dir is not None:
+            on_dir(listing)
+        # the batches are sliced out of the listing by offset, so a huge directory is only copied once
+        files = listing.files
+        start = 0
+        if batch:
+            start = batch_size - len(batch)
+            batch.extend(files[:start])
+            if len(batch) < batch_size:
+                continue
+            yield batch
+        while len(files) - start >= batch_size:
+            yield files[start:start + batch_size]
+            start += batch_size
+        batch = files[start:]
+    if batch:
+        yield batch
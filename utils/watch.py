@@ -0,0 +1,478 @@
+#!/usr/local/bin/python3
+
+import errno
+import os
+import select
+import stat
+import struct
+import time
+
+from utils.walk import FileRecord, visit_dir
+
+# the ways changes can be picked up. auto uses inotify where the system has it, and polls otherwise
+BACKENDS = ('auto', 'inotify', 'poll')
+
+# a batch of changes is applied once there have been no new events for this many seconds
+DEBOUNCE_SECONDS = 2.0
+
+# while events keep coming, a batch is applied at least this often anyway
+MAX_DELAY_SECONDS = 30.0
+
+# how often the polling backend looks for changed directories
+POLL_SECONDS = 5.0
+
+# inotify event flags, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# the events watched for. Each write to a file would be an IN_MODIFY, so only the close after writing
+# is watched for instead.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# the fixed part of each event read from an inotify descriptor: wd, mask, cookie and the name's length
+EVENT = struct.Struct('iIII')
+
+
+def watch_backend(value):
+    """
+    Option converter for --backend
+    :param value: the value given on the command line
+    :return: the backend name
+    """
+    if value not in BACKENDS:
+        raise ValueError(f"must be one of {', '.join(BACKENDS)}")
+    return value
+
+
+class Changes:
+    """
+    The changes seen since the last batch was applied, coalesced, so that however many events a burst
+    of activity makes, each file or directory is only looked at once. A tree is a directory to walk in
+    full, e.g. one just created or moved in. A dir is a directory to list again, and a file a single
+    entry of a directory to look at again.
+    """
+
+    def __init__(self):
+        self.trees = set()
+        self.dirs = set()
+        self.files = dict()
+        self.first = None
+        self.last = None
+
+    def __bool__(self):
+        return bool(self.trees or self.dirs or self.files)
+
+    def touch(self):
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+
+    def add_tree(self, path):
+        self.trees.add(path)
+        self.touch()
+
+    def add_dir(self, path):
+        self.dirs.add(path)
+        self.touch()
+
+    def add_file(self, dirpath, name):
+        self.files.setdefault(dirpath, set()).add(name)
+        self.touch()
+
+    def due(self, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS):
+        """
+        :return: True once things have been quiet for debounce seconds, or the oldest change has waited
+        :      : max_delay seconds
+        """
+        if not self:
+            return False
+        now = time.monotonic()
+        return now - self.last >= debounce or now - self.first >= max_delay
+
+    def wait(self, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS):
+        """
+        :return: the seconds until the changes are due, or None if there are none to wait for
+        """
+        if not self:
+            return None
+        now = time.monotonic()
+        return max(0.0, min(self.last + debounce, self.first + max_delay) - now)
+
+
+def _list_subdirs(path, walk_filter):
+    # the subdirectories a walk of path would descend into, without a stat of any of the files
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False) and not walk_filter.skip_dir(entry.name):
+                        subdirs.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return subdirs
+
+
+class PollingBackend:
+    """
+    Finds changes by comparing the mtime of every directory to the last one seen, every POLL_SECONDS.
+    Adding, removing or renaming an entry changes the mtime of its directory, so only those directories
+    are listed again. A file rewritten in place leaves its directory's mtime alone, so this backend does
+    not see it, where inotify does.
+    """
+    name = 'poll'
+
+    def __init__(self, root, walk_filter, interval=POLL_SECONDS):
+        self.root = root
+        self.walk_filter = walk_filter
+        self.interval = interval
+        self.mtimes = dict()
+        self.next_poll = None
+
+    def start(self):
+        self.add_tree(self.root)
+        self.next_poll = time.monotonic() + self.interval
+
+    def add_tree(self, path):
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                self.mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            stack.extend(_list_subdirs(dirpath, self.walk_filter))
+
+    def read(self, changes, timeout=None):
+        """
+        Wait until the next poll is due, or timeout seconds have passed, and add whatever has changed
+        by then to changes
+        """
+        wait = self.next_poll - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(0.0, timeout))
+            return
+        time.sleep(max(0.0, wait))
+        self.next_poll = time.monotonic() + self.interval
+
+        for dirpath, mtime in list(self.mtimes.items()):
+            try:
+                current = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                # gone. Its parent's mtime has changed too, and listing that finds it missing.
+                del self.mtimes[dirpath]
+                continue
+            if current == mtime:
+                continue
+            self.mtimes[dirpath] = current
+            changes.add_dir(dirpath)
+            for subdir in _list_subdirs(dirpath, self.walk_filter):
+                if subdir not in self.mtimes:
+                    self.add_tree(subdir)
+                    changes.add_tree(subdir)
+
+    def close(self):
+        self.mtimes = dict()
+
+
+class InotifyBackend:
+    """
+    Picks up changes from the Linux kernel through inotify, read with ctypes, so nothing needs to be
+    installed. There is one watch per directory, added as directories are created or moved in.
+    If the kernel's event queue overflows, events have been lost, so the whole tree is walked again.
+    """
+    name = 'inotify'
+
+    def __init__(self, root, walk_filter):
+        self.root = root
+        self.walk_filter = walk_filter
+        self.libc = _load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        from ctypes import get_errno
+        self.get_errno = get_errno
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), "inotify_init1 failed")
+        self.paths = dict()
+        self.watches = dict()
+
+    @staticmethod
+    def available():
+        return _load_libc() is not None
+
+    def start(self):
+        self.add_tree(self.root)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR | IN_DONT_FOLLOW)
+        if wd < 0:
+            error = self.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "out of inotify watches. Raise fs.inotify.max_user_watches, or use --backend poll")
+            # the directory went away before it could be watched, which its parent's events cover
+            return
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def add_tree(self, path):
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            self.add_watch(dirpath)
+            stack.extend(_list_subdirs(dirpath, self.walk_filter))
+
+    def remove_tree(self, path):
+        # stop watching a directory moved away, and everything below it. If it was moved somewhere
+        # else in the tree, it is watched again under its new path.
+        prefix = path + os.sep
+        for dirpath in [dirpath for dirpath in self.watches if dirpath == path or dirpath.startswith(prefix)]:
+            wd = self.watches.pop(dirpath)
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, changes, timeout=None):
+        """
+        Wait for events, for up to timeout seconds, and add the changes they describe to changes
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+                offset += EVENT.size + length
+                self.event(changes, wd, mask, name)
+
+    def event(self, changes, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            changes.add_tree(self.root)
+            return
+        dirpath = self.paths.get(wd)
+        if dirpath is None:
+            return
+        if mask & IN_IGNORED:
+            # the directory itself is gone. The event on its parent covers what was in it.
+            del self.paths[wd]
+            if self.watches.get(dirpath) == wd:
+                del self.watches[dirpath]
+            return
+        if not name:
+            return
+        path = os.path.join(dirpath, name)
+        if mask & IN_ISDIR:
+            if self.walk_filter.skip_dir(name):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+                changes.add_tree(path)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self.remove_tree(path)
+                changes.add_file(dirpath, name)
+        elif not self.walk_filter.skip_file(name):
+            changes.add_file(dirpath, name)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _load_libc():
+    # the C library, if it has the inotify calls (i.e. on Linux), or None. ctypes is only imported
+    # here, as it is slow to import, and only the inotify backend needs it.
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def create_backend(name, root, walk_filter, interval=POLL_SECONDS):
+    """
+    :param name: one of BACKENDS
+    :      root: the directory to watch
+    :   walk_filter: the WalkFilter deciding what to skip
+    :      interval: the seconds between polls, for the polling backend
+    :return: a backend object, not yet started
+    """
+    if name == 'inotify' or (name == 'auto' and InotifyBackend.available()):
+        return InotifyBackend(root, walk_filter)
+    return PollingBackend(root, walk_filter, interval)
+
+
+def watch_changes(backend, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS):
+    """
+    Generator of batches of changes, each handed back once it is due. Stops on a KeyboardInterrupt,
+    after handing back whatever changes were still waiting.
+    :param backend: a started backend
+    :     debounce: the seconds without events before a batch is due
+    :    max_delay: the most seconds a change waits while events keep coming
+    :return: a generator of Changes objects
+    """
+    changes = Changes()
+    while True:
+        try:
+            backend.read(changes, changes.wait(debounce, max_delay))
+        except KeyboardInterrupt:
+            if changes:
+                yield changes
+            return
+        if changes.due(debounce, max_delay):
+            yield changes
+            changes = Changes()
+
+
+def _is_below(path, roots):
+    # True if path is one of roots, or anywhere below one of them
+    while True:
+        if path in roots:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+class ChangeApplier:
+    """
+    Brings the database in line with a batch of changes, looking only at the files and directories
+    the changes name. Each directory listed is compared to the files stored for it with a single query.
+    """
+
+    def __init__(self, file_db, walk_filter, output=None):
+        """
+        :param file_db: the FileDatabase object to update
+        :  walk_filter: the WalkFilter deciding what to skip
+        :       output: optional Output to write the status of each file added, updated or deleted to
+        """
+        self.file_db = file_db
+        self.walk_filter = walk_filter
+        self.output = output
+        self.totals = dict.fromkeys(('added', 'updated', 'deleted'), 0)
+        self.changed = []
+
+    def apply(self, changes, known_dirs=None):
+        """
+        :param changes: the Changes to apply
+        :   known_dirs: optional dictionary of stored directory states, as for scan_tree. The directories
+        :             : of trees whose mtime still matches are not listed again.
+        :return: the list of FileRecords of the files added or updated
+        """
+        self.changed = []
+        trees = {path for path in changes.trees if not _is_below(os.path.dirname(path), changes.trees)}
+        for path in sorted(trees):
+            self.reconcile(path, True, known_dirs)
+        for path in sorted(changes.dirs):
+            if not _is_below(path, trees):
+                self.reconcile(path, False)
+        for dirpath, names in sorted(changes.files.items()):
+            if _is_below(dirpath, trees) or dirpath in changes.dirs:
+                continue
+            for name in sorted(names):
+                self.check_entry(dirpath, name)
+        self.file_db.commit()
+        return self.changed
+
+    def status(self, status, path, filesize=None, old_size=None):
+        self.totals[status] += 1
+        if self.output is not None:
+            self.output.status(status, path, filesize, old_size)
+
+    def reconcile(self, path, recursive, known_dirs=None):
+        """
+        List a directory again and update the database to match. New subdirectories are walked in
+        full, and stored ones that are gone are deleted.
+        :param path: the directory
+        :  recursive: if True, every directory below it is listed again as well
+        :  known_dirs: optional dictionary of stored directory states, to skip unchanged directories
+        """
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            listing = visit_dir(dirpath, self.walk_filter, known_dirs if recursive else None)
+            if listing.mtime is None:
+                self.remove_tree(dirpath)
+                continue
+            if not listing.unchanged:
+                self.reconcile_files(dirpath, listing.files)
+                self.file_db.set_dir_state(dirpath, listing.mtime, listing.file_count)
+            stored = set(self.file_db.find_child_dirs(dirpath))
+            for subdir in stored - set(listing.subdirs):
+                self.remove_tree(subdir)
+            stack.extend(subdir for subdir in listing.subdirs if recursive or subdir not in stored)
+
+    def reconcile_files(self, dirpath, records):
+        stored = {row[1]: row for row in self.file_db.iter_files_in_dir(dirpath)}
+        for record in records:
+            self.compare(record, stored.pop(record.filename, None))
+        for name, row in stored.items():
+            self.file_db.delete(dirpath, name)
+            self.status('deleted', os.path.join(dirpath, name))
+
+    def check_entry(self, dirpath, name):
+        """
+        Look at a single entry of a directory again: a file that was written, created, removed or
+        renamed, or a directory that was removed or renamed away
+        """
+        path = os.path.join(dirpath, name)
+        try:
+            statinfo = os.stat(path)
+        except OSError:
+            statinfo = None
+        if statinfo is not None and stat.S_ISDIR(statinfo.st_mode):
+            if not os.path.islink(path) and not self.walk_filter.skip_dir(name):
+                self.reconcile(path, True)
+            return
+        if statinfo is None and self.file_db.dir_id(path, create=False) is not None:
+            self.remove_tree(path)
+            return
+        rows = self.file_db.find_specific_file(dirpath, name)
+        row = rows[0] if rows else None
+        if statinfo is None:
+            if row is not None:
+                self.file_db.delete(dirpath, name)
+                self.status('deleted', path)
+            return
+        self.compare(FileRecord(dirpath, name, statinfo.st_size, statinfo.st_mtime_ns, statinfo.st_ino,
+                                statinfo.st_dev), row)
+
+    def compare(self, record, row):
+        # the same test as update: a file has changed if its size, mtime or inode has
+        if row is None:
+            self.file_db.insert(*record)
+            self.status('added', os.path.join(record.filedir, record.filename), record.filesize)
+            self.changed.append(record)
+        elif row[2] != record.filesize or (row[3] is not None and (row[3] != record.mtime or row[4] != record.inode)):
+            self.file_db.update(*record)
+            self.status('updated', os.path.join(record.filedir, record.filename), record.filesize, row[2])
+            self.changed.append(record)
+
+    def remove_tree(self, path):
+        if self.output is not None and not self.output.quiet:
+            for row in self.file_db.iter_files_in_dir(path):
+                self.output.status('deleted', os.path.join(row[0], row[1]))
+            for row in self.file_db.iter_files_below_dir(path):
+                self.output.status('deleted', os.path.join(row[0], row[1]))
+        self.totals['deleted'] += self.file_db.delete_tree(path)